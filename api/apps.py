@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        # モデルのシグナル(検索インデックスの更新など)を登録する
+        from . import signals  # noqa: F401
+        # DB接続のヘルスチェックと接続数の集計(api.connections)
+        from .connections import connect_signals
+        connect_signals()
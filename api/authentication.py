@@ -0,0 +1,108 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils.functional import cached_property
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from .cache import get_cache
+
+# JWT認証でリクエストごとに発生していたユーザーの取得クエリを省くための認証クラス
+# トークンのuser_idからユーザーオブジェクトを組み立て、DBのユーザーはビューが必要とした時だけ取得する。
+# 退会・無効化のチェックに使うユーザーの状態(is_active等)は短時間だけキャッシュし、
+# ユーザーの保存・削除時にはシグナルでキャッシュを消す
+
+USER_STATE_KEY = 'api:user-state:{}'
+
+
+def get_user_state(user_id):
+    cache = get_cache()
+    key = USER_STATE_KEY.format(user_id)
+    state = cache.get(key)
+    if state is None:
+        row = get_user_model().objects.filter(pk=user_id).values('is_active', 'is_staff', 'is_superuser').first()
+        # 存在しないユーザーも「存在しない」という状態としてキャッシュする
+        state = row or {'is_active': False, 'is_staff': False, 'is_superuser': False, 'missing': True}
+        cache.set(key, state, getattr(settings, 'JWT_USER_STATE_TIMEOUT', 60))
+    return state
+
+
+def forget_user_state(user_id):
+    get_cache().delete(USER_STATE_KEY.format(user_id))
+
+
+# トークンとキャッシュしたユーザーの状態から作るユーザーオブジェクト
+# id/pk・is_active・is_staff・is_superuserはDBを参照せずに使える。
+# それ以外の属性・メソッド(email、groups、get_username()、save()など)は、初めて使った時にDBから取得したユーザーに委譲する
+# (simplejwtのTokenUserは権限・保存などのメソッドを自前で定義していて委譲できないので継承しない)
+class CachedTokenUser:
+    is_anonymous = False
+    is_authenticated = True
+
+    def __init__(self, token, state):
+        set_local = super().__setattr__
+        set_local('token', token)
+        set_local('id', token[api_settings.USER_ID_CLAIM])
+        set_local('pk', self.id)
+        set_local('is_active', state['is_active'])
+        set_local('is_staff', state['is_staff'])
+        set_local('is_superuser', state['is_superuser'])
+
+    @cached_property
+    def user(self):
+        return get_user_model().objects.get(pk=self.pk)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    # 属性の変更はDBのユーザーに反映する(user.email = ...; user.save() のように使えるように)
+    def __setattr__(self, name, value):
+        if name in ('token', 'id', 'pk'):
+            raise AttributeError("can't set attribute {}".format(name))
+        if name in ('is_active', 'is_staff', 'is_superuser'):
+            super().__setattr__(name, value)
+        setattr(self.user, name, value)
+
+    # 有効なスーパーユーザーは全ての権限を持つ(PermissionsMixinと同じ)ので、DBのユーザーを取得しない
+    def has_perm(self, perm, obj=None):
+        if self.is_active and self.is_superuser:
+            return True
+        return self.user.has_perm(perm, obj)
+
+    def has_perms(self, perm_list, obj=None):
+        return all(self.has_perm(perm, obj) for perm in perm_list)
+
+    def has_module_perms(self, app_label):
+        if self.is_active and self.is_superuser:
+            return True
+        return self.user.has_module_perms(app_label)
+
+    # DBのユーザー(request.user == post.author など)とも、同じIDなら等しい
+    # (ModelのUser.__eq__はモデル以外とは常にFalseを返すので、request.userを左辺にして比較する)
+    def __eq__(self, other):
+        if isinstance(other, (CachedTokenUser, get_user_model())):
+            return self.pk == other.pk
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __str__(self):
+        return str(self.user)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Token contained no recognizable user identification')
+
+        state = get_user_state(user_id)
+        if state.get('missing'):
+            raise AuthenticationFailed('User not found', code='user_not_found')
+        if not state['is_active']:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+
+        return CachedTokenUser(validated_token, state)
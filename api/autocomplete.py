@@ -0,0 +1,158 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, F, Min, Sum
+from django.db.models.functions import Coalesce
+from . import search
+from .cache import get_versions
+from .models import Category, Post, Restaurant
+
+# 店舗名・カテゴリー名・メニュー名の前方一致の入力補完
+# 正規化した名前(*_normalized)のインデックスで前方一致の行だけを読み、投稿数の多い順にlimit件返す。
+# 店舗の投稿数は集計値(RestaurantStats)を使う。カテゴリー・メニュー名は前方一致する名前を名前順にAUTOCOMPLETE_CANDIDATES件まで選び、
+# その候補の投稿数だけを数える(候補がそれより多い短い接頭辞では、名前順で後ろの候補は含まれない)
+#   Postgres: db_index=TrueのCharFieldに付くvarchar_pattern_opsのインデックス(LIKE 'prefix%')
+#   SQLite  : 大文字小文字を区別しないLIKEはインデックスを使えないため、範囲(prefix <= name < 次の文字列)で検索する
+# 結果はプロセス内のLRUキャッシュ(AUTOCOMPLETE_CACHE_SIZE件、API_CACHE_TIMEOUT秒まで)に入れ、
+# モデルのバージョン(api.cache、全ワーカーで共有)が変わったら使わない。レスポンスキャッシュが無効(API_CACHE_ENABLED)なら使わない。
+# 短い接頭辞の結果がlimit件未満なら、それを伸ばした接頭辞の結果はその中にすべて含まれるので、DBに問い合わせずに絞り込む
+
+Source = namedtuple('Source', ['namespaces', 'query'])
+
+MAX_PREFIX_LENGTH = 100
+
+
+def normalize(text, max_length=200):
+    # 全角・半角、大文字・小文字、連続した空白の違いを吸収する
+    return ' '.join(search.normalize(text).split())[:max_length]
+
+
+def prefix_filter(field, prefix):
+    if connection.vendor == 'sqlite':
+        # SQLiteの文字列の比較はコードポイント順なので、最後の文字を1つ進めた文字列が上限になる
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return {field + '__gte': prefix, field + '__lt': upper}
+    return {field + '__startswith': prefix}
+
+
+def _restaurants(prefix, limit):
+    rows = (
+        Restaurant.objects.filter(**prefix_filter('name_normalized', prefix))
+        .order_by(F('stats__post_count').desc(nulls_last=True), 'name_normalized', 'id')
+        .values('id', 'name', 'location', 'name_normalized', 'stats__post_count')[:limit]
+    )
+    return [
+        (row['name_normalized'], {'id': row['id'], 'name': row['name'], 'location': row['location'],
+                                  'post_count': row['stats__post_count'] or 0})
+        for row in rows
+    ]
+
+
+def candidate_count(limit):
+    return max(limit, getattr(settings, 'AUTOCOMPLETE_CANDIDATES', 200))
+
+
+# カテゴリーの投稿数は店舗×カテゴリーの集計値(RestaurantCategoryStats)の合計で、投稿の中間テーブルは数えない
+def _categories(prefix, limit):
+    candidates = (
+        Category.objects.filter(**prefix_filter('name_normalized', prefix))
+        .order_by('name_normalized', 'id').values('id')[:candidate_count(limit)]
+    )
+    rows = (
+        Category.objects.filter(id__in=candidates)
+        .annotate(post_count=Coalesce(Sum('restaurant_stats__post_count'), 0))
+        .order_by('-post_count', 'name_normalized', 'id')
+        .values('id', 'name', 'name_normalized', 'post_count')[:limit]
+    )
+    return [(row['name_normalized'], {'id': row['id'], 'name': row['name'], 'post_count': row['post_count']})
+            for row in rows]
+
+
+# メニュー名は正規化した名前ごとにまとめ、表示には元の名前のうちの1つを使う
+# 投稿を数えるのは名前順に選んだ候補の名前の投稿だけにする(短い接頭辞で前方一致する全投稿を集計しない)
+def _menu_items(prefix, limit):
+    candidates = (
+        Post.objects.filter(**prefix_filter('menu_item_normalized', prefix))
+        .order_by('menu_item_normalized').values('menu_item_normalized').distinct()[:candidate_count(limit)]
+    )
+    rows = (
+        Post.objects.filter(menu_item_normalized__in=candidates)
+        .values('menu_item_normalized')
+        .annotate(post_count=Count('id'), display=Min('menu_item'))
+        .order_by('-post_count', 'menu_item_normalized')[:limit]
+    )
+    return [(row['menu_item_normalized'], {'menu_item': row['display'], 'post_count': row['post_count']})
+            for row in rows]
+
+
+SOURCES = {
+    # 店舗の投稿数は投稿から集計されるので、投稿の変更でもキャッシュを使わなくする
+    'restaurant': Source(('restaurant', 'post'), _restaurants),
+    'category': Source(('category', 'post'), _categories),
+    'menu_item': Source(('post',), _menu_items),
+}
+
+
+class PrefixCache:
+    def __init__(self, max_size, timeout=300):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, versions):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != versions or entry[2] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, versions, results):
+        with self._lock:
+            self._entries[key] = (versions, results, time.monotonic() + self.timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+prefix_cache = PrefixCache(
+    getattr(settings, 'AUTOCOMPLETE_CACHE_SIZE', 2000), timeout=getattr(settings, 'API_CACHE_TIMEOUT', 300)
+)
+
+
+# 接頭辞queryに一致する候補を投稿数の多い順にlimit件返す
+def complete(kind, query, limit):
+    source = SOURCES[kind]
+    prefix = normalize(query, MAX_PREFIX_LENGTH)
+    if not prefix:
+        return []
+    if not getattr(settings, 'API_CACHE_ENABLED', True):
+        return [item for _, item in source.query(prefix, limit)]
+    versions = tuple(get_versions(source.namespaces))
+
+    results = prefix_cache.get((kind, prefix, limit), versions)
+    if results is None:
+        results = _from_shorter_prefix(kind, prefix, limit, versions)
+        if results is None:
+            results = source.query(prefix, limit)
+        prefix_cache.set((kind, prefix, limit), versions, results)
+    return [item for _, item in results]
+
+
+def _from_shorter_prefix(kind, prefix, limit, versions):
+    for length in range(len(prefix) - 1, 0, -1):
+        results = prefix_cache.get((kind, prefix[:length], limit), versions)
+        if results is not None and len(results) < limit:
+            return [(key, item) for key, item in results if key.startswith(prefix)]
+    return None
@@ -0,0 +1,345 @@
+import json
+import platform
+import random
+import subprocess
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, URLResolver
+
+from . import autocomplete, bulk, rankings, search, stats
+from .cache import invalidate
+from .restaurants import restaurant_key
+from .models import Category, ChunkedUpload, Post, Profile, Restaurant, User
+
+# APIのベンチマーク(manage.py seed_data / bench_api)
+# - seed(): 件数を指定してユーザー・プロフィール・店舗・カテゴリー・投稿をbulk_createで作成する(乱数のシードを固定して再現可能)
+# - ApiBenchmark: api/urls.pyの全てのルートとJWTの発行・更新にリクエストを送り、
+#   レイテンシーのパーセンタイルと1リクエストあたりのクエリ数をJSONで返す(コミット間で比較できる)
+# 書き込みのリクエストはトランザクションをロールバックするので、何回実行してもデータは変わらない
+
+BENCH_PASSWORD = 'bench-password'
+BENCH_EMAIL = 'bench{}@example.com'
+BENCH_EMAIL_RE = r'^bench[0-9]+@example\.com$'
+
+MENU_ITEMS = ('醤油ラーメン', '味噌ラーメン', '特上寿司', '天ぷら定食', 'カツカレー', 'ステーキコンボ', 'オムライス', 'パンケーキ', '焼き鳥', 'ハンバーグ')
+RESTAURANT_NAMES = ('らーめん', '寿司', '食堂', 'ビストロ', '珈琲店', 'ステーキハウス', '居酒屋', 'ベーカリー')
+LOCATIONS = ('東京', '大阪', '京都', '神戸', '福岡', '札幌', '名古屋', '横浜')
+REVIEWS = ('おいしかった', 'また来たい', 'ボリュームがある', 'スープが濃厚', '値段の割に量が多い', '')
+
+DEFAULT_VOLUMES = {'users': 50, 'restaurants': 200, 'categories': 20, 'posts': 5000}
+
+
+# batch_size: 1回のトランザクションで作成する投稿数(1回のINSERTの行数はDBに合わせてDjangoが決める)
+# 何回実行してもよい: 作成済みのユーザー・プロフィール・カテゴリー・店舗はそのまま使い、
+# 前回作成した投稿は消してから作り直す(同じ件数・シードなら同じデータになる)
+def seed(users=50, restaurants=200, categories=20, posts=5000, categories_per_post=2, batch_size=1000, random_seed=0):
+    rng = random.Random(random_seed)
+    # パスワードのハッシュ化は遅いので全員同じハッシュにする
+    password = make_password(BENCH_PASSWORD)
+    emails = [BENCH_EMAIL.format(index) for index in range(users)]
+    User.objects.bulk_create([User(email=email, password=password) for email in emails], ignore_conflicts=True)
+    user_ids = list(User.objects.filter(email__in=emails).order_by('id').values_list('id', flat=True))
+    Profile.objects.bulk_create(
+        [Profile(nickName='bench{}'.format(index), userProfile_id=user_id) for index, user_id in enumerate(user_ids)],
+        ignore_conflicts=True,
+    )
+    category_names = ['bench-category-{}'.format(index) for index in range(categories)]
+    Category.objects.bulk_create(
+        [Category(name=name, name_normalized=name) for name in category_names], ignore_conflicts=True,
+    )
+    category_ids = list(Category.objects.filter(name__in=category_names).order_by('id').values_list('id', flat=True))
+    restaurant_names = [
+        ('{} {}'.format(rng.choice(RESTAURANT_NAMES), index), rng.choice(LOCATIONS)) for index in range(restaurants)
+    ]
+    # bulk_createではシグナルが呼ばれないため、重複チェック用のキーと正規化した名前もここで付ける
+    restaurant_keys = [restaurant_key(name, location) for name, location in restaurant_names]
+    Restaurant.objects.bulk_create([
+        Restaurant(name=name, location=location, dedup_key=key, name_normalized=autocomplete.normalize(name))
+        for (name, location), key in zip(restaurant_names, restaurant_keys)
+    ], ignore_conflicts=True)
+    restaurant_rows = list(Restaurant.objects.filter(dedup_key__in=restaurant_keys).order_by('id')
+                           .values_list('id', 'name', 'location'))
+    _delete_seeded_posts()
+
+    created = 0
+    while created < posts:
+        count = min(batch_size, posts - created)
+        batch = []
+        for index in range(created, created + count):
+            restaurant_id, name, location = rng.choice(restaurant_rows)
+            menu_item, review = rng.choice(MENU_ITEMS), rng.choice(REVIEWS)
+            batch.append(Post(
+                author_id=user_ids[index % len(user_ids)], restaurant_id=restaurant_id, menu_item=menu_item,
+                menu_item_normalized=autocomplete.normalize(menu_item),
+                score=rng.randint(1, 5), price=rng.randrange(300, 5000, 10), review_text=review,
+                search_document=search.build_search_document(menu_item, review, name, location),
+            ))
+        with transaction.atomic():
+            Post.objects.bulk_create(batch)
+            bulk.assign_bulk_ids(batch)
+            Post.category.through.objects.bulk_create([
+                Post.category.through(post_id=post.id, category_id=category_id)
+                for post in batch
+                for category_id in rng.sample(category_ids, min(categories_per_post, len(category_ids)))
+            ])
+            search.index_posts((post.id, post.search_document) for post in batch)
+        created += count
+
+    stats.rebuild_all(batch_size=batch_size)
+    rankings.refresh(full=True)
+    invalidate('post', 'restaurant', 'category', 'profile')
+    return {'users': users, 'restaurants': restaurants, 'categories': categories, 'posts': posts}
+
+
+# 前回のseedで作成した投稿(ベンチマーク用のユーザーの投稿)を消す
+def _delete_seeded_posts():
+    with transaction.atomic():
+        Post.objects.filter(author__email__regex=BENCH_EMAIL_RE).delete()
+
+
+Scenario = namedtuple('Scenario', ['name', 'route', 'method', 'path', 'auth', 'data', 'content_type', 'write'])
+
+
+def scenario(name, route, path, method='GET', auth=True, data=None, content_type='application/json', write=False):
+    return Scenario(name, route, method, path, auth, data, content_type, write)
+
+
+class ApiBenchmark:
+    # ストレージへの書き込みが必要なため計測しないルート
+    SKIPPED = {
+        'user:uploadconfirm': 'requires a file in the storage bucket',
+        'user:uploadlocal': 'writes to the default storage',
+        'user:chunkedupload-finalize': 'writes to the default storage',
+    }
+
+    def __init__(self, iterations=50, warmup=3, cache=False):
+        self.iterations = iterations
+        self.warmup = warmup
+        self.cache = cache
+
+    def run(self, volumes=None):
+        from rest_framework_simplejwt.tokens import RefreshToken
+
+        user = User.objects.get(email=BENCH_EMAIL.format(0))
+        self.refresh = RefreshToken.for_user(user)
+        self.access = str(self.refresh.access_token)
+
+        overrides = {'DIRECT_UPLOAD_BACKEND': 'api.signed_uploads.LocalUploadBackend'}
+        if not self.cache:
+            overrides['API_CACHE_ENABLED'] = False
+        routes = {}
+        with override_settings(**overrides):
+            scenarios = self.scenarios(user)
+            for item in scenarios:
+                routes[item.name] = self.measure(item)
+
+        covered = {item.route for item in scenarios}
+        return {
+            'meta': self.meta(volumes),
+            'routes': routes,
+            'skipped': self.SKIPPED,
+            'uncovered': sorted(route_names() - covered - set(self.SKIPPED)),
+        }
+
+    def scenarios(self, user):
+        post = Post.objects.filter(author_id=user.pk).order_by('id').first()
+        other_post = Post.objects.exclude(author_id=user.pk).order_by('id').first() or post
+        restaurant = Restaurant.objects.order_by('id').first()
+        categories = list(Category.objects.order_by('id').values_list('id', flat=True)[:2])
+        profile = Profile.objects.get(userProfile_id=user.pk)
+        upload, _ = ChunkedUpload.objects.get_or_create(user_id=user.pk, post=post, filename='bench.glb', size=1024)
+        second_page = Client().get('/api/post_list/', HTTP_ACCEPT='application/json').json().get('next') or '/api/post_list/'
+        new_post = {
+            'restaurant': restaurant.id, 'category': categories, 'menu_item': 'ベンチマーク', 'score': 4, 'price': 1000,
+        }
+        import_body = ''.join(json.dumps({
+            'menu_item': 'インポート{}'.format(index), 'restaurant': restaurant.name,
+            'restaurant_location': restaurant.location, 'price': 500 + index,
+        }, ensure_ascii=False) + '\n' for index in range(20))
+
+        return [
+            scenario('api_root', 'user:api-root', '/api/'),
+            scenario('register', 'user:register', '/api/register/', 'POST', auth=False,
+                     data={'email': 'bench-new@example.com', 'password': BENCH_PASSWORD}, write=True),
+            scenario('jwt_create', 'jwt-create', '/authen/jwt/create/', 'POST', auth=False,
+                     data={'email': user.email, 'password': BENCH_PASSWORD}),
+            scenario('jwt_refresh', 'jwt-refresh', '/authen/jwt/refresh/', 'POST', auth=False,
+                     data={'refresh': str(self.refresh)}),
+            scenario('jwt_verify', 'jwt-verify', '/authen/jwt/verify/', 'POST', auth=False, data={'token': self.access}),
+            scenario('myprofile', 'user:myprofile', '/api/myprofile/'),
+            scenario('profile_list', 'user:profile-list', '/api/profile/'),
+            scenario('profile_detail', 'user:profile-detail', '/api/profile/{}/'.format(profile.id)),
+            scenario('profile_update', 'user:profile-detail', '/api/profile/{}/'.format(profile.id), 'PATCH',
+                     data={'nickName': 'bench'}, write=True),
+            scenario('post_viewset_list', 'user:post-list', '/api/post/'),
+            scenario('post_viewset_detail', 'user:post-detail', '/api/post/{}/'.format(post.id)),
+            scenario('post_create', 'user:post-list', '/api/post/', 'POST', data=new_post, write=True),
+            scenario('post_update', 'user:post-detail', '/api/post/{}/'.format(post.id), 'PATCH',
+                     data={'score': 5, 'category': categories[:1]}, write=True),
+            scenario('post_delete', 'user:post-detail', '/api/post/{}/'.format(post.id), 'DELETE', write=True),
+            scenario('post_list', 'user:postlist', '/api/post_list/', auth=False),
+            scenario('post_list_page2', 'user:postlist', second_page, auth=False),
+            scenario('post_list_filtered', 'user:postlist',
+                     '/api/post_list/?category={}&score_min=3&ordering=-score'.format(categories[0]), auth=False),
+            scenario('post_list_expanded', 'user:postlist',
+                     '/api/post_list/?expand=restaurant,category,author_profile', auth=False),
+            scenario('my_posts', 'user:mypost', '/api/mypost/?summary=true'),
+            scenario('user_posts', 'user:userposts', '/api/user/{}/posts/'.format(user.pk), auth=False),
+            scenario('post_detail', 'user:postdetail', '/api/post_detail/{}/'.format(other_post.id), auth=False),
+            scenario('post_search', 'user:postsearch', '/api/post/search/?q=ラーメン', auth=False),
+            scenario('post_import', 'user:postimport', '/api/post_import/', 'POST', data=import_body,
+                     content_type='application/x-ndjson', write=True),
+            scenario('post_export', 'user:postexport', '/api/post_export/'),
+            scenario('restaurant_list', 'user:restaurant-list', '/api/restaurant/', auth=False),
+            scenario('restaurant_detail', 'user:restaurant-detail', '/api/restaurant/{}/'.format(restaurant.id), auth=False),
+            scenario('restaurant_create', 'user:restaurant-list', '/api/restaurant/', 'POST',
+                     data={'name': 'ベンチマーク', 'location': '東京'}, write=True),
+            scenario('restaurant_nearby', 'user:restaurant-nearby',
+                     '/api/restaurant/nearby/?lat=35.6812&lng=139.7671&radius=5', auth=False),
+            scenario('restaurant_lookup', 'user:restaurant-lookup', '/api/restaurant/lookup/?{}'.format(
+                urlencode({'name': restaurant.name, 'location': restaurant.location})), auth=False),
+            scenario('restaurant_resolve', 'user:restaurant-lookup', '/api/restaurant/lookup/', 'POST',
+                     data={'name': restaurant.name.upper(), 'location': restaurant.location}, write=True),
+            scenario('autocomplete_restaurant', 'user:autocomplete', '/api/autocomplete/restaurant/?q=ら', auth=False),
+            scenario('autocomplete_menu_item', 'user:autocomplete', '/api/autocomplete/menu_item/?q=醤', auth=False),
+            scenario('ranking_trending', 'user:ranking', '/api/ranking/trending/?expand=restaurant', auth=False),
+            scenario('ranking_top_rated', 'user:ranking',
+                     '/api/ranking/top_rated/?category={}'.format(categories[0]), auth=False),
+            scenario('category_list', 'user:category-list', '/api/category/', auth=False),
+            scenario('category_detail', 'user:category-detail', '/api/category/{}/'.format(categories[0]), auth=False),
+            scenario('model_upload_create', 'user:chunkedupload-list', '/api/model_upload/', 'POST',
+                     data={'post': post.id, 'filename': 'bench.glb', 'size': 1024}, write=True),
+            scenario('model_upload_detail', 'user:chunkedupload-detail', '/api/model_upload/{}/'.format(upload.id)),
+            scenario('upload_url', 'user:uploadurl', '/api/upload_url/', 'POST',
+                     data={'target': 'post_photo', 'id': post.id, 'filename': 'bench.jpg'}, write=True),
+        ]
+
+    def measure(self, item):
+        client = Client()
+        headers = {'HTTP_ACCEPT': 'application/json'}
+        if item.auth:
+            headers['HTTP_AUTHORIZATION'] = 'JWT {}'.format(self.access)
+        data = item.data
+        if data is not None and item.content_type == 'application/json':
+            data = json.dumps(data)
+
+        latencies = []
+        queries = []
+        status_codes = set()
+        for iteration in range(self.warmup + self.iterations):
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                if item.write:
+                    with transaction.atomic():
+                        response = self._request(client, item, data, headers)
+                        transaction.set_rollback(True)
+                else:
+                    response = self._request(client, item, data, headers)
+                elapsed = time.perf_counter() - started
+            if iteration < self.warmup:
+                continue
+            latencies.append(elapsed)
+            queries.append(len(captured))
+            status_codes.add(response.status_code)
+
+        latencies.sort()
+        return {
+            'route': item.route,
+            'method': item.method,
+            'path': item.path,
+            'status': sorted(status_codes),
+            'iterations': len(latencies),
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies) * 1000, 2),
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': percentile(latencies, 100),
+            },
+            'queries': {'min': min(queries), 'max': max(queries), 'mean': round(sum(queries) / len(queries), 2)},
+        }
+
+    def _request(self, client, item, data, headers):
+        kwargs = dict(headers)
+        if data is not None:
+            kwargs['content_type'] = item.content_type
+        response = client.generic(item.method, item.path, data or '', **kwargs)
+        if response.streaming:
+            # ストリーミングのレスポンスは最後まで読み出した時間を計測する
+            b''.join(response.streaming_content)
+        return response
+
+    def meta(self, volumes):
+        return {
+            'commit': git_commit(),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'volumes': volumes,
+            'iterations': self.iterations,
+            'warmup': self.warmup,
+            'cache': self.cache,
+        }
+
+
+def percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, max(0, int(round(percent / 100 * len(sorted_values))) - 1))
+    return round(sorted_values[index] * 1000, 2)
+
+
+# api/urls.pyとJWT(authen/)のルート名
+def route_names():
+    from djoser.urls import jwt
+    from . import urls
+
+    names = set()
+
+    def collect(patterns, namespace):
+        for pattern in patterns:
+            if isinstance(pattern, URLResolver):
+                collect(pattern.url_patterns, pattern.namespace or namespace)
+            elif isinstance(pattern, URLPattern) and pattern.name:
+                names.add('{}:{}'.format(namespace, pattern.name) if namespace else pattern.name)
+
+    collect(urls.urlpatterns, urls.app_name)
+    collect(jwt.urlpatterns, None)
+    return names
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=str(settings.BASE_DIR),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# 2つの結果(JSON)のレイテンシー(p50)とクエリ数の差分
+def compare(baseline, current):
+    rows = []
+    for name, result in current['routes'].items():
+        before = baseline.get('routes', {}).get(name)
+        if before is None:
+            continue
+        p50_before, p50_after = before['latency_ms']['p50'], result['latency_ms']['p50']
+        rows.append({
+            'name': name,
+            'p50_before': p50_before,
+            'p50_after': p50_after,
+            'p50_change': round((p50_after - p50_before) / p50_before * 100, 1) if p50_before else None,
+            'queries_before': before['queries']['max'],
+            'queries_after': result['queries']['max'],
+        })
+    return rows
@@ -0,0 +1,327 @@
+import csv
+import io
+import json
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError, connections, router, transaction
+
+from . import autocomplete, restaurants, search, stats
+from .cache import invalidate
+from .models import Category, Post
+from .serializers import PostImportRowSerializer
+
+# 投稿の一括インポート・エクスポート(スプレッドシートや提携先のフィードからの移行用)
+# 1行1投稿のNDJSONかCSVを1行ずつ読み、BULK_IMPORT_BATCH_SIZE行ごとに
+#   投稿のbulk_create → カテゴリーの中間テーブルのbulk_create
+# で保存する。読み込んだ行はバッチ単位でしか保持しないので、ファイルの大きさによらずメモリの使用量は一定
+# 店舗は店舗名・場所ごとに1回だけ取得(または作成)し、カテゴリーは最初に読み込んだ辞書で解決するので、行ごとにクエリを発行しない
+#
+# bulk_createではシグナルが呼ばれないため、シグナルで行っている処理(検索インデックス・店舗の集計値・キャッシュの無効化)は
+# バッチごとにまとめて行う
+#
+# 行の形式(エクスポートも同じ形式で、そのままインポートできる):
+#   {"menu_item": "醤油ラーメン", "restaurant": "店舗名", "restaurant_location": "場所", "category": ["ラーメン"],
+#    "score": 4, "price": 800, "review_text": "...", "author": "user@example.com"}
+# CSVは同じ名前の列を持ち、categoryは「|」区切り
+
+FORMAT_NDJSON = 'ndjson'
+FORMAT_CSV = 'csv'
+FORMATS = (FORMAT_NDJSON, FORMAT_CSV)
+
+CONTENT_TYPES = {
+    FORMAT_NDJSON: 'application/x-ndjson; charset=utf-8',
+    FORMAT_CSV: 'text/csv; charset=utf-8',
+}
+
+CATEGORY_SEPARATOR = '|'
+EXPORT_FIELDS = (
+    'id', 'created_on', 'author', 'restaurant', 'restaurant_location', 'category',
+    'menu_item', 'score', 'price', 'review_text',
+)
+
+
+def read_lines(stream):
+    # バイト列・文字列どちらのストリームからも1行ずつ文字列として読む(先頭のBOMは取り除く)
+    if stream is None:
+        return
+    first = True
+    while True:
+        line = stream.readline()
+        if not line:
+            return
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if first:
+            line = line.lstrip('\ufeff')
+            first = False
+        yield line
+
+
+# (行番号, 行のdict, エラー) を順に返す
+def iter_ndjson(lines):
+    for line_no, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as exc:
+            yield line_no, None, {'non_field_errors': ['Invalid JSON: {}'.format(exc)]}
+            continue
+        if not isinstance(row, dict):
+            yield line_no, None, {'non_field_errors': ['Each line must be a JSON object.']}
+            continue
+        if isinstance(row.get('category'), str):
+            row['category'] = _split_categories(row['category'])
+        yield line_no, row, None
+
+
+def iter_csv(lines):
+    reader = csv.DictReader(lines)
+    try:
+        for row in reader:
+            # 空のセルは未指定として扱う(デフォルト値を使う)
+            row = {key: value for key, value in row.items() if key and value not in ('', None)}
+            if 'category' in row:
+                row['category'] = _split_categories(row['category'])
+            yield reader.line_num, row, None
+    except csv.Error as exc:
+        yield reader.line_num, None, {'non_field_errors': ['Invalid CSV: {}'.format(exc)]}
+
+
+def iter_rows(stream, data_format):
+    lines = read_lines(stream)
+    if data_format == FORMAT_CSV:
+        return iter_csv(lines)
+    return iter_ndjson(lines)
+
+
+def _split_categories(value):
+    return [name.strip() for name in value.split(CATEGORY_SEPARATOR) if name.strip()]
+
+
+class PostImporter:
+    # author_id: authorを指定しない行の投稿者
+    # allow_author: 行のauthorを受け付けるか(APIでは常にリクエストしたユーザーの投稿にする)
+    def __init__(self, author_id=None, allow_author=False, batch_size=None, create_missing=False, max_errors=None):
+        self.author_id = author_id
+        self.allow_author = allow_author
+        self.batch_size = batch_size or getattr(settings, 'BULK_IMPORT_BATCH_SIZE', 500)
+        self.create_missing = create_missing
+        self.max_errors = max_errors if max_errors is not None else getattr(settings, 'BULK_IMPORT_MAX_ERRORS', 100)
+        self.created = 0
+        self.failed = 0
+        self.errors = []
+        self._restaurants = {}
+        self._categories = None
+        self._authors = {}
+
+    def run(self, rows):
+        batch = []
+        for line_no, row, error in rows:
+            if error is None:
+                post, category_ids, error = self._build(row)
+            if error is not None:
+                self._add_error(line_no, error)
+                continue
+            batch.append((line_no, post, category_ids))
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = []
+        if batch:
+            self._flush(batch)
+        return self.result()
+
+    def result(self):
+        return {'created': self.created, 'failed': self.failed, 'errors': self.errors}
+
+    def _add_error(self, line_no, error):
+        self.failed += 1
+        # エラーの詳細は先頭のmax_errors件だけ返す(件数はfailedで分かる)
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line_no, 'errors': error})
+
+    # 1行分の値を検証して、保存前の投稿とカテゴリーIDを作る
+    def _build(self, row):
+        serializer = PostImportRowSerializer(data=row)
+        if not serializer.is_valid():
+            return None, None, serializer.errors
+        data = serializer.validated_data
+
+        errors = {}
+        restaurant = self._resolve_restaurant(data['restaurant'], data['restaurant_location'])
+        if restaurant is None:
+            errors['restaurant'] = ['Unknown restaurant "{}".'.format(data['restaurant'])]
+        category_ids = []
+        for name in dict.fromkeys(data['category']):
+            category_id = self._resolve_category(name)
+            if category_id is None:
+                errors.setdefault('category', []).append('Unknown category "{}".'.format(name))
+            category_ids.append(category_id)
+        author_id = self._resolve_author(data.get('author'), errors)
+        if errors:
+            return None, None, errors
+
+        restaurant_id, restaurant_name, restaurant_location = restaurant
+        post = Post(
+            author_id=author_id, restaurant_id=restaurant_id, menu_item=data['menu_item'],
+            score=data['score'], price=data['price'], review_text=data['review_text'],
+            menu_item_normalized=autocomplete.normalize(data['menu_item']),
+            search_document=search.build_search_document(
+                data['menu_item'], data['review_text'], restaurant_name, restaurant_location
+            ),
+        )
+        return post, category_ids, None
+
+    # 店舗名・場所から (ID, 店舗名, 場所) を返す
+    # 店舗はrestaurants.get_or_create(作成しない場合はrestaurants.find)で、正規化した店舗名・場所のキーによって解決する
+    # 結果はキーごとに覚えておく(同じ店舗の行が続いてもクエリは最初の1回だけ)
+    def _resolve_restaurant(self, name, location):
+        key = restaurants.restaurant_key(name, location)
+        if key not in self._restaurants:
+            if self.create_missing:
+                restaurant, _ = restaurants.get_or_create(name, location)
+            else:
+                restaurant = restaurants.find(name, location)
+            self._restaurants[key] = restaurant and (restaurant.id, restaurant.name, restaurant.location)
+        return self._restaurants[key]
+
+    def _resolve_category(self, name):
+        if self._categories is None:
+            self._categories = dict(Category.objects.values_list('name', 'id'))
+        category_id = self._categories.get(name)
+        if category_id is None and self.create_missing:
+            category_id = self._categories[name] = Category.objects.get_or_create(name=name)[0].id
+        return category_id
+
+    def _resolve_author(self, email, errors):
+        if not self.allow_author or not email:
+            if self.author_id is None:
+                errors['author'] = ['This field is required.']
+            return self.author_id
+        if email not in self._authors:
+            self._authors[email] = get_user_model().objects.filter(email__iexact=email).values_list('id', flat=True).first()
+        if self._authors[email] is None:
+            errors['author'] = ['Unknown user "{}".'.format(email)]
+        return self._authors[email]
+
+    def _flush(self, batch):
+        posts = [post for _, post, _ in batch]
+        try:
+            with transaction.atomic():
+                Post.objects.bulk_create(posts)
+                assign_bulk_ids(posts)
+                Post.category.through.objects.bulk_create([
+                    Post.category.through(post_id=post.id, category_id=category_id)
+                    for _, post, category_ids in batch for category_id in category_ids
+                ])
+                search.index_posts((post.id, post.search_document) for post in posts)
+                stats.refresh_restaurants({post.restaurant_id for post in posts})
+                invalidate('post', 'restaurant')
+        except DatabaseError as exc:
+            for line_no, _, _ in batch:
+                self._add_error(line_no, {'non_field_errors': [str(exc)]})
+            return
+        self.created += len(posts)
+
+
+# bulk_createで作成した投稿にIDを設定する
+# Postgresなどは INSERT ... RETURNING でbulk_createがIDを設定する。
+# SQLiteはIDを返さないが、AUTOINCREMENTのIDは挿入した順に増え、トランザクション中は他の接続から書き込まれないため、
+# IDの大きい方からlen(posts)件が今回作成した投稿になる
+def assign_bulk_ids(posts):
+    if not posts:
+        return
+    connection = connections[router.db_for_write(Post)]
+    if connection.features.can_return_rows_from_bulk_insert:
+        return
+    ids = list(Post.objects.order_by('-id').values_list('id', flat=True)[:len(posts)])
+    for post, post_id in zip(posts, reversed(ids)):
+        post.id = post_id
+
+
+# 投稿をインポートと同じ形式のdictで1件ずつ返す
+# 投稿は.iterator()でchunk_size件ずつ読み、カテゴリーはそのchunk_size件分をまとめて1回のクエリで取得する
+# authorは投稿者のID。author_emails=Trueの場合はメールアドレス(管理者が実行するmanage.py export_posts用。
+# APIでは他のユーザーのメールアドレスを返さない)
+def iter_export_rows(queryset=None, chunk_size=None, author_emails=False):
+    chunk_size = chunk_size or getattr(settings, 'BULK_EXPORT_CHUNK_SIZE', 1000)
+    queryset = Post.objects.all() if queryset is None else queryset
+    categories = dict(Category.objects.values_list('id', 'name'))
+    author_field = 'author__email' if author_emails else 'author_id'
+    rows = queryset.order_by('id').values(
+        'id', 'created_on', author_field, 'restaurant__name', 'restaurant__location',
+        'menu_item', 'score', 'price', 'review_text',
+    ).iterator(chunk_size=chunk_size)
+
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield from _export_chunk(chunk, categories, author_field)
+            chunk = []
+    if chunk:
+        yield from _export_chunk(chunk, categories, author_field)
+
+
+def _export_chunk(chunk, categories, author_field):
+    post_categories = defaultdict(list)
+    through = Post.category.through.objects.filter(post_id__in=[row['id'] for row in chunk])
+    for post_id, category_id in through.order_by('post_id', 'category_id').values_list('post_id', 'category_id'):
+        post_categories[post_id].append(categories.get(category_id, ''))
+    for row in chunk:
+        yield {
+            'id': row['id'],
+            'created_on': row['created_on'].isoformat(),
+            'author': row[author_field],
+            'restaurant': row['restaurant__name'],
+            'restaurant_location': row['restaurant__location'],
+            'category': post_categories.get(row['id'], []),
+            'menu_item': row['menu_item'],
+            'score': row['score'],
+            'price': row['price'],
+            'review_text': row['review_text'],
+        }
+
+
+# エクスポートする行を1行ずつの文字列にする
+def render_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+def render_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for row in rows:
+        row = dict(row, category=CATEGORY_SEPARATOR.join(row['category']))
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def render_rows(rows, data_format):
+    if data_format == FORMAT_CSV:
+        return render_csv(rows)
+    return render_ndjson(rows)
+
+
+# 1行ずつの文字列をsize文字程度にまとめて返す(行ごとに書き込むと送信の回数が多くなるため)
+def buffered(lines, size=64 * 1024):
+    parts = []
+    length = 0
+    for line in lines:
+        parts.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(parts)
+            parts = []
+            length = 0
+    if parts:
+        yield ''.join(parts)
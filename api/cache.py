@@ -0,0 +1,119 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+
+# 誰でもアクセスできる読み取り系APIのレスポンスキャッシュ
+# キャッシュのキーには依存するデータの「バージョン」を含め、モデルが保存・削除されたらバージョンを上げる(シグナル)。
+# 古いバージョンのキーは参照されなくなり、タイムアウトかLRUで消えるので、書き込み後に古いデータを返すことはない。
+# キャッシュのバックエンドは settings.API_CACHE_ALIAS のキャッシュ(デフォルトはローカルメモリ、REDIS_URL設定時はRedis)
+# バージョンはこのキャッシュに置くので、全ワーカーで共有されるキャッシュ(Redis)でなければ複数のワーカーでは使えない
+# (settings.SHARED_CACHEがFalseの場合はAPI_CACHE_ENABLEDを有効にできない)
+
+VERSION_KEY = 'api:version:{}'
+RESPONSE_KEY = 'api:response:{}:{}'
+
+
+def get_cache():
+    return caches[getattr(settings, 'API_CACHE_ALIAS', 'default')]
+
+
+def get_versions(namespaces):
+    cache = get_cache()
+    keys = [VERSION_KEY.format(namespace) for namespace in namespaces]
+    versions = cache.get_many(keys)
+    missing = {key: _initial_version() for key in keys if key not in versions}
+    if missing:
+        # add()なので他のプロセスが先に設定していればそちらが優先される
+        for key, value in missing.items():
+            cache.add(key, value, None)
+        versions.update(cache.get_many(list(missing)))
+    return [versions.get(key, 0) for key in keys]
+
+
+# namespaceのバージョンを上げて、そのデータに依存するキャッシュをまとめて無効にする
+def bump_version(*namespaces):
+    cache = get_cache()
+    for namespace in namespaces:
+        key = VERSION_KEY.format(namespace)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # バージョンのキーが消えていた場合は、以前の値と重ならない値から始める
+            cache.set(key, _initial_version(), None)
+
+
+# すぐにバージョンを上げ、トランザクションの確定後にもう一度上げる
+# (確定までの間に他のリクエストが確定前の古いデータを新しいバージョンのキーでキャッシュしても、確定後に無効になる)
+def invalidate(*namespaces):
+    bump_version(*namespaces)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: bump_version(*namespaces))
+
+
+def _initial_version():
+    return int(time.time() * 1000)
+
+
+# レビューなど誰が見ても同じ内容を返すビューのGETレスポンスをキャッシュするMixin
+# - 認証ヘッダーのないGET/HEADのみを対象にする
+# - ETagを付け、If-None-Matchが一致すれば304を返す
+# cache_namespaces: レスポンスが依存するデータ(このnamespaceのバージョンが上がるとキャッシュが無効になる)
+#                   ?expand=のようにURLによって変わる場合はget_cache_namespacesをオーバーライドする
+class CachedResponseMixin:
+    cache_namespaces = ()
+    cache_timeout = None
+
+    def dispatch(self, request, *args, **kwargs):
+        if not self._is_cacheable_request(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        cache = get_cache()
+        key = self._response_cache_key(request)
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type, etag = cached
+            return self._cached_response(request, content, content_type, etag)
+
+        response = super().dispatch(request, *args, **kwargs)
+        if response.status_code != 200:
+            return response
+        if hasattr(response, 'render'):
+            response.render()
+        etag = '"{}"'.format(hashlib.md5(response.content).hexdigest())
+        timeout = self.cache_timeout if self.cache_timeout is not None else getattr(settings, 'API_CACHE_TIMEOUT', 300)
+        cache.set(key, (response.content, response['Content-Type'], etag), timeout)
+        return self._cached_response(request, response.content, response['Content-Type'], etag, response)
+
+    def _is_cacheable_request(self, request):
+        return (
+            getattr(settings, 'API_CACHE_ENABLED', True)
+            and request.method in ('GET', 'HEAD')
+            and 'HTTP_AUTHORIZATION' not in request.META
+        )
+
+    # リクエストによって依存するデータが増える場合(?expand=など)はオーバーライドする
+    def get_cache_namespaces(self, request):
+        return self.cache_namespaces
+
+    def _response_cache_key(self, request):
+        versions = get_versions(self.get_cache_namespaces(request))
+        # 同じURLでもAcceptによってJSON/ブラウザブルAPIが変わるのでキーに含める
+        source = '{}|{}|{}'.format(request.get_full_path(), request.META.get('HTTP_ACCEPT', ''), versions)
+        return RESPONSE_KEY.format(type(self).__name__, hashlib.md5(source.encode('utf-8')).hexdigest())
+
+    def _cached_response(self, request, content, content_type, etag, response=None):
+        if etag in _parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        elif response is None:
+            response = HttpResponse(content, content_type=content_type)
+        response['ETag'] = etag
+        response['Vary'] = 'Accept, Authorization'
+        return response
+
+
+def _parse_etags(header):
+    return {etag.strip() for etag in header.split(',') if etag.strip()}
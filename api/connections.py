@@ -0,0 +1,234 @@
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+# データベースへの接続の管理(settings.DB_CONN_MODE)
+# - persistent: CONN_MAX_AGEで接続を使い回す。DB_HEALTH_CHECK_INTERVAL秒以上使っていない接続は、
+#               リクエストの最初に使えるか確認し(SELECT 1)、切れていれば閉じて次のクエリで接続し直す
+# - pool      : ConnectionPool(api.pool_backend)。リクエストの終わりに接続を閉じる代わりにプールへ返す
+# 接続数・プールの状態は/metrics(api.metrics)に出力する
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# スレッドセーフな接続プール
+# checkout(connect): 空いている接続を返す。なければconnect()で作り(max_size本まで)、すべて使用中ならtimeout秒まで返却を待つ
+# checkin(): 返却された接続はトランザクションの途中なら戻し、壊れている・max_lifetime秒を超えた接続は閉じて捨てる
+class ConnectionPool:
+    def __init__(self, alias, max_size=8, timeout=10.0, max_lifetime=1800.0, health_check_interval=30.0):
+        self.alias = alias
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self._condition = threading.Condition()
+        # (接続, 作成時刻, 返却時刻)
+        self._idle = deque()
+        self._created_at = {}
+        self.in_use = 0
+        self.opened = 0
+        self.closed = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+    @property
+    def size(self):
+        return self.in_use + len(self._idle)
+
+    def checkout(self, connect):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._condition:
+            waited = False
+            while not self._idle and self.size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout('No database connection available in the pool within {}s.'.format(self.timeout))
+                waited = True
+                self._condition.wait(remaining)
+            if waited:
+                self.waits += 1
+                self.wait_seconds += time.monotonic() - started
+            entry = self._idle.pop() if self._idle else None
+            self.in_use += 1
+
+        try:
+            if entry is not None:
+                connection = self._reuse(*entry)
+                if connection is not None:
+                    return connection
+            connection = connect()
+        except Exception:
+            with self._condition:
+                self.in_use -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._created_at[id(connection)] = time.monotonic()
+            self.opened += 1
+        return connection
+
+    # discard=True: エラーで使えなくなった接続(再利用せずに閉じる)
+    def checkin(self, connection, discard=False):
+        keep = not discard and not connection.closed and not self._expired(connection)
+        if keep and connection.get_transaction_status() != 0:
+            # トランザクションの途中で返された接続(エラーなど)は戻してから再利用する
+            try:
+                connection.rollback()
+            except Exception:
+                keep = False
+        with self._condition:
+            self.in_use -= 1
+            if keep:
+                self._idle.append((connection, self._created_at.get(id(connection), 0.0), time.monotonic()))
+            self._condition.notify()
+        if not keep:
+            self._discard(connection)
+
+    # プールの接続をすべて閉じる(テストやプロセスの終了時)
+    def close_all(self):
+        with self._condition:
+            idle, self._idle = list(self._idle), deque()
+        for connection, _, _ in idle:
+            self._discard(connection)
+
+    def _reuse(self, connection, created_at, returned_at):
+        if connection.closed or self._expired(connection):
+            self._discard(connection)
+            return None
+        if time.monotonic() - returned_at >= self.health_check_interval:
+            ok = _ping(connection)
+            record_health_check(self.alias, ok)
+            if not ok:
+                self._discard(connection)
+                return None
+        return connection
+
+    def _expired(self, connection):
+        created_at = self._created_at.get(id(connection))
+        return created_at is not None and time.monotonic() - created_at > self.max_lifetime
+
+    def _discard(self, connection):
+        with self._condition:
+            self._created_at.pop(id(connection), None)
+            self.closed += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+# DBの接続(DB-APIの接続)で SELECT 1 が実行できるか
+def _ping(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        return True
+    except Exception:
+        return False
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, options):
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None:
+            pool = _pools[alias] = ConnectionPool(
+                alias,
+                max_size=options.get('MAX_SIZE', 8),
+                timeout=options.get('TIMEOUT', 10.0),
+                max_lifetime=options.get('MAX_LIFETIME', 1800.0),
+                health_check_interval=getattr(settings, 'DB_HEALTH_CHECK_INTERVAL', 30.0),
+            )
+        return pool
+
+
+# 接続数とヘルスチェックの集計(/metrics用)
+_stats_lock = threading.Lock()
+connects = defaultdict(int)
+health_checks = defaultdict(int)
+
+
+def record_health_check(alias, ok):
+    with _stats_lock:
+        health_checks[(alias, 'ok' if ok else 'failed')] += 1
+
+
+def count_connection(sender, connection, **kwargs):
+    with _stats_lock:
+        connects[(connection.alias, connection.vendor)] += 1
+
+
+# persistent: 一定時間使っていない接続をリクエストの最初に確認する
+# (Djangoのclose_old_connectionsはCONN_MAX_AGEを過ぎた接続とエラーの起きた接続しか閉じないため、
+#  DB側で切られた接続を使うと最初のクエリがエラーになる)
+def check_idle_connections(**kwargs):
+    interval = getattr(settings, 'DB_HEALTH_CHECK_INTERVAL', 30.0)
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block:
+            continue
+        if now - getattr(connection, '_api_last_used', now) < interval:
+            continue
+        ok = connection.is_usable()
+        record_health_check(connection.alias, ok)
+        if not ok:
+            logger.info('Closing unusable database connection %s.', connection.alias)
+            connection.close()
+
+
+def mark_connections_used(**kwargs):
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is not None:
+            connection._api_last_used = now
+
+
+def connect_signals():
+    connection_created.connect(count_connection, dispatch_uid='api.connections.count_connection')
+    request_started.connect(check_idle_connections, dispatch_uid='api.connections.check_idle_connections')
+    request_finished.connect(mark_connections_used, dispatch_uid='api.connections.mark_connections_used')
+
+
+# /metricsに出力する行
+def render_metrics(lines, counter, gauge):
+    with _stats_lock:
+        counter(lines, 'api_db_connects_total', 'Database connections opened by Django (pool checkouts in pool mode).',
+                ('alias', 'vendor'), dict(connects))
+        counter(lines, 'api_db_health_checks_total', 'Health checks of reused database connections.',
+                ('alias', 'result'), dict(health_checks))
+    with _pools_lock:
+        pools = list(_pools.values())
+    if not pools:
+        return
+    gauge(lines, 'api_db_pool_connections', 'Pooled database connections by state.', ('alias', 'state'), {
+        key: value for pool in pools
+        for key, value in (((pool.alias, 'in_use'), pool.in_use), ((pool.alias, 'idle'), len(pool._idle)))
+    })
+    gauge(lines, 'api_db_pool_max_size', 'Maximum pooled connections per process.', ('alias',),
+          {(pool.alias,): pool.max_size for pool in pools})
+    counter(lines, 'api_db_pool_opened_total', 'Physical connections opened by the pool.', ('alias',),
+            {(pool.alias,): pool.opened for pool in pools})
+    counter(lines, 'api_db_pool_closed_total', 'Physical connections closed by the pool.', ('alias',),
+            {(pool.alias,): pool.closed for pool in pools})
+    counter(lines, 'api_db_pool_waits_total', 'Checkouts that had to wait for a free connection.', ('alias',),
+            {(pool.alias,): pool.waits for pool in pools})
+    counter(lines, 'api_db_pool_wait_seconds_total', 'Time spent waiting for a free connection.', ('alias',),
+            {(pool.alias,): pool.wait_seconds for pool in pools})
+    counter(lines, 'api_db_pool_timeouts_total', 'Checkouts that timed out.', ('alias',),
+            {(pool.alias,): pool.timeouts for pool in pools})
@@ -0,0 +1,62 @@
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+from .models import Post
+
+
+# 投稿の絞り込み用フィルター
+# ?category=1,2      カテゴリーID(複数指定時はいずれかに該当する投稿)
+# ?restaurant=1      店舗ID
+# ?author=1          投稿者ID
+# ?score_min=3&score_max=5, ?price_min=500&price_max=1500  範囲指定(両端を含む)
+class PostFilter(BaseFilterBackend):
+    range_params = (
+        ('score_min', 'score__gte'),
+        ('score_max', 'score__lte'),
+        ('price_min', 'price__gte'),
+        ('price_max', 'price__lte'),
+    )
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+
+        category_ids = _int_list(params, 'category')
+        if category_ids:
+            # JOIN + DISTINCTではなく中間テーブルの(category_id, post_id)インデックスで投稿IDを引く
+            post_ids = Post.category.through.objects.filter(category_id__in=category_ids).values('post_id')
+            queryset = queryset.filter(id__in=post_ids)
+
+        for name in ('restaurant', 'author'):
+            value = _int_param(params, name)
+            if value is not None:
+                queryset = queryset.filter(**{name + '_id': value})
+
+        for name, lookup in self.range_params:
+            value = _int_param(params, name)
+            if value is not None:
+                queryset = queryset.filter(**{lookup: value})
+
+        return queryset
+
+
+def _int_param(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError({name: ['A valid integer is required.']})
+
+
+def _int_list(params, name):
+    values = []
+    for raw in params.getlist(name):
+        for item in raw.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            try:
+                values.append(int(item))
+            except ValueError:
+                raise ValidationError({name: ['A comma separated list of integers is required.']})
+    return values
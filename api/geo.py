@@ -0,0 +1,139 @@
+import json
+import math
+import time
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.db.models import F, FloatField, Q
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
+
+# 店舗の位置(緯度・経度)による近くの店舗の検索
+# 緯度・経度からgeohash(地図を32分割ずつした区画の文字列)を作ってRestaurant.geohashに保存し、インデックスを付ける。
+# 近くの店舗は、半径をカバーする区画(中心とその周り8区画)のgeohashの前方一致 → 緯度・経度の範囲 → 距離
+# の順で絞り込むため、PostgresでもSQLiteでもテーブル全体を走査しない
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 12
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        # 経度・緯度の順に交互に範囲を半分にしていき、5ビットごとに1文字にする
+        target, span = (longitude, lng_range) if even else (latitude, lat_range)
+        middle = (span[0] + span[1]) / 2
+        value <<= 1
+        if target >= middle:
+            value |= 1
+            span[0] = middle
+        else:
+            span[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+# 指定した長さのgeohashの区画の大きさ(緯度方向・経度方向の度数)
+def cell_size(precision):
+    lat_bits = (5 * precision) // 2
+    lng_bits = 5 * precision - lat_bits
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+# 半径radius_kmの円を中心と周り8区画でカバーできる最も細かいgeohashの長さ
+def precision_for_radius(latitude, radius_km):
+    lat_km_per_degree = KM_PER_DEGREE
+    lng_km_per_degree = KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01)
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        lat_size, lng_size = cell_size(precision)
+        if lat_size * lat_km_per_degree >= radius_km and lng_size * lng_km_per_degree >= radius_km:
+            return precision
+    return 1
+
+
+# 中心の区画と周りの8区画のgeohash
+def covering_cells(latitude, longitude, radius_km):
+    precision = precision_for_radius(latitude, radius_km)
+    lat_size, lng_size = cell_size(precision)
+    cells = set()
+    for lat_step in (-1, 0, 1):
+        for lng_step in (-1, 0, 1):
+            lat = min(max(latitude + lat_step * lat_size, -90.0), 90.0)
+            lng = (longitude + lng_step * lng_size + 180.0) % 360.0 - 180.0
+            cells.add(encode(lat, lng, precision))
+    return sorted(cells)
+
+
+# geohashがprefixで始まる行の条件
+# LIKE 'prefix%' はSQLite(大文字小文字を区別しないLIKE)やPostgres(C以外の照合順序)でインデックスを使えないため、
+# 範囲(prefix <= geohash < 次のprefix)で指定する
+def prefix_filter(prefix, field='geohash'):
+    condition = Q(**{field + '__gte': prefix})
+    upper = _next_prefix(prefix)
+    if upper:
+        condition &= Q(**{field + '__lt': upper})
+    return condition
+
+
+def _next_prefix(prefix):
+    while prefix:
+        index = GEOHASH_ALPHABET.index(prefix[-1])
+        if index + 1 < len(GEOHASH_ALPHABET):
+            return prefix[:-1] + GEOHASH_ALPHABET[index + 1]
+        prefix = prefix[:-1]
+    return ''
+
+
+# 距離(km、haversine)のアノテーション
+# 三角関数はPostgresの関数、SQLiteではDjangoが登録する関数で計算される
+def distance_expression(latitude, longitude, lat_field='latitude', lng_field='longitude'):
+    lat1 = math.radians(latitude)
+    d_lat = (Radians(F(lat_field)) - lat1) / 2
+    d_lng = (Radians(F(lng_field)) - math.radians(longitude)) / 2
+    a = Power(Sin(d_lat), 2) + math.cos(lat1) * Cos(Radians(F(lat_field))) * Power(Sin(d_lng), 2)
+    return ASin(Sqrt(a), output_field=FloatField()) * (2 * EARTH_RADIUS_KM)
+
+
+# (latitude, longitude)から半径radius_km以内の店舗を近い順に並べたクエリセット(distanceに距離(km)が入る)
+def nearby(queryset, latitude, longitude, radius_km):
+    cells = Q()
+    for cell in covering_cells(latitude, longitude, radius_km):
+        cells |= prefix_filter(cell)
+    lat_delta = radius_km / KM_PER_DEGREE
+    queryset = queryset.filter(cells).filter(latitude__gte=latitude - lat_delta, latitude__lte=latitude + lat_delta)
+    lng_delta = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+    if -180.0 <= longitude - lng_delta and longitude + lng_delta <= 180.0:
+        # 日付変更線をまたぐ場合は経度の範囲では絞り込まない(geohashと距離で絞り込む)
+        queryset = queryset.filter(longitude__gte=longitude - lng_delta, longitude__lte=longitude + lng_delta)
+    return queryset.annotate(distance=distance_expression(latitude, longitude)).filter(
+        distance__lte=radius_km
+    ).order_by('distance', 'id')
+
+
+# 住所・店舗名から緯度・経度を調べる(manage.py backfill_restaurant_locationsで使用)
+# GEOCODER_URLはNominatim(OpenStreetMap)互換のAPI。見つからない場合はNone
+def geocode(query):
+    url = '{}?{}'.format(
+        getattr(settings, 'GEOCODER_URL', 'https://nominatim.openstreetmap.org/search'),
+        urlencode({'q': query, 'format': 'json', 'limit': 1}),
+    )
+    request = Request(url, headers={'User-Agent': getattr(settings, 'GEOCODER_USER_AGENT', 'api_gourmet')})
+    with urlopen(request, timeout=10) as response:
+        results = json.loads(response.read().decode('utf-8'))
+    # Nominatimの利用規約に合わせてリクエストの間隔を空ける
+    time.sleep(getattr(settings, 'GEOCODER_INTERVAL', 1.0))
+    if not results:
+        return None
+    return float(results[0]['lat']), float(results[0]['lon'])
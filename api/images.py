@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+
+from .cache import invalidate
+
+logger = logging.getLogger(__name__)
+
+# アップロードされた画像(投稿のメニュー画像・プロフィール画像)から、幅の違う縮小版をWebPとJPEGで作るパイプライン
+# 元画像の保存はこれまで通りImageFieldで行い、縮小版はバックグラウンドのスレッドで作成して
+# 画像のファイル名(ストレージ上のキー)を <元画像のフィールド名>_variants にJSONで記録する
+#   {"320": {"webp": "posts/1ramen.w320.webp", "jpg": "posts/1ramen.w320.jpg"}, ...}
+# ストレージはフィールドのstorage(DEFAULT_FILE_STORAGE)を使うので、テストではローカルのファイルシステムでも動く
+
+# 縮小版を作る画像フィールドと、縮小版を記録するフィールド
+IMAGE_FIELDS = {
+    ('api.Post', 'menu_item_photo'): 'menu_item_photo_variants',
+    ('api.Profile', 'img'): 'img_variants',
+}
+
+VARIANT_FORMATS = (
+    ('webp', 'WEBP'),
+    ('jpg', 'JPEG'),
+)
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'IMAGE_PIPELINE_WORKERS', 2),
+            thread_name_prefix='image-pipeline',
+        )
+    return _executor
+
+
+def image_fields(instance):
+    label = instance._meta.label
+    return [(field_name, variants_field) for (model_label, field_name), variants_field in IMAGE_FIELDS.items()
+            if model_label == label]
+
+
+# 保存前(pre_save)に、新しい画像がアップロードされた・画像が変わったフィールドを調べる
+# 古い縮小版の記録は消し、新しい画像があれば保存後に縮小版を作る
+def prepare_variants(instance):
+    instance._pending_images = []
+    deferred = instance.get_deferred_fields()
+    for field_name, variants_field in image_fields(instance):
+        if field_name in deferred:
+            # 読み込んでいない(only/defer)画像は保存されないので変わらない
+            continue
+        image_file = getattr(instance, field_name)
+        uploaded = bool(image_file) and not image_file._committed
+        if uploaded or instance.has_changed(field_name):
+            setattr(instance, variants_field, '')
+            if image_file:
+                instance._pending_images.append(field_name)
+
+
+# 保存後(post_save)に、prepare_variantsで見つけた画像の縮小版の作成を予約する
+def schedule_pending_variants(instance):
+    for field_name in getattr(instance, '_pending_images', []):
+        schedule_variants(instance, field_name)
+    instance._pending_images = []
+
+
+# 縮小版の作成を予約する(トランザクションの確定後にワーカーへ渡す)
+def schedule_variants(instance, field_name):
+    label = instance._meta.label
+    pk = instance.pk
+    transaction.on_commit(lambda: run_in_background(generate_variants, label, pk, field_name))
+
+
+# バックグラウンドのスレッドで実行する(IMAGE_PIPELINE_SYNCの場合はその場で実行する)
+# 縮小版の作成と、使われなくなったファイルの削除(api.media)で使う
+def run_in_background(func, *args):
+    if getattr(settings, 'IMAGE_PIPELINE_SYNC', False):
+        func(*args)
+    else:
+        _get_executor().submit(_run_in_worker, func, *args)
+
+
+def _run_in_worker(func, *args):
+    try:
+        func(*args)
+    except Exception:
+        logger.exception('Failed to run %s%r in the image pipeline.', func.__name__, args)
+    finally:
+        # ワーカースレッドが持つDB接続を閉じる
+        close_old_connections()
+
+
+def generate_variants(label, pk, field_name):
+    model = apps.get_model(label)
+    variants_field = IMAGE_FIELDS[(label, field_name)]
+    instance = model.objects.filter(pk=pk).only('pk', field_name).first()
+    if instance is None:
+        return None
+    image_file = getattr(instance, field_name)
+    if not image_file:
+        return None
+
+    # Pillowのimportは縮小版を作る時まで遅らせる(ワーカーの起動時間を短くするため)
+    from PIL import Image, ImageOps
+
+    name = image_file.name
+    storage = image_file.storage
+    with storage.open(name, 'rb') as source:
+        image = Image.open(source)
+        image.load()
+    # スマホで撮影した画像の向き(EXIF)を反映する
+    image = ImageOps.exif_transpose(image)
+
+    base = os.path.splitext(name)[0]
+    variants = {}
+    for width in sorted(set(getattr(settings, 'IMAGE_VARIANT_WIDTHS', (320, 640, 1280)))):
+        if width >= image.width and variants:
+            # 元画像より大きい縮小版は作らない(元画像が最小の幅より小さい場合は元の大きさで1つだけ作る)
+            break
+        resized = image.copy()
+        resized.thumbnail((width, width * 10), Image.LANCZOS)
+        for ext, image_format in VARIANT_FORMATS:
+            variants.setdefault(str(width), {})[ext] = storage.save(
+                '{}.w{}.{}'.format(base, width, ext), ContentFile(_encode(resized, image_format))
+            )
+
+    # 処理中に画像が差し替えられていた場合は記録しない
+    model.objects.filter(pk=pk, **{field_name: name}).update(**{variants_field: json.dumps(variants)})
+    invalidate(model._meta.model_name)
+    return variants
+
+
+# Pillowで開ける画像か(署名付きURLで直接アップロードされたファイルの確認用、画素のデコードはしない)
+def is_valid_image(file):
+    from PIL import Image
+
+    try:
+        with Image.open(file) as image:
+            image.verify()
+    except Exception:
+        return False
+    return True
+
+
+def _encode(image, image_format):
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = BytesIO()
+    image.save(buffer, format=image_format, quality=getattr(settings, 'IMAGE_VARIANT_QUALITY', 80))
+    return buffer.getvalue()
+
+
+# <フィールド名>_variants のJSONを {幅: {形式: URL}} に変換する(シリアライザー用)
+def variant_urls(instance, field_name):
+    raw = getattr(instance, IMAGE_FIELDS[(instance._meta.label, field_name)])
+    if not raw:
+        return {}
+    storage = getattr(instance, field_name).storage
+    return {
+        width: {ext: storage.url(name) for ext, name in formats.items()}
+        for width, formats in json.loads(raw).items()
+    }
@@ -0,0 +1,67 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from api import geo
+from api.cache import invalidate
+from api.models import Restaurant
+
+
+# 既存の店舗の緯度・経度とgeohashを補完するコマンド
+# --csv      id,latitude,longitude のCSV(ヘッダー行あり)から緯度・経度を設定する
+# --geocode  緯度・経度が未設定の店舗を「店舗名 場所」でジオコーディングする(GEOCODER_URL)
+# 緯度・経度を持つ店舗はgeohashを計算し直す(bulk_updateのためsignalsは通らない)
+class Command(BaseCommand):
+    help = 'Backfill restaurant latitude/longitude (from a CSV or a geocoder) and recompute geohashes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--csv', help='CSV file with id,latitude,longitude columns.')
+        parser.add_argument('--geocode', action='store_true', help='Geocode restaurants without coordinates.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        coordinates = self.read_csv(options['csv']) if options['csv'] else {}
+        geocoded = {}
+        changed = []
+        missing = 0
+        for restaurant in Restaurant.objects.order_by('id').iterator():
+            if restaurant.id in coordinates:
+                restaurant.latitude, restaurant.longitude = coordinates[restaurant.id]
+            elif restaurant.latitude is None and options['geocode']:
+                # 同じ店舗名・場所は一度だけ問い合わせる
+                query = '{} {}'.format(restaurant.name, restaurant.location).strip()
+                if query not in geocoded:
+                    geocoded[query] = geo.geocode(query)
+                if geocoded[query]:
+                    restaurant.latitude, restaurant.longitude = geocoded[query]
+
+            if restaurant.latitude is None or restaurant.longitude is None:
+                missing += 1
+                geohash = ''
+            else:
+                geohash = geo.encode(restaurant.latitude, restaurant.longitude)
+            if restaurant.id in coordinates or geohash != restaurant.geohash:
+                restaurant.geohash = geohash
+                changed.append(restaurant)
+
+        with transaction.atomic():
+            Restaurant.objects.bulk_update(changed, ['latitude', 'longitude', 'geohash'], batch_size=options['batch_size'])
+        if changed:
+            invalidate('restaurant')
+        self.stdout.write(self.style.SUCCESS(
+            'Updated {} restaurants ({} still without coordinates).'.format(len(changed), missing)
+        ))
+
+    def read_csv(self, path):
+        coordinates = {}
+        with open(path, newline='', encoding='utf-8-sig') as file:
+            for line_no, row in enumerate(csv.DictReader(file), start=2):
+                try:
+                    latitude, longitude = float(row['latitude']), float(row['longitude'])
+                    restaurant_id = int(row['id'])
+                except (KeyError, TypeError, ValueError):
+                    raise CommandError('Invalid row at line {}.'.format(line_no))
+                if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                    raise CommandError('Coordinates out of range at line {}.'.format(line_no))
+                coordinates[restaurant_id] = (latitude, longitude)
+        return coordinates
@@ -0,0 +1,56 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from api import benchmarks
+
+
+# APIの全ルートのレイテンシーとクエリ数を計測するコマンド
+# テスト用のDBを作成してseed_dataと同じデータを入れてから計測し、終わったら削除する(開発用のDBには書き込まない)
+#   manage.py bench_api --posts 20000 --output bench.json
+#   manage.py bench_api --compare bench.json      (以前の結果との比較)
+class Command(BaseCommand):
+    help = 'Benchmark latency percentiles and queries per request for every API route.'
+
+    def add_arguments(self, parser):
+        for name, default in benchmarks.DEFAULT_VOLUMES.items():
+            parser.add_argument('--{}'.format(name), type=int, default=default, help='Number of {} to seed.'.format(name))
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the seeded data.')
+        parser.add_argument('--iterations', type=int, default=50, help='Measured requests per route.')
+        parser.add_argument('--warmup', type=int, default=3, help='Unmeasured requests per route.')
+        parser.add_argument('--cache', action='store_true', help='Keep the response cache enabled.')
+        parser.add_argument('--keepdb', action='store_true', help='Reuse the test database between runs.')
+        parser.add_argument('--output', '-o', help='Write the JSON results to this file.')
+        parser.add_argument('--compare', help='Previous results (JSON) to compare against.')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            volumes = {name: options[name] for name in benchmarks.DEFAULT_VOLUMES}
+            if not options['keepdb'] or not benchmarks.User.objects.filter(email=benchmarks.BENCH_EMAIL.format(0)).exists():
+                benchmarks.seed(random_seed=options['seed'], **volumes)
+            results = benchmarks.ApiBenchmark(
+                iterations=options['iterations'], warmup=options['warmup'], cache=options['cache'],
+            ).run(volumes)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        output = json.dumps(results, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as file:
+                baseline = json.load(file)
+            self.stderr.write('{:<24} {:>10} {:>10} {:>8} {:>8}'.format('route', 'p50 before', 'p50 after', 'change', 'queries'))
+            for row in benchmarks.compare(baseline, results):
+                self.stderr.write('{:<24} {:>10} {:>10} {:>7}% {:>3} -> {}'.format(
+                    row['name'], row['p50_before'], row['p50_after'], row['p50_change'],
+                    row['queries_before'], row['queries_after'],
+                ))
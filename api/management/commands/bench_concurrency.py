@@ -0,0 +1,135 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+DEFAULT_PATHS = ('/api/post_list/', '/api/restaurant/', '/api/category/')
+
+SERVER_COMMANDS = {
+    'wsgi': ['gunicorn', 'api_gourmet.wsgi:application'],
+    'asgi': ['gunicorn', 'api_gourmet.asgi:application', '-k', 'uvicorn.workers.UvicornWorker'],
+}
+
+
+# 読み取り系APIに同時にリクエストを送り、スループットとレイテンシーを計測するコマンド
+# --url  起動済みのサーバーを計測する
+# それ以外 WSGI(gunicornの同期ワーカー)とASGI(uvicornのワーカー)のサーバーを同じワーカー数で順に起動して比較する
+# 結果はJSONで出力する
+class Command(BaseCommand):
+    help = 'Benchmark concurrent read throughput of the WSGI and ASGI server modes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base URL of an already running server (e.g. http://127.0.0.1:8000).')
+        parser.add_argument('--modes', default='wsgi,asgi', help='Server modes to start and compare (wsgi,asgi).')
+        parser.add_argument('--paths', default=','.join(DEFAULT_PATHS), help='Comma separated paths to request.')
+        parser.add_argument('--concurrency', type=int, default=50, help='Number of concurrent clients.')
+        parser.add_argument('--requests', type=int, default=1000, help='Total number of requests per run.')
+        parser.add_argument('--workers', type=int, default=2, help='Server worker processes (WEB_CONCURRENCY).')
+        parser.add_argument('--threads', type=int, default=8, help='View threads per ASGI worker (ASGI_THREADS).')
+        parser.add_argument('--timeout', type=float, default=30.0, help='Per request timeout in seconds.')
+
+    def handle(self, *args, **options):
+        paths = [path for path in options['paths'].split(',') if path]
+        if options['url']:
+            results = {'url': self.run(options['url'].rstrip('/'), paths, options)}
+        else:
+            results = {}
+            for mode in [mode for mode in options['modes'].split(',') if mode]:
+                if mode not in SERVER_COMMANDS:
+                    raise CommandError('Unknown server mode: {}'.format(mode))
+                results[mode] = self.run_server(mode, paths, options)
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def run_server(self, mode, paths, options):
+        port = _free_port()
+        env = dict(
+            os.environ,
+            DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'api_gourmet.settings'),
+            WEB_CONCURRENCY=str(options['workers']),
+            ASGI_THREADS=str(options['threads']),
+        )
+        command = SERVER_COMMANDS[mode] + ['--bind', '127.0.0.1:{}'.format(port), '--log-level', 'warning']
+        server = subprocess.Popen(command, cwd=str(settings.BASE_DIR), env=env, stdout=sys.stderr, stderr=sys.stderr)
+        base_url = 'http://127.0.0.1:{}'.format(port)
+        try:
+            _wait_until_ready(base_url + paths[0], server)
+            # 接続の確立やインポートなど初回のみの処理を計測から除く
+            self.run(base_url, paths, dict(options, requests=options['concurrency']))
+            result = self.run(base_url, paths, options)
+            result['command'] = ' '.join(command)
+            return result
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    def run(self, base_url, paths, options):
+        urls = [base_url + paths[i % len(paths)] for i in range(options['requests'])]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            samples = list(executor.map(lambda url: _request(url, options['timeout']), urls))
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for ok, latency in samples if ok)
+        errors = len(samples) - len(latencies)
+        return {
+            'requests': len(samples),
+            'concurrency': options['concurrency'],
+            'errors': errors,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+                'p50': _percentile(latencies, 50),
+                'p90': _percentile(latencies, 90),
+                'p99': _percentile(latencies, 99),
+                'max': _percentile(latencies, 100),
+            },
+        }
+
+
+def _request(url, timeout):
+    started = time.perf_counter()
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            response.read()
+            ok = response.status == 200
+    except (HTTPError, URLError, OSError):
+        ok = False
+    return ok, time.perf_counter() - started
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(percent / 100 * len(values))) - 1))
+    return round(values[index] * 1000, 1)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_ready(url, server, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise CommandError('Server exited with status {}.'.format(server.returncode))
+        try:
+            with urlopen(url, timeout=2) as response:
+                response.read()
+                return
+        except HTTPError:
+            return
+        except (URLError, OSError):
+            time.sleep(0.2)
+    raise CommandError('Server did not start within {} seconds.'.format(timeout))
@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished, request_started
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+MODES = ('off', 'persistent', 'pool')
+
+
+# データベースへの接続の持ち方(settings.DB_CONN_MODE)ごとに、リクエストの処理(接続 → SELECT 1 → リクエストの終わり)を
+# 繰り返してレイテンシーと新しく開いた接続の数を計測するコマンド
+# モードは設定の読み込み時に決まるため、モードごとにDB_CONN_MODEを指定した別のプロセスで計測する
+# poolはPostgresのみ(それ以外のDBではスキップする)。結果はJSONで出力する
+class Command(BaseCommand):
+    help = 'Benchmark per-request database connection overhead of the DB_CONN_MODE settings.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', default=','.join(MODES), help='Connection modes to compare (off,persistent,pool).')
+        parser.add_argument('--requests', type=int, default=500, help='Number of simulated requests per mode.')
+        parser.add_argument('--threads', type=int, default=1, help='Concurrent request threads.')
+        parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['child']:
+            self.stdout.write(json.dumps(self.run(options)))
+            return
+
+        results = {}
+        for mode in [mode for mode in options['modes'].split(',') if mode]:
+            if mode not in MODES:
+                raise CommandError('Unknown connection mode: {}'.format(mode))
+            if mode == 'pool' and connection.vendor != 'postgresql':
+                results[mode] = {'skipped': 'pool mode requires PostgreSQL ({}).'.format(connection.vendor)}
+                continue
+            results[mode] = self.run_child(mode, options)
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def run_child(self, mode, options):
+        env = dict(
+            os.environ,
+            DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'api_gourmet.settings'),
+            DB_CONN_MODE=mode,
+        )
+        command = [
+            sys.executable, 'manage.py', 'bench_db_connections', '--child',
+            '--requests', str(options['requests']), '--threads', str(options['threads']),
+        ]
+        output = subprocess.run(
+            command, cwd=str(settings.BASE_DIR), env=env, stdout=subprocess.PIPE, stderr=sys.stderr, check=True,
+        ).stdout
+        return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+    def run(self, options):
+        opened = []
+        connection_created.connect(lambda **kwargs: opened.append(1), weak=False)
+
+        # 最初の接続を計測から除く
+        _request()
+        opened.clear()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            latencies = sorted(executor.map(lambda _: _request(), range(options['requests'])))
+        elapsed = time.perf_counter() - started
+        return {
+            'mode': settings.DB_CONN_MODE,
+            'engine': connection.settings_dict['ENGINE'],
+            'requests': len(latencies),
+            'threads': options['threads'],
+            'connections_opened': len(opened),
+            'elapsed_s': round(elapsed, 3),
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+                'p50': _percentile(latencies, 50),
+                'p90': _percentile(latencies, 90),
+                'p99': _percentile(latencies, 99),
+                'max': _percentile(latencies, 100),
+            },
+        }
+
+
+# 1リクエスト分の処理(Djangoのハンドラーと同じようにrequest_started/request_finishedを送る)
+def _request():
+    started = time.perf_counter()
+    request_started.send(sender=Command)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+    finally:
+        request_finished.send(sender=Command)
+    return time.perf_counter() - started
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(percent / 100 * len(values))) - 1))
+    return round(values[index] * 1000, 3)
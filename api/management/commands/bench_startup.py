@@ -0,0 +1,67 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# 計測する起動処理(それぞれ新しいPythonのプロセスで実行する)
+#   settings      : 設定のimport
+#   check         : manage.py check (管理コマンドの起動)
+#   wsgi / asgi   : gunicornのワーカーの起動(アプリケーションのimportとdjango.setup())
+#   first_request : ワーカーの起動から最初のレスポンス(/api/category/、DBへの接続を含む)まで
+TARGETS = {
+    'settings': [sys.executable, '-c', 'import api_gourmet.settings'],
+    'check': [sys.executable, 'manage.py', 'check'],
+    'wsgi': [sys.executable, '-c', 'from api_gourmet.wsgi import application'],
+    'asgi': [sys.executable, '-c', 'from api_gourmet.asgi import application'],
+    'first_request': [sys.executable, '-c', '\n'.join([
+        'from api_gourmet.wsgi import application',
+        'from django.conf import settings',
+        'from django.test import Client',
+        "host = settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS else 'localhost'",
+        "response = Client(HTTP_HOST=host).get('/api/category/', HTTP_ACCEPT='application/json')",
+        'assert response.status_code == 200, response.status_code',
+    ])],
+}
+
+
+# ワーカーの起動・管理コマンドの起動にかかる時間(コールドスタート)を計測するコマンド
+# 起動するたびに新しいプロセスで実行し、最小値・中央値・最大値(ミリ秒)をJSONで出力する
+class Command(BaseCommand):
+    help = 'Benchmark cold start time of settings import, manage.py check and worker boot.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--targets', default=','.join(TARGETS), help='Startup steps to measure.')
+        parser.add_argument('--repeat', type=int, default=5, help='Processes started per target.')
+
+    def handle(self, *args, **options):
+        env = dict(
+            os.environ,
+            DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'api_gourmet.settings'),
+        )
+        results = {}
+        for target in [target for target in options['targets'].split(',') if target]:
+            if target not in TARGETS:
+                raise CommandError('Unknown target: {}'.format(target))
+            samples = [self.run(target, env) for _ in range(options['repeat'])]
+            results[target] = {
+                'min': round(min(samples) * 1000, 1),
+                'median': round(statistics.median(samples) * 1000, 1),
+                'max': round(max(samples) * 1000, 1),
+            }
+        results['storage'] = settings.DEFAULT_FILE_STORAGE
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def run(self, target, env):
+        started = time.perf_counter()
+        completed = subprocess.run(
+            TARGETS[target], cwd=str(settings.BASE_DIR), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+        elapsed = time.perf_counter() - started
+        if completed.returncode != 0:
+            raise CommandError('{} failed:\n{}'.format(target, completed.stderr.decode('utf-8', 'replace')))
+        return elapsed
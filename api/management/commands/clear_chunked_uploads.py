@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from api import uploads
+
+
+# 途中で放棄された3Dモデルの分割アップロードと、その一時ファイルを削除するコマンド
+class Command(BaseCommand):
+    help = 'Delete expired chunked uploads and their staging files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=None, help='Age in hours (default: CHUNKED_UPLOAD_EXPIRE_HOURS).')
+
+    def handle(self, *args, **options):
+        count = uploads.clear_expired(options['hours'])
+        self.stdout.write(self.style.SUCCESS('Deleted {} expired uploads.'.format(count)))
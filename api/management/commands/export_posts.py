@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from api import bulk
+
+
+# 全投稿をimport_postsと同じ形式(NDJSON/CSV)で書き出すコマンド
+# 投稿はchunk_size件ずつ読み込みながら書き出すので、件数によらずメモリの使用量は一定
+class Command(BaseCommand):
+    help = 'Export all posts as NDJSON or CSV in the import_posts format.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', dest='data_format', choices=bulk.FORMATS, default=bulk.FORMAT_NDJSON)
+        parser.add_argument('--output', '-o', help='Output file (default: stdout).')
+        parser.add_argument('--chunk-size', type=int, help='Posts fetched per database round trip.')
+
+    def handle(self, *args, **options):
+        rows = bulk.iter_export_rows(chunk_size=options['chunk_size'], author_emails=True)
+        lines = bulk.render_rows(rows, options['data_format'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,42 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from api import media
+
+
+# どの投稿・プロフィールからも参照されていないファイル(縮小版を含む)をストレージから削除するコマンド(api.media)
+# 保存先のディレクトリ(avatars/ posts/ models/)の一覧をページごとに読み、--min-age時間より前に更新されたファイルだけを消す
+# 差し替え・削除された投稿・プロフィールのファイル(内容のハッシュから決めた名前)はこのコマンドだけが消すので、cronなどで定期的に実行する
+#   manage.py gc_media --dry-run      (削除せずに件数とサイズを表示する。-v 2でファイル名も表示)
+class Command(BaseCommand):
+    help = 'Delete media files that no post or profile references.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the orphaned files.')
+        parser.add_argument('--min-age', type=float, default=24,
+                            help='Keep files modified within this many hours (uploads not yet attached).')
+        parser.add_argument('--page-size', type=int, default=1000, help='Files listed per page.')
+        parser.add_argument('--batch-size', type=int, default=100, help='Files deleted per batch.')
+        parser.add_argument('--workers', type=int, default=8, help='Batches deleted in parallel.')
+        parser.add_argument('--directories', default=','.join(media.MEDIA_DIRECTORIES),
+                            help='Storage directories to scan.')
+
+    def handle(self, *args, **options):
+        report = None
+        if options['verbosity'] >= 2:
+            report = lambda names: self.stdout.write('\n'.join(names))  # noqa: E731
+        result = media.collect_garbage(
+            dry_run=options['dry_run'],
+            min_age=timedelta(hours=options['min_age']),
+            page_size=options['page_size'],
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            directories=[directory for directory in options['directories'].split(',') if directory],
+            report=report,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            '{}{} files listed, {} referenced names, {} orphans ({:.1f} MB), {} deleted.'.format(
+                '[dry run] ' if options['dry_run'] else '', result['listed'], result['referenced'],
+                result['orphans'], result['orphan_bytes'] / 1024 / 1024, result['deleted'],
+            )
+        ))
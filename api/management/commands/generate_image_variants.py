@@ -0,0 +1,25 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from api import images
+
+
+# 縮小版がまだない画像(パイプライン導入前の画像や、ワーカーの再起動で処理されなかった画像)の縮小版を作るコマンド
+class Command(BaseCommand):
+    help = 'Generate resized WebP/JPEG variants for images that do not have them yet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Regenerate variants for every image.')
+
+    def handle(self, *args, **options):
+        for (label, field_name), variants_field in images.IMAGE_FIELDS.items():
+            queryset = apps.get_model(label).objects.exclude(**{field_name: ''}).exclude(**{field_name + '__isnull': True})
+            if not options['all']:
+                queryset = queryset.filter(**{variants_field: ''})
+            count = 0
+            for pk in queryset.values_list('pk', flat=True).iterator():
+                try:
+                    images.generate_variants(label, pk, field_name)
+                    count += 1
+                except Exception as exc:
+                    self.stderr.write('{}(pk={}).{}: {}'.format(label, pk, field_name, exc))
+            self.stdout.write('{}.{}: {} images processed.'.format(label, field_name, count))
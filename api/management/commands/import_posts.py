@@ -0,0 +1,49 @@
+import json
+import os
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from api import bulk
+
+
+# NDJSON/CSVのファイル(「-」で標準入力)から投稿を一括で作成するコマンド
+# 行にauthor(メールアドレス)がない場合は--authorのユーザーの投稿になる
+class Command(BaseCommand):
+    help = 'Import posts from an NDJSON or CSV file in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='NDJSON/CSV file to import ("-" reads from stdin).')
+        parser.add_argument('--format', dest='data_format', choices=bulk.FORMATS,
+                            help='Input format (default: guessed from the file extension, otherwise ndjson).')
+        parser.add_argument('--author', help='Email of the user for rows without an author.')
+        parser.add_argument('--batch-size', type=int, help='Rows per bulk insert.')
+        parser.add_argument('--create-missing', action='store_true',
+                            help='Create restaurants and categories that do not exist yet.')
+
+    def handle(self, *args, **options):
+        data_format = options['data_format']
+        if data_format is None:
+            data_format = bulk.FORMAT_CSV if options['path'].lower().endswith('.csv') else bulk.FORMAT_NDJSON
+
+        author_id = None
+        if options['author']:
+            author_id = get_user_model().objects.filter(email__iexact=options['author']).values_list('id', flat=True).first()
+            if author_id is None:
+                raise CommandError('Unknown user "{}".'.format(options['author']))
+        importer = bulk.PostImporter(
+            author_id=author_id, allow_author=True,
+            batch_size=options['batch_size'], create_missing=options['create_missing'],
+        )
+
+        if options['path'] == '-':
+            result = importer.run(bulk.iter_rows(sys.stdin.buffer, data_format))
+        else:
+            if not os.path.exists(options['path']):
+                raise CommandError('File not found: {}'.format(options['path']))
+            with open(options['path'], 'rb') as stream:
+                result = importer.run(bulk.iter_rows(stream, data_format))
+
+        for error in result['errors']:
+            self.stderr.write('line {}: {}'.format(error['line'], json.dumps(error['errors'], ensure_ascii=False)))
+        self.stdout.write('{} posts created, {} rows failed.'.format(result['created'], result['failed']))
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from api import restaurants
+from api.models import Restaurant
+
+
+# 重複している店舗(店舗名・場所を正規化して一致するもの)を統合するコマンド
+# 投稿を残す店舗に付け替えてから重複している店舗を削除する。グループごとに別のトランザクションで処理するため、
+# 大きなテーブルでも長いロックを取らず、途中で止めても統合済みのグループはそのまま残る
+# --into ID --ids 2,3  正規化で一致しない重複(表記ゆれ)を指定して統合する
+class Command(BaseCommand):
+    help = 'Merge duplicate restaurants into one and repoint their posts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the duplicate groups.')
+        parser.add_argument('--into', type=int, help='Restaurant to keep when merging explicit --ids.')
+        parser.add_argument('--ids', help='Comma separated restaurant ids to merge into --into.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if options['into'] or options['ids']:
+            groups = [self.explicit_group(options)]
+        else:
+            groups = restaurants.duplicate_groups()
+
+        merged = moved = 0
+        for target_id, duplicate_ids in groups:
+            if options['dry_run']:
+                self.stdout.write('{} <- {}'.format(target_id, ', '.join(str(i) for i in duplicate_ids)))
+                continue
+            moved += restaurants.merge(target_id, duplicate_ids, batch_size=options['batch_size'])
+            merged += len(duplicate_ids)
+
+        if options['dry_run']:
+            self.stdout.write('{} duplicate groups.'.format(len(groups)))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                'Merged {} restaurants into {} ({} posts moved).'.format(merged, len(groups), moved)
+            ))
+
+    def explicit_group(self, options):
+        if not options['into'] or not options['ids']:
+            raise CommandError('--into and --ids must be given together.')
+        try:
+            duplicate_ids = [int(value) for value in options['ids'].split(',') if value.strip()]
+        except ValueError:
+            raise CommandError('--ids must be comma separated integers.')
+        ids = set(duplicate_ids) | {options['into']}
+        found = set(Restaurant.objects.filter(id__in=ids).values_list('id', flat=True))
+        if found != ids:
+            raise CommandError('Unknown restaurant ids: {}.'.format(', '.join(str(i) for i in sorted(ids - found))))
+        return options['into'], [i for i in duplicate_ids if i != options['into']]
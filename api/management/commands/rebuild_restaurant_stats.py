@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from api import stats
+
+
+# 店舗ごとの集計値(RestaurantStats/RestaurantCategoryStats)を投稿からまとめて作り直すコマンド
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized restaurant rating aggregates from posts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = stats.rebuild_all(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Rebuilt stats for {} restaurants.'.format(count)))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from api import search
+from api.models import Post
+
+
+# 投稿の全文検索用の文字列とインデックスを作り直すコマンド
+# (bulk操作やSQLでの直接更新などシグナルを経由しない変更の後に実行する)
+class Command(BaseCommand):
+    help = 'Rebuild Post.search_document and the full-text search index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        count = search.reindex_posts(Post.objects.all(), batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Reindexed {} posts.'.format(count)))
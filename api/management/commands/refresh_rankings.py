@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from api import rankings
+
+
+# ランキング(api.rankings)を更新するコマンド
+# 前回の更新以降に変わった投稿・店舗だけを反映する(前回の更新がない場合と--fullは全件から作り直す)
+# cronなどで定期的に実行するか、--interval 秒数 で常駐させる(同時に複数実行しない)
+class Command(BaseCommand):
+    help = 'Refresh the materialized post and restaurant rankings.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Rebuild every ranking from all posts.')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running and refresh every N seconds (0 runs once).')
+
+    def handle(self, *args, **options):
+        full = options['full']
+        while True:
+            started = time.perf_counter()
+            run = rankings.refresh(full=full)
+            self.stdout.write(self.style.SUCCESS(
+                'Refreshed rankings ({}): {} posts and {} restaurants changed, {} lists written in {:.2f}s.'.format(
+                    'full' if run.full else 'incremental', run.changed_posts, run.changed_restaurants,
+                    run.lists_written, time.perf_counter() - started,
+                )
+            ))
+            if not options['interval']:
+                break
+            full = False
+            # 待っている間にDBから切られた接続を使わないよう閉じておく
+            close_old_connections()
+            time.sleep(options['interval'])
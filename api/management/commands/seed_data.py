@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from api import benchmarks
+
+
+# ベンチマーク・負荷試験用のデータ(ユーザー・プロフィール・店舗・カテゴリー・投稿)をbulk_createで作成するコマンド
+class Command(BaseCommand):
+    help = 'Seed the database with benchmark data (users, profiles, restaurants, categories, posts).'
+
+    def add_arguments(self, parser):
+        for name, default in benchmarks.DEFAULT_VOLUMES.items():
+            parser.add_argument('--{}'.format(name), type=int, default=default, help='Number of {} to create.'.format(name))
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0, help='Random seed (same seed, same data).')
+
+    def handle(self, *args, **options):
+        volumes = benchmarks.seed(
+            batch_size=options['batch_size'], random_seed=options['seed'],
+            **{name: options[name] for name in benchmarks.DEFAULT_VOLUMES},
+        )
+        self.stdout.write('Seeded {}.'.format(', '.join('{} {}'.format(count, name) for name, count in volumes.items())))
@@ -0,0 +1,203 @@
+import json
+import logging
+import posixpath
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.apps import apps
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .images import IMAGE_FIELDS, run_in_background
+from .storage import is_content_addressed, list_files
+
+logger = logging.getLogger(__name__)
+
+# 投稿・プロフィールのファイル(ストレージ上のファイル)の後片付け
+# ファイルの差し替え・行の削除で使われなくなったファイルと、その縮小版(api.images)をストレージから消す
+# 内容のハッシュから決めた名前のファイル(api.models.upload_post_path等)はその場では消さず、掃除(gc_media)に任せる
+#   同じ内容のファイルは複数の行から参照され、別のリクエストが保存済みのファイルを再利用(DeduplicateMixin)して
+#   まだ確定していない行から参照し始めている場合があるため。掃除は更新日時がmin_ageより前のファイルだけを消し、
+#   再利用されたファイルは更新日時が新しくなる
+# それ以外の名前(ハッシュ導入前のファイル)は、トランザクションの確定後に参照している行がなくなっていれば消す
+
+FILE_FIELDS = {
+    'api.Post': ('menu_item_photo', 'menu_item_model'),
+    'api.Profile': ('img',),
+}
+
+
+# 縮小版のJSON(<フィールド名>_variants)に記録されたファイル名
+def _names_in_variants(raw):
+    if not raw:
+        return []
+    return [name for formats in json.loads(raw).values() for name in formats.values()]
+
+
+def _variant_names(instance, field_name, read):
+    variants_field = IMAGE_FIELDS.get((instance._meta.label, field_name))
+    return _names_in_variants(read(variants_field) if variants_field else None)
+
+
+# 保存前(pre_save)に、差し替えられるファイル(読み込み時のファイル名と縮小版)を覚えておく
+def prepare_cleanup(instance):
+    instance._replaced_files = [
+        (field_name, instance.loaded_value(field_name), _variant_names(instance, field_name, instance.loaded_value))
+        for field_name in FILE_FIELDS.get(instance._meta.label, ())
+        if instance.loaded_value(field_name) and instance.has_changed(field_name)
+    ]
+
+
+# 保存後(post_save)に、差し替えられたファイルの削除を予約する
+def schedule_replaced(instance):
+    files = getattr(instance, '_replaced_files', [])
+    instance._replaced_files = []
+    _schedule(instance._meta.label, files)
+
+
+# 削除後(post_delete)に、削除した行のファイルの削除を予約する
+def schedule_deleted(instance):
+    read = lambda attname: getattr(instance, attname)  # noqa: E731
+    _schedule(instance._meta.label, [
+        (field_name, getattr(instance, field_name).name, _variant_names(instance, field_name, read))
+        for field_name in FILE_FIELDS.get(instance._meta.label, ())
+        if getattr(instance, field_name)
+    ])
+
+
+def _schedule(label, files):
+    for field_name, name, variants in files:
+        if is_content_addressed(name):
+            continue
+        transaction.on_commit(
+            lambda field_name=field_name, name=name, variants=variants: run_in_background(
+                delete_unreferenced, label, field_name, name, variants
+            )
+        )
+
+
+# どの行からも参照されていなければ、ファイルとその縮小版を消す(縮小版の名前は元のファイルから決まるので、
+# 元のファイルが参照されていれば縮小版も使われている)
+def delete_unreferenced(label, field_name, name, variants=()):
+    model = apps.get_model(label)
+    if model.objects.filter(**{field_name: name}).exists():
+        return False
+    storage = model._meta.get_field(field_name).storage
+    for file_name in [name, *variants]:
+        storage.delete(file_name)
+    logger.info('Deleted unreferenced file %s and %d variants.', name, len(variants))
+    return True
+
+
+# ストレージ全体の掃除(manage.py gc_media)
+# 内容のハッシュから決めた名前の使われなくなったファイル、上記の後片付けが失敗したファイルや、
+# 確認されなかった直接アップロード(api.signed_uploads)のファイルを消す(cronなどで定期的に実行する)
+# 1. 参照されているファイル名(縮小版を含む)を集合に読み込む(1件あたり数十バイトなので、数十万件でも数十MB)
+# 2. 保存先のディレクトリの一覧をページごとに読み、集合にない・min_ageより前に更新されたファイルを削除の候補にする
+#    (アップロード直後でまだ行に紐付いていないファイルを消さないため)
+# 3. 候補をbatch_size件ごとに、一覧の読み込み中に参照されたもの(同じ内容の再アップロードなど)を除いて並列に削除する
+#    (削除の直前に更新日時も確かめ直す)
+
+# 掃除するディレクトリ(upload_post_path等の保存先)
+MEDIA_DIRECTORIES = ('avatars', 'posts', 'models')
+
+# 縮小版の名前(<元のファイルの拡張子を除いた名前>.w<幅>.<形式>)
+VARIANT_NAME_RE = re.compile(r'^(.+)\.w\d+\.[a-z]+$')
+
+
+def referenced_names():
+    names = set()
+    for label, field_names in FILE_FIELDS.items():
+        variants_fields = [IMAGE_FIELDS[(label, name)] for name in field_names if (label, name) in IMAGE_FIELDS]
+        rows = apps.get_model(label).objects.order_by().values_list(*field_names, *variants_fields)
+        for row in rows.iterator(chunk_size=2000):
+            names.update(name for name in row[:len(field_names)] if name)
+            for raw in row[len(field_names):]:
+                names.update(_names_in_variants(raw))
+    return names
+
+
+# 縮小版なら元のファイルの拡張子を除いた名前、それ以外はNone
+def _variant_stem(name):
+    match = VARIANT_NAME_RE.match(name)
+    return match.group(1) if match else None
+
+
+# namesのうち、今参照されているファイルと、参照されているファイルの縮小版
+def _still_referenced(names):
+    stems = {_variant_stem(name) for name in names} - {None}
+    found = set()
+    for label, field_names in FILE_FIELDS.items():
+        model = apps.get_model(label)
+        for field_name in field_names:
+            condition = Q(**{field_name + '__in': names})
+            for stem in stems:
+                condition |= Q(**{field_name + '__startswith': stem + '.'})
+            found.update(model.objects.filter(condition).values_list(field_name, flat=True))
+    found_stems = {posixpath.splitext(name)[0] for name in found}
+    return {name for name in names if name in found or _variant_stem(name) in found_stems}
+
+
+# 削除の直前にも更新日時を確かめる(一覧を読んだ後に再利用されたファイルは消さない)
+def _delete(storage, names, cutoff):
+    deleted = 0
+    for name in names:
+        try:
+            if storage.get_modified_time(name) > cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        storage.delete(name)
+        deleted += 1
+    return deleted
+
+
+# 参照されていないファイルを削除して件数を返す(dry_run=Trueの場合は数えるだけ)
+# reportを指定した場合は、削除する(dry_runでは削除の対象の)ファイル名のリストをバッチごとに渡す
+def collect_garbage(storage=None, dry_run=False, min_age=timedelta(hours=24), page_size=1000, batch_size=100,
+                    workers=8, directories=MEDIA_DIRECTORIES, report=None):
+    storage = storage or default_storage
+    result = {'listed': 0, 'referenced': 0, 'orphans': 0, 'orphan_bytes': 0, 'deleted': 0}
+    referenced = referenced_names()
+    result['referenced'] = len(referenced)
+    cutoff = timezone.now() - min_age
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='gc-media') as executor:
+        pending = set()
+
+        def flush(batch):
+            batch = dict(batch)
+            for name in _still_referenced(list(batch)):
+                del batch[name]
+            result['orphans'] += len(batch)
+            result['orphan_bytes'] += sum(size or 0 for size in batch.values())
+            if report is not None and batch:
+                report(sorted(batch))
+            if dry_run or not batch:
+                return
+            # 削除待ちのバッチはworkers × 2個までにする(一覧を先に読み進めすぎないように)
+            while len(pending) >= max(workers, 1) * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.discard(future)
+                    result['deleted'] += future.result()
+            pending.add(executor.submit(_delete, storage, sorted(batch), cutoff))
+
+        batch = []
+        for directory in directories:
+            for page in list_files(storage, directory + '/', page_size):
+                result['listed'] += len(page)
+                for name, size, modified in page:
+                    if name in referenced or modified > cutoff:
+                        continue
+                    batch.append((name, size))
+                    if len(batch) >= batch_size:
+                        flush(batch)
+                        batch = []
+        if batch:
+            flush(batch)
+        for future in pending:
+            result['deleted'] += future.result()
+    return result
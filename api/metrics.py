@@ -0,0 +1,239 @@
+import hmac
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from . import connections as db_connections
+
+logger = logging.getLogger(__name__)
+
+# リクエストごとのDBクエリ数・DBの時間・シリアライズの時間・全体の時間の計測
+# - MetricsMiddleware: 全リクエストのクエリ(execute_wrapper)と全体の時間を計測し、Server-Timingヘッダーを付ける
+# - MetricsMixin     : DRFのビューに付け、シリアライズの時間とビューごとのクエリ数の上限(query_budget)を記録する
+# - /metrics         : ビューごとの集計をPrometheusのテキスト形式で返す
+# 集計はプロセスごと(gunicornのワーカーごと)に持つ
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# 1リクエストで記録するSQLの最大件数(クエリ数の上限を超えた時の表示用)
+MAX_STATEMENTS = 200
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.view = ''
+        self.query_budget = None
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.total_time = 0.0
+        self.statements = []
+
+    # connection.execute_wrapperに渡すラッパー
+    def execute(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries += 1
+            if len(self.statements) < MAX_STATEMENTS:
+                self.statements.append(sql)
+
+    @property
+    def over_budget(self):
+        return self.query_budget is not None and self.queries > self.query_budget
+
+    def server_timing(self):
+        return 'db;dur={:.1f};desc="{} queries", serialize;dur={:.1f}, total;dur={:.1f}'.format(
+            self.db_time * 1000, self.queries, self.serialize_time * 1000, self.total_time * 1000
+        )
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = defaultdict(int)
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.queries = defaultdict(lambda: Histogram(QUERY_BUCKETS))
+        self.db_seconds = defaultdict(float)
+        self.serialize_seconds = defaultdict(float)
+        self.over_budget = defaultdict(int)
+
+    def observe(self, metrics, method, status):
+        key = (metrics.view, method)
+        with self._lock:
+            self.requests[key + (str(status),)] += 1
+            self.latency[key].observe(metrics.total_time)
+            self.queries[key].observe(metrics.queries)
+            self.db_seconds[key] += metrics.db_time
+            self.serialize_seconds[key] += metrics.serialize_time
+            if metrics.over_budget:
+                self.over_budget[key] += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            _counter(lines, 'api_requests_total', 'Requests by view, method and status.',
+                     ('view', 'method', 'status'), self.requests)
+            _histogram(lines, 'api_request_duration_seconds', 'Total request latency.', self.latency)
+            _histogram(lines, 'api_db_queries_per_request', 'Database queries per request.', self.queries)
+            _counter(lines, 'api_db_duration_seconds_total', 'Time spent in database queries.',
+                     ('view', 'method'), self.db_seconds)
+            _counter(lines, 'api_serialize_duration_seconds_total', 'Time spent serializing (excluding queries).',
+                     ('view', 'method'), self.serialize_seconds)
+            _counter(lines, 'api_query_budget_exceeded_total', 'Requests that ran more queries than the view budget.',
+                     ('view', 'method'), self.over_budget)
+        # DB接続数・接続プールの状態(api.connections)
+        db_connections.render_metrics(lines, _counter, _gauge)
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs)
+
+
+def _counter(lines, name, help_text, label_names, values):
+    lines.append('# HELP {} {}'.format(name, help_text))
+    lines.append('# TYPE {} counter'.format(name))
+    for key, value in sorted(values.items()):
+        lines.append('{}{{{}}} {}'.format(name, _labels(label_names, key), _number(value)))
+
+
+def _gauge(lines, name, help_text, label_names, values):
+    lines.append('# HELP {} {}'.format(name, help_text))
+    lines.append('# TYPE {} gauge'.format(name))
+    for key, value in sorted(values.items()):
+        lines.append('{}{{{}}} {}'.format(name, _labels(label_names, key), _number(value)))
+
+
+def _histogram(lines, name, help_text, histograms):
+    lines.append('# HELP {} {}'.format(name, help_text))
+    lines.append('# TYPE {} histogram'.format(name))
+    for key, histogram in sorted(histograms.items()):
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append('{}_bucket{{{}}} {}'.format(name, _labels(('view', 'method'), key, le=_number(bound)), count))
+        lines.append('{}_bucket{{{}}} {}'.format(name, _labels(('view', 'method'), key, le='+Inf'), histogram.count))
+        lines.append('{}_sum{{{}}} {}'.format(name, _labels(('view', 'method'), key), _number(histogram.sum)))
+        lines.append('{}_count{{{}}} {}'.format(name, _labels(('view', 'method'), key), histogram.count))
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = request.metrics = RequestMetrics()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(metrics.execute))
+            response = self.get_response(request)
+        metrics.total_time = time.perf_counter() - started
+
+        # ビューはURLの名前で区別する(キャッシュからレスポンスを返した場合もビューの処理と同じ名前で集計する)
+        match = getattr(request, 'resolver_match', None)
+        metrics.view = match.view_name if match else 'unmatched'
+        if metrics.view != 'metrics':
+            registry.observe(metrics, request.method, response.status_code)
+        if metrics.over_budget:
+            logger.warning('%s %s ran %d queries (budget %d).', request.method, metrics.view, metrics.queries, metrics.query_budget)
+
+        response['Server-Timing'] = metrics.server_timing()
+        # テスト(api.testing)でクエリ数を確認できるようにレスポンスにも付けておく
+        response.metrics = metrics
+        return response
+
+
+# DRFのビューに付けるMixin
+# query_budget: 1リクエストあたりのクエリ数の上限(超えた場合は警告のログとapi_query_budget_exceeded_totalに記録)
+#               ViewSetではアクションごとに {'list': 3, 'retrieve': 2} のように指定できる
+class MetricsMixin:
+    query_budget = None
+
+    def initial(self, request, *args, **kwargs):
+        metrics = getattr(request, 'metrics', None)
+        if metrics is not None:
+            metrics.query_budget = self.get_query_budget()
+        super().initial(request, *args, **kwargs)
+
+    def get_query_budget(self):
+        if isinstance(self.query_budget, dict):
+            return self.query_budget.get(getattr(self, 'action', None))
+        return self.query_budget
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('context', self.get_serializer_context())
+        return timed_serializer(self.get_serializer_class())(*args, **kwargs)
+
+
+_timed_serializers = {}
+
+
+# to_representationの時間(その間のクエリの時間は除く)をシリアライズの時間として記録するシリアライザーのサブクラス
+def timed_serializer(serializer_class):
+    timed = _timed_serializers.get(serializer_class)
+    if timed is None:
+        def to_representation(self, instance):
+            metrics = getattr(self.context.get('request'), 'metrics', None)
+            if metrics is None:
+                return super(timed, self).to_representation(instance)
+            started = time.perf_counter()
+            db_time = metrics.db_time
+            try:
+                return super(timed, self).to_representation(instance)
+            finally:
+                metrics.serialize_time += (time.perf_counter() - started) - (metrics.db_time - db_time)
+
+        timed = type(serializer_class.__name__, (serializer_class,), {
+            '__module__': serializer_class.__module__,
+            '__qualname__': serializer_class.__qualname__,
+            'to_representation': to_representation,
+        })
+        _timed_serializers[serializer_class] = timed
+    return timed
+
+
+# /metrics：Prometheusのテキスト形式の集計
+# Authorization: Bearer <METRICS_TOKEN> か、スタッフのユーザーのログイン(セッション)が必要
+# (METRICS_TOKENを設定していない場合はトークンでは見られない)
+def metrics_view(request):
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    authorized = bool(token) and hmac.compare_digest(
+        request.META.get('HTTP_AUTHORIZATION', '').encode(), 'Bearer {}'.format(token).encode()
+    )
+    user = getattr(request, 'user', None)
+    if not authorized and not (user is not None and user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
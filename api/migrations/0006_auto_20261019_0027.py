@@ -0,0 +1,17 @@
+# Generated by Django 3.0.7 on 2026-10-18 15:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_auto_20230601_1424'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['created_on', 'id'], name='api_post_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.0.7 on 2026-10-18 15:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_auto_20261019_0027'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['score', 'id'], name='api_post_score_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['price', 'id'], name='api_post_price_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['restaurant', 'created_on'], name='api_post_rest_created_idx'),
+        ),
+        # 自動生成の中間テーブル(api_post_category)はモデルのMetaでインデックスを指定できないためSQLで作成する
+        # カテゴリーIDから投稿IDを引く絞り込みをインデックスのみで解決できるようにする
+        migrations.RunSQL(
+            'CREATE INDEX api_post_category_cat_post_idx ON api_post_category (category_id, post_id);',
+            reverse_sql='DROP INDEX api_post_category_cat_post_idx;',
+        ),
+    ]
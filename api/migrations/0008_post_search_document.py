@@ -0,0 +1,72 @@
+# Generated by Django 3.0.7 on 2026-10-18 15:31
+
+import unicodedata
+
+from django.db import migrations, models
+
+
+# マイグレーションの時点のapi.search.build_search_document(後から変更されても既存のマイグレーションの結果が変わらないようにコピーしておく)
+def build_search_document(menu_item, review_text, restaurant_name, restaurant_location):
+    text = '\n'.join(part or '' for part in (menu_item, review_text, restaurant_name, restaurant_location))
+    return unicodedata.normalize('NFKC', text).casefold()
+
+
+def fill_search_document(apps, schema_editor):
+    Post = apps.get_model('api', 'Post')
+    batch = []
+    for post in Post.objects.select_related('restaurant').iterator(chunk_size=500):
+        post.search_document = build_search_document(
+            post.menu_item, post.review_text, post.restaurant.name, post.restaurant.location
+        )
+        batch.append(post)
+        if len(batch) >= 500:
+            Post.objects.bulk_update(batch, ['search_document'])
+            batch = []
+    if batch:
+        Post.objects.bulk_update(batch, ['search_document'])
+
+
+# Postgres: pg_trgmのGINインデックス / SQLite: FTS5(trigram)の仮想テーブル
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        schema_editor.execute(
+            'CREATE INDEX api_post_search_trgm_idx ON api_post USING gin (search_document gin_trgm_ops)'
+        )
+    elif vendor == 'sqlite':
+        try:
+            schema_editor.execute(
+                "CREATE VIRTUAL TABLE api_post_fts USING fts5(search_document, tokenize='trigram')"
+            )
+        except Exception:
+            # FTS5(trigram)に対応していないSQLiteではLIKE検索にフォールバックする
+            return
+        schema_editor.execute(
+            'INSERT INTO api_post_fts(rowid, search_document) SELECT id, search_document FROM api_post'
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS api_post_search_trgm_idx')
+    elif vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS api_post_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_auto_20261019_0028'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='search_document',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(fill_search_document, migrations.RunPython.noop),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
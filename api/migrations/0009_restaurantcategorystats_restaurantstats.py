@@ -0,0 +1,50 @@
+# Generated by Django 3.0.7 on 2026-10-18 15:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from api import stats
+
+
+def fill_restaurant_stats(apps, schema_editor):
+    stats.rebuild_all(apps=apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_post_search_document'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RestaurantStats',
+            fields=[
+                ('restaurant', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='api.Restaurant')),
+                ('post_count', models.PositiveIntegerField(default=0)),
+                ('score_sum', models.PositiveIntegerField(default=0)),
+                ('price_sum', models.BigIntegerField(default=0)),
+                ('price_min', models.IntegerField(blank=True, null=True)),
+                ('price_max', models.IntegerField(blank=True, null=True)),
+                ('score_1_count', models.PositiveIntegerField(default=0)),
+                ('score_2_count', models.PositiveIntegerField(default=0)),
+                ('score_3_count', models.PositiveIntegerField(default=0)),
+                ('score_4_count', models.PositiveIntegerField(default=0)),
+                ('score_5_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RestaurantCategoryStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('post_count', models.PositiveIntegerField(default=0)),
+                ('score_sum', models.PositiveIntegerField(default=0)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='restaurant_stats', to='api.Category')),
+                ('restaurant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='category_stats', to='api.Restaurant')),
+            ],
+            options={
+                'unique_together': {('restaurant', 'category')},
+            },
+        ),
+        migrations.RunPython(fill_restaurant_stats, migrations.RunPython.noop),
+    ]
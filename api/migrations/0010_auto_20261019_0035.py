@@ -0,0 +1,23 @@
+# Generated by Django 3.0.7 on 2026-10-18 15:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_restaurantcategorystats_restaurantstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='menu_item_photo_variants',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='img_variants',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.0.7 on 2026-10-18 15:55
+
+import hashlib
+import unicodedata
+
+from django.db import migrations, models
+
+
+# マイグレーションの時点のapi.restaurants.restaurant_key(後から変更されても既存のマイグレーションの結果が変わらないようにコピーしておく)
+def normalize(text):
+    return ''.join(
+        char for char in unicodedata.normalize('NFKC', text or '').casefold()
+        if not unicodedata.category(char).startswith(('P', 'Z', 'C', 'S'))
+    )
+
+
+def restaurant_key(name, location):
+    source = '{}\x1f{}'.format(normalize(name), normalize(location))
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+# 既存の店舗にキーを付ける(同じキーの店舗が複数ある場合はIDが最小の店舗だけに付け、残りはNULLのまま)
+def fill_dedup_key(apps, schema_editor):
+    Restaurant = apps.get_model('api', 'Restaurant')
+    seen = set()
+    batch = []
+    for restaurant in Restaurant.objects.order_by('id').only('id', 'name', 'location').iterator(chunk_size=500):
+        key = restaurant_key(restaurant.name, restaurant.location)
+        if key in seen:
+            continue
+        seen.add(key)
+        restaurant.dedup_key = key
+        batch.append(restaurant)
+        if len(batch) >= 500:
+            Restaurant.objects.bulk_update(batch, ['dedup_key'])
+            batch = []
+    if batch:
+        Restaurant.objects.bulk_update(batch, ['dedup_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_auto_20261019_0052'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='restaurant',
+            name='dedup_key',
+            field=models.CharField(blank=True, editable=False, max_length=40, null=True, unique=True),
+        ),
+        migrations.RunPython(fill_dedup_key, migrations.RunPython.noop),
+    ]
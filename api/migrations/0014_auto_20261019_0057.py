@@ -0,0 +1,53 @@
+# Generated by Django 3.0.7 on 2026-10-18 15:57
+
+import unicodedata
+
+from django.db import migrations, models
+
+
+# マイグレーションの時点のapi.autocomplete.normalize(後から変更されても既存のマイグレーションの結果が変わらないようにコピーしておく)
+def normalize(text, max_length=200):
+    return ' '.join(unicodedata.normalize('NFKC', text or '').casefold().split())[:max_length]
+
+
+def fill_normalized_names(apps, schema_editor):
+    for model_name, source, target in (('Category', 'name', 'name_normalized'),
+                                       ('Restaurant', 'name', 'name_normalized'),
+                                       ('Post', 'menu_item', 'menu_item_normalized')):
+        model = apps.get_model('api', model_name)
+        max_length = model._meta.get_field(target).max_length
+        batch = []
+        for instance in model.objects.only('id', source).iterator(chunk_size=500):
+            setattr(instance, target, normalize(getattr(instance, source), max_length))
+            batch.append(instance)
+            if len(batch) >= 500:
+                model.objects.bulk_update(batch, [target])
+                batch = []
+        if batch:
+            model.objects.bulk_update(batch, [target])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_restaurant_dedup_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='name_normalized',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='menu_item_normalized',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='restaurant',
+            name='name_normalized',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=200),
+        ),
+        migrations.RunPython(fill_normalized_names, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.7 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_auto_20261019_0057'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['author', 'created_on', 'id'], name='api_post_author_created_idx'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 3.0.7 on 2026-10-18 16:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_auto_20261019_0100'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RankingRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_on', models.DateTimeField()),
+                ('finished_on', models.DateTimeField()),
+                ('full', models.BooleanField(default=False)),
+                ('changed_posts', models.PositiveIntegerField(default=0)),
+                ('changed_restaurants', models.PositiveIntegerField(default=0)),
+                ('lists_written', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='updated_on',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='restaurantcategorystats',
+            name='updated_on',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='restaurantstats',
+            name='updated_on',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.CreateModel(
+            name='RankingEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('trending', 'trending posts'), ('top_rated', 'top rated restaurants'), ('top_restaurants', 'top restaurants')], max_length=20)),
+                ('rank', models.PositiveIntegerField()),
+                ('score', models.FloatField()),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ranking_entries', to='api.Category')),
+                ('post', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.Post')),
+                ('restaurant', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.Restaurant')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='rankingentry',
+            index=models.Index(fields=['kind', 'category', 'rank'], name='api_ranking_list_idx'),
+        ),
+    ]
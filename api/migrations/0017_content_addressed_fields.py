@@ -0,0 +1,29 @@
+# Generated by Django 3.0.7 on 2026-10-18 16:39
+
+import api.models
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_rankings'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='post',
+            name='menu_item_model',
+            field=api.models.ContentAddressedFileField(blank=True, null=True, upload_to=api.models.upload_model_path),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='menu_item_photo',
+            field=api.models.ContentAddressedImageField(blank=True, null=True, upload_to=api.models.upload_post_path),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='img',
+            field=api.models.ContentAddressedImageField(blank=True, null=True, upload_to=api.models.upload_avatar_path),
+        ),
+    ]
@@ -1,23 +1,128 @@
 # モジュールのimport
+import hashlib
+import os
+import uuid
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.db.models.fields.files import FieldFile, ImageFieldFile
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.conf import settings
 # Create your models here.
 
-def upload_avatar_path(instance, filename):
-    ext = filename.split('.')[-1]
+# アップロードされたファイルの内容のSHA-256
+# ファイル名を内容から決めるので、同じ名前のファイルは内容も同じ(CDN・ブラウザに長期間キャッシュさせ、同じ内容のファイルは1つだけ保存する)
+# 内容がまだない場合(署名付きURLでの直接アップロード(api.signed_uploads)の発行時)は重複しないランダムな値
+def content_hash(instance, field_name):
+    field_file = getattr(instance, field_name)
+    # FieldFile.save(name, content)で差し替える場合は、保存中の内容(ContentAddressedFieldFile)
+    content = getattr(field_file, 'incoming_content', None)
+    if content is None and field_file and not field_file._committed:
+        content = getattr(field_file, '_file', None)
+    if content is None:
+        return uuid.uuid4().hex
+    # 計算済みのハッシュ(分割アップロードのapi.uploadsが検証した値)があればそれを使う
+    if getattr(content, 'sha256', None):
+        return content.sha256
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def _content_addressed_path(directory, instance, field_name, filename):
+    ext = os.path.splitext(filename)[1].lower()
+    return '/'.join([directory, content_hash(instance, field_name) + ext])
+
+
+# FieldFile.save(name, content)は、ファイル名を決める(upload_to)時点ではまだ前のファイルを持っているので、
+# 保存中の内容をincoming_contentとしてcontent_hashに渡す
+class ContentAddressedFieldFileMixin:
+    incoming_content = None
+
+    def save(self, name, content, save=True):
+        self.incoming_content = content
+        try:
+            super().save(name, content, save=save)
+        finally:
+            self.incoming_content = None
+
+
+class ContentAddressedFieldFile(ContentAddressedFieldFileMixin, FieldFile):
+    pass
+
+
+class ContentAddressedImageFieldFile(ContentAddressedFieldFileMixin, ImageFieldFile):
+    pass
+
 
-    # 保存先のファイルパスを生成
-    # 生成されたファイルパスは 'avatars/{ユーザープロファイルのID}{ニックネーム}.{拡張子}'という形式になる
-    return '/'.join(['avatars', str(instance.userProfile.id) + str(instance.nickName) + str(".") + str(ext)])
+# 内容のハッシュを名前にする(upload_post_path等)ファイルのフィールド
+class ContentAddressedFileField(models.FileField):
+    attr_class = ContentAddressedFieldFile
+
+
+class ContentAddressedImageField(models.ImageField):
+    attr_class = ContentAddressedImageFieldFile
+
+
+# 保存先のファイルパスを生成
+# 生成されたファイルパスは '{ディレクトリ}/{ファイルの内容のSHA-256}.{拡張子}'という形式になる
+def upload_avatar_path(instance, filename):
+    return _content_addressed_path('avatars', instance, 'img', filename)
 
 def upload_post_path(instance, filename):
-    ext = filename.split('.')[-1]
-    return '/'.join(['posts', str(instance.author.id) + str(instance.menu_item) + str(".") + str(ext)])
+    return _content_addressed_path('posts', instance, 'menu_item_photo', filename)
 
 def upload_model_path(instance, filename):
-    ext = filename.split('.')[-1]
-    return '/'.join(['models', str(instance.author.id) + str(instance.menu_item) + str(".") + str(ext)])
+    return _content_addressed_path('models', instance, 'menu_item_model', filename)
+
+# DBから読み込んだ時点の値を保持し、保存時にどのフィールドが変更されたかを判定できるようにするMixin
+# (シグナルで変更前の値を使うため。変更前の値を取得するための追加のクエリは発行しない)
+class TrackChangesMixin:
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    # 保存した値を読み込み時の値にする(update_fieldsの場合はそのフィールドだけ)
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._remember_values(kwargs.get('update_fields'))
+
+    # 読み込んでいなかったフィールドを後から読み込んだ場合(refresh_from_db)も、その値を読み込み時の値にする
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self._remember_values(fields)
+
+    # ファイルはFieldFileではなくファイル名(DBの値)を持つ(FieldFileは次の保存までに中身が差し替えられるため)
+    # 読み込んでいないフィールド(only/defer)は、読み込みのクエリが起きるので記録しない
+    def _remember_values(self, names=None):
+        deferred = self.get_deferred_fields()
+        loaded = dict(getattr(self, '_loaded_values', None) or {})
+        for field in self._meta.concrete_fields:
+            if field.attname in deferred:
+                continue
+            if names is not None and field.name not in names and field.attname not in names:
+                continue
+            value = getattr(self, field.attname)
+            loaded[field.attname] = value.name if isinstance(value, FieldFile) else value
+        self._loaded_values = loaded
+
+    # DBから読み込んだ時点の値(新規作成時や読み込んでいないフィールドはdefault)
+    def loaded_value(self, attname, default=None):
+        return (getattr(self, '_loaded_values', None) or {}).get(attname, default)
+
+    # 指定したフィールドのいずれかが読み込み時から変更されているか(新規作成時は常にTrue)
+    # 読み込んでいないフィールド(only/defer)は保存されないので変更なしとする(値を読み込むクエリも起こさない)
+    def has_changed(self, *attnames):
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None:
+            return True
+        deferred = self.get_deferred_fields()
+        return any(attname not in loaded or loaded[attname] != getattr(self, attname)
+                   for attname in attnames if attname not in deferred)
+
 
 # UserManagerクラス
 class UserManager(BaseUserManager):
@@ -86,7 +191,7 @@ class User(AbstractBaseUser, PermissionsMixin):
 
 
 # Profileクラス
-class Profile(models.Model):
+class Profile(TrackChangesMixin, models.Model):
     nickName = models.CharField(max_length=20)
 
     userProfile = models.OneToOneField(
@@ -102,7 +207,9 @@ class Profile(models.Model):
     # blankパラメータ：Trueにすることでこのフィールドの入力が任意になります。
     # nullパラメータ：Trueにすることで、このフィールドがデータベースにおいてNULL値を取ることを許容します。
     # upload_toパラメータは画像ファイルのアップロード先を指定するためのもの(上記で記載)
-    img = models.ImageField(blank=True, null=True, upload_to=upload_avatar_path)
+    img = ContentAddressedImageField(blank=True, null=True, upload_to=upload_avatar_path)
+    # imgの縮小版(幅ごとのWebP/JPEG)のファイル名のJSON(api.imagesがバックグラウンドで作成する)
+    img_variants = models.TextField(blank=True, default='', editable=False)
 
 
 
@@ -113,14 +220,32 @@ class Profile(models.Model):
 # カテゴリーのモデル作成
 class Category(models.Model):
     name = models.CharField( max_length=50, unique=True)
+    # 前方一致の入力補完用に正規化したカテゴリー名(api.autocompleteで管理)
+    name_normalized = models.CharField(max_length=50, blank=True, default='', db_index=True, editable=False)
 
     def __str__(self):
         return self.name
 
 # 店舗のモデル作成
-class Restaurant(models.Model):
+class Restaurant(TrackChangesMixin, models.Model):
     name = models.CharField(max_length=200)  # 店舗名
     location = models.CharField(max_length=200)  # 店舗の場所
+    # 前方一致の入力補完用に正規化した店舗名(api.autocompleteで管理)
+    name_normalized = models.CharField(max_length=200, blank=True, default='', db_index=True, editable=False)
+    # 緯度・経度(未設定の店舗は近くの店舗の検索の対象にならない)
+    latitude = models.FloatField(blank=True, null=True, validators=[MinValueValidator(-90), MaxValueValidator(90)])
+    longitude = models.FloatField(blank=True, null=True, validators=[MinValueValidator(-180), MaxValueValidator(180)])
+    # 緯度・経度から作るgeohash(近くの店舗の検索用、api.geoで管理)
+    geohash = models.CharField(max_length=12, blank=True, default='', editable=False)
+    # 店舗名・場所を正規化した文字列のハッシュ(同じ店舗の重複を防ぐ、api.restaurantsで管理)
+    # キーを付ける前からあった重複はNULL(manage.py merge_restaurantsで統合する)
+    dedup_key = models.CharField(max_length=40, blank=True, null=True, unique=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # 近くの店舗の検索用(geohashの前方一致を範囲で検索する)
+            models.Index(fields=['geohash'], name='api_restaurant_geohash_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -136,8 +261,10 @@ SCORE_CHOICES = [
     (5, '★★★★★'),
 ]
 
-class Post(models.Model):
+class Post(TrackChangesMixin, models.Model):
     created_on = models.DateTimeField(auto_now_add=True)  # 日付
+    # 最終更新日時(ランキング(api.rankings)の差分更新で前回以降に変わった投稿を探す。カテゴリーの変更でも更新する)
+    updated_on = models.DateTimeField(auto_now=True, db_index=True)
     author = models.ForeignKey(  # 投稿者(1対1の関係で紐づく)
         settings.AUTH_USER_MODEL, related_name="posts",
         on_delete=models.CASCADE
@@ -150,11 +277,169 @@ class Post(models.Model):
         Category, related_name="posts",
     )
     menu_item = models.CharField(max_length=200)  # メニュー名
+    # 前方一致の入力補完用に正規化したメニュー名(api.autocompleteで管理)
+    menu_item_normalized = models.CharField(max_length=200, blank=True, default='', db_index=True, editable=False)
     score = models.PositiveSmallIntegerField(verbose_name='レビュースコア', choices=SCORE_CHOICES, default='3')  #評価
     price = models.IntegerField()  # 値段
-    menu_item_photo = models.ImageField(upload_to=upload_post_path, blank=True, null=True)  # メニュー画像
-    menu_item_model = models.FileField(upload_to=upload_model_path, blank=True, null=True)  # メニュー3Dモデル
+    menu_item_photo = ContentAddressedImageField(upload_to=upload_post_path, blank=True, null=True)  # メニュー画像
+    # メニュー画像の縮小版(幅ごとのWebP/JPEG)のファイル名のJSON(api.imagesがバックグラウンドで作成する)
+    menu_item_photo_variants = models.TextField(blank=True, default='', editable=False)
+    menu_item_model = ContentAddressedFileField(upload_to=upload_model_path, blank=True, null=True)  # メニュー3Dモデル
     review_text = models.TextField(blank=True, null=True)  # レビュー内容
+    # 全文検索用の文字列(メニュー名・レビュー・店舗名・店舗の場所を正規化して連結したもの、api.searchで管理)
+    search_document = models.TextField(blank=True, default='', editable=False)
+
+    class Meta:
+        indexes = [
+            # 投稿一覧のカーソルページネーション用(created_on, idの順で並べる)
+            models.Index(fields=['created_on', 'id'], name='api_post_created_id_idx'),
+            # スコア・値段での絞り込み/並び替え用(idまで含めてページ送りもインデックスで完結させる)
+            models.Index(fields=['score', 'id'], name='api_post_score_id_idx'),
+            models.Index(fields=['price', 'id'], name='api_post_price_id_idx'),
+            # 店舗ごとの投稿一覧用
+            models.Index(fields=['restaurant', 'created_on'], name='api_post_rest_created_idx'),
+            # ユーザーごとの投稿一覧(/api/mypost/, /api/user/<id>/posts/)のkeysetページネーション用
+            models.Index(fields=['author', 'created_on', 'id'], name='api_post_author_created_idx'),
+        ]
+
     def __str__(self):
         return self.menu_item
 
+
+# 店舗ごとの投稿の集計値(平均スコア・投稿数・価格帯・スコアの分布)
+# 店舗一覧で毎回Avg('posts__score')などを計算しないよう、投稿の作成・更新・削除時に差分で更新する(api.stats)
+# 全件の作り直しは manage.py rebuild_restaurant_stats
+class RestaurantStats(models.Model):
+    restaurant = models.OneToOneField(
+        Restaurant, related_name='stats', primary_key=True,
+        on_delete=models.CASCADE
+    )
+    post_count = models.PositiveIntegerField(default=0)  # 投稿数
+    score_sum = models.PositiveIntegerField(default=0)  # スコアの合計
+    price_sum = models.BigIntegerField(default=0)  # 値段の合計
+    price_min = models.IntegerField(blank=True, null=True)  # 最安値
+    price_max = models.IntegerField(blank=True, null=True)  # 最高値
+    # スコアごとの投稿数
+    score_1_count = models.PositiveIntegerField(default=0)
+    score_2_count = models.PositiveIntegerField(default=0)
+    score_3_count = models.PositiveIntegerField(default=0)
+    score_4_count = models.PositiveIntegerField(default=0)
+    score_5_count = models.PositiveIntegerField(default=0)
+    # 最終更新日時(ランキングの差分更新で集計値の変わった店舗を探す、F式のUPDATEでも更新する)
+    updated_on = models.DateTimeField(auto_now=True, db_index=True)
+
+    @property
+    def avg_score(self):
+        return round(self.score_sum / self.post_count, 2) if self.post_count else None
+
+    @property
+    def avg_price(self):
+        return round(self.price_sum / self.post_count) if self.post_count else None
+
+    @property
+    def score_histogram(self):
+        return {str(score): getattr(self, 'score_{}_count'.format(score)) for score, _ in SCORE_CHOICES}
+
+    def __str__(self):
+        return str(self.restaurant_id)
+
+
+# 店舗×カテゴリーごとの投稿の集計値
+class RestaurantCategoryStats(models.Model):
+    restaurant = models.ForeignKey(
+        Restaurant, related_name='category_stats',
+        on_delete=models.CASCADE
+    )
+    category = models.ForeignKey(
+        Category, related_name='restaurant_stats',
+        on_delete=models.CASCADE
+    )
+    post_count = models.PositiveIntegerField(default=0)
+    score_sum = models.PositiveIntegerField(default=0)
+    updated_on = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        unique_together = ('restaurant', 'category')
+
+    @property
+    def avg_score(self):
+        return round(self.score_sum / self.post_count, 2) if self.post_count else None
+
+
+# ランキング(api.rankings)の各リストの上位の行(manage.py refresh_rankingsが作成する)
+# リストは(kind, category)ごとで、categoryがNULLのものは全カテゴリーのリスト。
+# APIは(kind, category, rank)のインデックスで上位から読むだけで、投稿の集計や並び替えはしない
+# 投稿・店舗が削除された行はNULLになり(次の更新でリストから除く)、それまでは読み取り時に飛ばす
+class RankingEntry(models.Model):
+    KIND_TRENDING = 'trending'
+    KIND_TOP_RATED = 'top_rated'
+    KIND_TOP_RESTAURANTS = 'top_restaurants'
+    KIND_CHOICES = [
+        (KIND_TRENDING, 'trending posts'),
+        (KIND_TOP_RATED, 'top rated restaurants'),
+        (KIND_TOP_RESTAURANTS, 'top restaurants'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    category = models.ForeignKey(
+        Category, related_name='ranking_entries', blank=True, null=True,
+        on_delete=models.CASCADE
+    )
+    rank = models.PositiveIntegerField()
+    # trendingは投稿、それ以外は店舗
+    post = models.ForeignKey(Post, related_name='+', blank=True, null=True, on_delete=models.SET_NULL)
+    restaurant = models.ForeignKey(Restaurant, related_name='+', blank=True, null=True, on_delete=models.SET_NULL)
+    # 並び順の値(時間で減衰する値は基準時刻からの対数、api.rankings.display_scoreで現在の値にする)
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'category', 'rank'], name='api_ranking_list_idx'),
+        ]
+
+    def __str__(self):
+        return '{} {} #{}'.format(self.kind, self.category_id or 'all', self.rank)
+
+
+# ランキングの更新の記録(次の差分更新は最後の更新の開始時刻以降に変わった投稿・店舗が対象)
+# 更新と同じトランザクションで保存するので、途中で失敗した更新は記録されない
+class RankingRun(models.Model):
+    started_on = models.DateTimeField()
+    finished_on = models.DateTimeField()
+    full = models.BooleanField(default=False)  # 全件から作り直したかどうか
+    changed_posts = models.PositiveIntegerField(default=0)
+    changed_restaurants = models.PositiveIntegerField(default=0)
+    lists_written = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.started_on)
+
+
+# 3Dモデル(Post.menu_item_model)の分割・再開可能なアップロード
+# チャンクはサーバーの一時ディレクトリのファイルに追記し(api.uploads)、
+# 最後にチェックサムを確認してから投稿のmenu_item_modelとしてストレージに保存する
+class ChunkedUpload(models.Model):
+    STATUS_UPLOADING = 'uploading'
+    STATUS_COMPLETE = 'complete'
+    STATUS_CHOICES = [
+        (STATUS_UPLOADING, 'uploading'),
+        (STATUS_COMPLETE, 'complete'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name='chunked_uploads',
+        on_delete=models.CASCADE
+    )
+    post = models.ForeignKey(
+        Post, related_name='model_uploads',
+        on_delete=models.CASCADE
+    )
+    filename = models.CharField(max_length=200)  # 元のファイル名(拡張子をupload_model_pathで使う)
+    size = models.BigIntegerField()  # ファイル全体のサイズ(バイト)
+    offset = models.BigIntegerField(default=0)  # 受け取り済みのバイト数(次のチャンクの開始位置)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_UPLOADING)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return str(self.id)
@@ -0,0 +1,189 @@
+import datetime
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, Cursor, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+# 複合キーによるkeyset(シーク)ページネーション
+# DRFのCursorPaginationは並び順の先頭フィールドだけを位置として使い、同値の行はOFFSETで読み飛ばすため、
+# score・priceのように同値が多いフィールドで並べると正しくページを送れない。
+# ここでは並び順のすべてのフィールド(最後はidで一意にする)の値をカーソルに持たせ、
+# (a, b, id) < (x, y, z) のような条件で続きを取得する
+class KeysetPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    # 並び順を一意にするために最後に付け足すフィールド
+    tiebreaker = 'id'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+
+        # 前のページへ戻る場合は並び順を反転して取得し、最後に元の順に戻す
+        ordering = _reverse_ordering(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if self.cursor is not None and self.cursor.position is not None:
+            values = self._decode_position(self.cursor.position)
+            queryset = queryset.filter(_keyset_filter(ordering, values))
+
+        # 1件多く取得して次のページがあるかどうかを判定する(COUNTは発行しない)
+        try:
+            results = list(queryset[:self.page_size + 1])
+        except (ValueError, ValidationError):
+            # カーソルに型の合わない値が含まれていた場合
+            raise NotFound(self.invalid_cursor_message)
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = self.cursor is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if not any(field.lstrip('-') in (self.tiebreaker, 'pk') for field in ordering):
+            direction = '-' if ordering[-1].startswith('-') else ''
+            ordering += (direction + self.tiebreaker,)
+        return ordering
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if self.page:
+            position = self._get_position_from_instance(self.page[-1], self.ordering)
+        else:
+            position = self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if self.page:
+            position = self._get_position_from_instance(self.page[0], self.ordering)
+        else:
+            position = self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = []
+        for field in ordering:
+            attr = field.lstrip('-')
+            value = instance[attr] if isinstance(instance, dict) else getattr(instance, attr)
+            if isinstance(value, (datetime.datetime, datetime.date)):
+                value = value.isoformat()
+            values.append(value)
+        return json.dumps(values, separators=(',', ':'))
+
+    def _decode_position(self, position):
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+
+# 投稿一覧用のページネーション(新しい投稿順)
+class PostCursorPagination(KeysetPagination):
+    ordering = ('-created_on', '-id')
+
+
+# 全文検索の結果用のページネーション
+# 関連度順に並ぶためkeysetは使えずlimit/offsetで分割する(件数のCOUNTは行わない)
+class SearchPagination(LimitOffsetPagination):
+    default_limit = 20
+    max_limit = 50
+    # 深いページの要求で検索が重くならないようにoffsetの上限を設ける
+    max_offset = 1000
+
+    # search(limit, offset)はapi.search.SearchResultを返す関数
+    def paginate_search(self, search, request):
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.offset = min(self.get_offset(request), self.max_offset)
+        result = search(self.limit + 1, self.offset)
+        self.has_next = len(result.ids) > self.limit
+        self.timed_out = result.timed_out
+        return result.ids[:self.limit]
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('timed_out', self.timed_out),
+            ('results', data),
+        ]))
+
+    def get_next_link(self):
+        if not self.has_next or self.offset + self.limit > self.max_offset:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+
+
+# 近くの店舗の検索のページネーション(距離順)
+# 件数を数えるCOUNTは行わず、limit+1件取得して次のページの有無を判定する
+class NearbyPagination(LimitOffsetPagination):
+    default_limit = 20
+    max_limit = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.offset = self.get_offset(request)
+        results = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_next = len(results) > self.limit
+        return results[:self.limit]
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+
+
+def _reverse_ordering(ordering):
+    return tuple(field[1:] if field.startswith('-') else '-' + field for field in ordering)
+
+
+# (f1, f2, ..., fn) が values より「後ろ」にある行を表す条件を組み立てる
+# f1 > v1 OR (f1 = v1 AND f2 > v2) OR ... (降順のフィールドは < で比較)
+def _keyset_filter(ordering, values):
+    condition = None
+    for index, field in enumerate(ordering):
+        attr = field.lstrip('-')
+        lookup = '__lt' if field.startswith('-') else '__gt'
+        term = Q(**{attr + lookup: values[index]})
+        for prev_field, prev_value in zip(ordering[:index], values[:index]):
+            term &= Q(**{prev_field.lstrip('-'): prev_value})
+        condition = term if condition is None else condition | term
+    return condition
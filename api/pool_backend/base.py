@@ -0,0 +1,23 @@
+from django.db.backends.postgresql import base
+from api.connections import get_pool
+
+
+# 接続プールを使うPostgresのバックエンド(settings.DB_CONN_MODE = 'pool')
+# 接続はプロセス内のConnectionPool(api.connections)から借り、Djangoが接続を閉じるとき
+# (CONN_MAX_AGE=0なのでリクエストの終わり)に切断せずプールへ返す
+# プールの設定: DATABASES['default']['POOL'] = {'MAX_SIZE': ..., 'TIMEOUT': ..., 'MAX_LIFETIME': ...}
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_pool(self):
+        return get_pool(self.alias, self.settings_dict.get('POOL', {}))
+
+    def get_new_connection(self, conn_params):
+        connection = self.get_pool().checkout(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        # プールの接続を再利用した場合も、接続時に設定される値を設定し直す
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                # エラーの後に使えなくなったため閉じる場合(close_if_unusable_or_obsolete)はプールに戻さない
+                self.get_pool().checkin(self.connection, discard=self.errors_occurred)
@@ -0,0 +1,275 @@
+import heapq
+import math
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .cache import invalidate
+from .models import Post, RankingEntry, RankingRun, RestaurantCategoryStats, RestaurantStats
+
+# 注目の投稿・評価の高い店舗・人気の店舗のランキング(manage.py refresh_rankingsが定期的に作成する)
+# リクエストごとに全投稿を集計・並び替えせず、(kind, category)ごとの上位RANKING_SIZE件をRankingEntryに保存しておき、
+# APIはインデックスで上位から読むだけにする
+#   trending        : 投稿。スコアを投稿からの経過時間で減衰させた値(RANKING_HALF_LIFE_DAYS日で半分になる)
+#   top_rated       : 店舗。平均スコアを投稿数で補正した値(RANKING_PRIOR_SCOREの投稿RANKING_PRIOR_COUNT件分を加えた平均)
+#   top_restaurants : 店舗。その店舗の投稿の減衰したスコアの合計(投稿数・新しさ・スコアのすべてが効く)
+# 減衰は固定の基準時刻(EPOCH)からの対数で保存する(log(スコア) + 基準時刻から投稿日時までの半減期の数 × log 2)。
+# 時間が経っても全員が同じだけ減衰するので順位は変わらず、前回以降に変わった投稿・店舗だけを並べ直せばよい(差分更新)
+
+EPOCH = datetime(2020, 1, 1, tzinfo=dt_timezone.utc)
+
+# IN句1回あたりのID数
+CHUNK_SIZE = 500
+# 残しておく更新の記録の件数
+KEEP_RUNS = 100
+
+Kind = namedtuple('Kind', ['entity', 'rows'])
+
+
+# 基準時刻からwhenまでの半減期の数 × log 2
+def decay_offset(when):
+    half_life = getattr(settings, 'RANKING_HALF_LIFE_DAYS', 3) * 86400
+    return (when - EPOCH).total_seconds() / half_life * math.log(2)
+
+
+def decayed_score(score, created_on):
+    return math.log(max(int(score), 1)) + decay_offset(created_on)
+
+
+def rated_score(score_sum, post_count):
+    prior_count = getattr(settings, 'RANKING_PRIOR_COUNT', 5)
+    prior_score = getattr(settings, 'RANKING_PRIOR_SCORE', 3.0)
+    return (prior_count * prior_score + score_sum) / (prior_count + post_count)
+
+
+# 保存した値を表示用の値にする(減衰する値は現在時刻での値)
+def display_score(kind, score, now=None):
+    if kind == RankingEntry.KIND_TOP_RATED:
+        return round(score, 2)
+    return round(math.exp(score - decay_offset(now or timezone.now())), 4)
+
+
+# 対数のまま足し合わせる(log(Σexp(value)))。基準時刻からの減衰をそのまま足すと桁があふれるため
+class LogSum:
+    def __init__(self):
+        self.peak = None
+        self.total = 0.0
+
+    def add(self, value):
+        if self.peak is None:
+            self.peak, self.total = value, 1.0
+        elif value > self.peak:
+            self.total = self.total * math.exp(self.peak - value) + 1.0
+            self.peak = value
+        else:
+            self.total += math.exp(value - self.peak)
+
+    @property
+    def value(self):
+        return self.peak + math.log(self.total)
+
+
+# idsがNoneなら全件、それ以外はidsをCHUNK_SIZE件ずつのIN句で絞り込んだquerysetを順に返す
+def _querysets(queryset, field, ids):
+    if ids is None:
+        yield queryset
+        return
+    ids = sorted(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield queryset.filter(**{field + '__in': ids[start:start + CHUNK_SIZE]})
+
+
+def _iterate(queryset, field, ids, *fields):
+    for chunk in _querysets(queryset.order_by(), field, ids):
+        yield from chunk.values_list(*fields).iterator(chunk_size=2000)
+
+
+# 各kindのリストの行 (category_id(Noneは全カテゴリー), 投稿・店舗のID, 値) を返す
+# idsを指定した場合はその投稿・店舗の行だけ
+def _trending_rows(ids=None):
+    for post_id, score, created_on in _iterate(Post.objects, 'id', ids, 'id', 'score', 'created_on'):
+        yield None, post_id, decayed_score(score, created_on)
+    through = Post.category.through.objects
+    for category_id, post_id, score, created_on in _iterate(
+        through, 'post_id', ids, 'category_id', 'post_id', 'post__score', 'post__created_on'
+    ):
+        yield category_id, post_id, decayed_score(score, created_on)
+
+
+def _top_rated_rows(ids=None):
+    stats = RestaurantStats.objects.filter(post_count__gt=0)
+    for restaurant_id, score_sum, post_count in _iterate(
+        stats, 'restaurant_id', ids, 'restaurant_id', 'score_sum', 'post_count'
+    ):
+        yield None, restaurant_id, rated_score(score_sum, post_count)
+    category_stats = RestaurantCategoryStats.objects.filter(post_count__gt=0)
+    for category_id, restaurant_id, score_sum, post_count in _iterate(
+        category_stats, 'restaurant_id', ids, 'category_id', 'restaurant_id', 'score_sum', 'post_count'
+    ):
+        yield category_id, restaurant_id, rated_score(score_sum, post_count)
+
+
+def _popular_rows(ids=None):
+    sums = defaultdict(LogSum)
+    for restaurant_id, score, created_on in _iterate(
+        Post.objects, 'restaurant_id', ids, 'restaurant_id', 'score', 'created_on'
+    ):
+        sums[None, restaurant_id].add(decayed_score(score, created_on))
+    through = Post.category.through.objects
+    for category_id, restaurant_id, score, created_on in _iterate(
+        through, 'post__restaurant_id', ids, 'category_id', 'post__restaurant_id', 'post__score', 'post__created_on'
+    ):
+        sums[category_id, restaurant_id].add(decayed_score(score, created_on))
+    for (category_id, restaurant_id), total in sums.items():
+        yield category_id, restaurant_id, total.value
+
+
+KINDS = {
+    RankingEntry.KIND_TRENDING: Kind('post', _trending_rows),
+    RankingEntry.KIND_TOP_RATED: Kind('restaurant', _top_rated_rows),
+    RankingEntry.KIND_TOP_RESTAURANTS: Kind('restaurant', _popular_rows),
+}
+
+
+# 値の大きい順(同じ値はIDの小さい順)の [(ID, 値), ...]
+def _ranked(scores):
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+# 行からリストごとの上位capacity件を作る(ヒープで上位だけを残すので、全件から作り直す時もメモリは件数によらない)
+def _top(rows, capacity):
+    heaps = defaultdict(list)
+    for key, entity_id, score in rows:
+        heap = heaps[key]
+        item = (score, -entity_id)
+        if len(heap) < capacity:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    return {key: _ranked({-entity_id: score for score, entity_id in heap}) for key, heap in heaps.items()}
+
+
+# 前回のリスト(entries、順位順)に変わった投稿・店舗(changed)の新しい値(scores)を反映する
+# 前回のリストが満杯なら、リスト外の項目の値はすべてリストの最下位以下なので、最下位を下回った項目は外す。
+# 残りがcapacity件未満になった場合は、リスト外から繰り上がる項目が分からないためNone(作り直しが必要)を返す
+def _merge(entries, changed, scores, capacity):
+    full = len(entries) >= capacity
+    floor = entries[-1][1] if full else None
+    merged = {entity_id: score for entity_id, score in entries if entity_id is not None and entity_id not in changed}
+    for entity_id, score in scores.items():
+        if floor is None or score >= floor:
+            merged[entity_id] = score
+    if full and len(merged) < capacity:
+        return None
+    return _ranked(merged)[:capacity]
+
+
+def _list_filter(key):
+    return {'category__isnull': True} if key is None else {'category_id': key}
+
+
+# 差分更新: 変わった投稿・店舗(changed)を含むリストだけを並べ直す {key: [(ID, 値), ...]}
+def _refresh_kind(kind, changed, capacity):
+    source = KINDS[kind]
+    scores = defaultdict(dict)
+    for key, entity_id, score in source.rows(changed):
+        scores[key][entity_id] = score
+
+    entries = RankingEntry.objects.filter(kind=kind)
+    # 新しい値のあるリスト、変わった項目が載っているリスト(カテゴリーから外れた場合など)、削除された項目が載っているリスト
+    keys = set(scores)
+    for chunk in _querysets(entries, source.entity + '_id', changed):
+        keys.update(chunk.values_list('category_id', flat=True).distinct())
+    keys.update(entries.filter(**{source.entity + '__isnull': True}).values_list('category_id', flat=True).distinct())
+
+    current = {
+        key: list(entries.filter(**_list_filter(key)).order_by('rank').values_list(source.entity + '_id', 'score'))
+        for key in keys
+    }
+
+    lists, rebuild = {}, set()
+    for key in keys:
+        merged = _merge(current[key], changed, scores.get(key, {}), capacity)
+        if merged is None:
+            rebuild.add(key)
+        else:
+            lists[key] = merged
+    if rebuild:
+        rebuilt = _top(source.rows(), capacity)
+        lists.update({key: rebuilt.get(key, []) for key in rebuild})
+    return lists
+
+
+def _write(kind, lists, replace_all=False):
+    entity_field = KINDS[kind].entity + '_id'
+    if replace_all:
+        RankingEntry.objects.filter(kind=kind).delete()
+    entries = []
+    for key, ranked in lists.items():
+        if not replace_all:
+            RankingEntry.objects.filter(kind=kind, **_list_filter(key)).delete()
+        entries.extend(
+            RankingEntry(kind=kind, category_id=key, rank=rank, score=score, **{entity_field: entity_id})
+            for rank, (entity_id, score) in enumerate(ranked, 1)
+        )
+    RankingEntry.objects.bulk_create(entries)
+
+
+def last_run():
+    return RankingRun.objects.order_by('-id').first()
+
+
+# ランキングを更新して更新の記録(RankingRun)を返す
+# 前回の更新がない場合とfull=Trueの場合は全件から作り直し、それ以外は前回の開始時刻以降に変わった投稿・店舗だけを反映する
+# (RANKING_OVERLAP_SECONDS秒だけ遡り、前回の実行中に確定したトランザクションの変更も拾う。同じ変更を2回反映しても結果は同じ)
+def refresh(full=False):
+    capacity = getattr(settings, 'RANKING_SIZE', 100)
+    run = RankingRun(started_on=timezone.now())
+    last = last_run()
+    run.full = full or last is None
+
+    with transaction.atomic():
+        if run.full:
+            for kind, source in KINDS.items():
+                lists = _top(source.rows(), capacity)
+                _write(kind, lists, replace_all=True)
+                run.lists_written += len(lists)
+        else:
+            since = last.started_on - timedelta(seconds=getattr(settings, 'RANKING_OVERLAP_SECONDS', 300))
+            post_ids = set(Post.objects.filter(updated_on__gte=since).values_list('id', flat=True))
+            restaurant_ids = set(
+                RestaurantStats.objects.filter(updated_on__gte=since).values_list('restaurant_id', flat=True)
+            ) | set(
+                RestaurantCategoryStats.objects.filter(updated_on__gte=since).values_list('restaurant_id', flat=True)
+            )
+            run.changed_posts, run.changed_restaurants = len(post_ids), len(restaurant_ids)
+            for kind, source in KINDS.items():
+                lists = _refresh_kind(kind, post_ids if source.entity == 'post' else restaurant_ids, capacity)
+                _write(kind, lists)
+                run.lists_written += len(lists)
+
+        run.finished_on = timezone.now()
+        run.save()
+        RankingRun.objects.filter(id__lte=run.id - KEEP_RUNS).delete()
+        invalidate('ranking')
+    return run
+
+
+# 保存済みのリストの上位limit件(削除された投稿・店舗の行は飛ばし、順位を詰める)
+# 投稿は?expand=(PostReadSerializer)に合わせて店舗・投稿者のプロフィールをJOINし、カテゴリーは1クエリでまとめて取得する
+def top(kind, category_id=None, limit=20, expand=()):
+    entity = KINDS[kind].entity
+    queryset = RankingEntry.objects.filter(kind=kind, **{entity + '__isnull': False}, **_list_filter(category_id))
+    if entity == 'post':
+        related = ['post__restaurant__stats' if 'restaurant' in expand else 'post']
+        if 'author_profile' in expand:
+            related.append('post__author__profile')
+        queryset = queryset.select_related(*related).prefetch_related('post__category')
+    else:
+        queryset = queryset.select_related('restaurant__stats')
+    entries = list(queryset.order_by('rank')[:limit])
+    for rank, entry in enumerate(entries, 1):
+        entry.rank = rank
+    return entries
@@ -0,0 +1,94 @@
+import hashlib
+import unicodedata
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from . import search, stats
+from .cache import invalidate
+from .models import Post, Restaurant
+
+# 店舗の重複の防止と統合
+# 店舗名・場所を正規化した文字列のハッシュをRestaurant.dedup_keyに保存し、ユニークインデックスで同じ店舗の作成を防ぐ。
+# 正規化では全角・半角、大文字・小文字、空白・記号の違いを吸収する(「すし 大」と「スシ大」は別の店舗のまま)
+# キーを付ける前に作られていた重複(dedup_keyがNULLの店舗)は manage.py merge_restaurants で統合する
+
+
+def normalize(text):
+    return ''.join(
+        char for char in search.normalize(text)
+        if not unicodedata.category(char).startswith(('P', 'Z', 'C', 'S'))
+    )
+
+
+def restaurant_key(name, location):
+    source = '{}\x1f{}'.format(normalize(name), normalize(location))
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+# 店舗名・場所が同じ(正規化して一致する)店舗。ない場合はNone
+def find(name, location, queryset=None):
+    queryset = Restaurant.objects.all() if queryset is None else queryset
+    return queryset.filter(dedup_key=restaurant_key(name, location)).first()
+
+
+# 店舗名・場所が同じ店舗を取得し、なければ作成する((店舗, 作成したかどうか)を返す)
+# 同時に作成された場合はユニークインデックスの違反になるので、作成された方を取得し直す
+def get_or_create(name, location, queryset=None):
+    restaurant = find(name, location, queryset)
+    if restaurant is not None:
+        return restaurant, False
+    try:
+        with transaction.atomic():
+            return Restaurant.objects.create(name=name, location=location), True
+    except IntegrityError:
+        restaurant = find(name, location, queryset)
+        if restaurant is None:
+            raise
+        return restaurant, False
+
+
+# 重複している店舗のグループ [(残す店舗のID, [統合する店舗のID, ...]), ...]
+# 残すのはdedup_keyを持つ店舗(なければIDが最小の店舗)
+def duplicate_groups(chunk_size=2000):
+    rows = defaultdict(list)
+    keyed = {}
+    queryset = Restaurant.objects.order_by('id').values_list('id', 'name', 'location', 'dedup_key')
+    for restaurant_id, name, location, dedup_key in queryset.iterator(chunk_size=chunk_size):
+        key = restaurant_key(name, location)
+        rows[key].append(restaurant_id)
+        if dedup_key == key:
+            keyed[key] = restaurant_id
+
+    groups = []
+    for key, ids in rows.items():
+        if len(ids) < 2:
+            continue
+        target_id = keyed.get(key, ids[0])
+        groups.append((target_id, [restaurant_id for restaurant_id in ids if restaurant_id != target_id]))
+    return sorted(groups)
+
+
+# 重複している店舗の投稿を残す店舗に付け替えてから、重複している店舗を削除する
+# 付け替えはbatch_size件の店舗ごとのUPDATE 1回で行い、投稿を1件ずつ読み込まない
+def merge(target_id, duplicate_ids, batch_size=500):
+    duplicate_ids = [restaurant_id for restaurant_id in duplicate_ids if restaurant_id != target_id]
+    moved = 0
+    with transaction.atomic():
+        target = Restaurant.objects.select_for_update().get(pk=target_id)
+        for start in range(0, len(duplicate_ids), batch_size):
+            batch = duplicate_ids[start:start + batch_size]
+            moved += Post.objects.filter(restaurant_id__in=batch).update(
+                restaurant_id=target_id, updated_on=timezone.now()
+            )
+            Restaurant.objects.filter(id__in=batch).delete()
+
+        key = restaurant_key(target.name, target.location)
+        if target.dedup_key != key and not Restaurant.objects.filter(dedup_key=key).exists():
+            Restaurant.objects.filter(pk=target_id).update(dedup_key=key)
+        if moved:
+            # 付け替えた投稿の検索用文字列(店舗名・場所を含む)と集計値を作り直す
+            search.reindex_posts(Post.objects.filter(restaurant_id=target_id), batch_size=batch_size)
+            stats.refresh_restaurants([target_id])
+        invalidate('restaurant', 'post')
+    return moved
@@ -0,0 +1,162 @@
+import time
+import unicodedata
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+
+# 投稿の全文検索
+# 検索対象(メニュー名・レビュー・店舗名・店舗の場所)はPost.search_documentに1つの文字列としてまとめて保存し、
+#   Postgres: search_documentにpg_trgmのGINインデックス(部分一致とsimilarityによる順位付け)
+#   SQLite  : FTS5(trigramトークナイザ)の仮想テーブル api_post_fts (rowid = 投稿ID)
+# で検索する。日本語は単語区切りがないためトライグラムで部分一致させる
+
+FTS_TABLE = 'api_post_fts'
+# トライグラムで検索できる最短の文字数(これより短い語はLIKEで検索する)
+MIN_TRIGRAM_LENGTH = 3
+
+SearchResult = namedtuple('SearchResult', ['ids', 'timed_out'])
+
+
+def normalize(text):
+    # 全角・半角や大文字・小文字の違いを吸収する
+    return unicodedata.normalize('NFKC', text or '').casefold()
+
+
+def build_search_document(menu_item, review_text, restaurant_name, restaurant_location):
+    return normalize('\n'.join(part or '' for part in (menu_item, review_text, restaurant_name, restaurant_location)))
+
+
+def document_for_post(post):
+    restaurant = post.restaurant
+    return build_search_document(post.menu_item, post.review_text, restaurant.name, restaurant.location)
+
+
+# SQLiteでFTS5テーブルが使えるかどうか(FTS5非対応のSQLiteではマイグレーションで作成されない)
+# 毎回テーブル一覧を問い合わせないよう、DBごとに結果を覚えておく
+_fts_tables = {}
+
+
+def fts_available():
+    if connection.vendor != 'sqlite':
+        return False
+    key = (connection.alias, str(connection.settings_dict['NAME']))
+    if key not in _fts_tables:
+        _fts_tables[key] = FTS_TABLE in connection.introspection.table_names()
+    return _fts_tables[key]
+
+
+# FTS5テーブルに投稿の検索用文字列を登録・更新する(Postgresではカラムのインデックスが自動で更新されるので何もしない)
+def index_posts(rows):
+    rows = list(rows)
+    if not rows or not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany('DELETE FROM {} WHERE rowid = %s'.format(FTS_TABLE), [(post_id,) for post_id, _ in rows])
+        cursor.executemany('INSERT INTO {}(rowid, search_document) VALUES (%s, %s)'.format(FTS_TABLE), rows)
+
+
+def unindex_posts(post_ids):
+    post_ids = list(post_ids)
+    if not post_ids or not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany('DELETE FROM {} WHERE rowid = %s'.format(FTS_TABLE), [(post_id,) for post_id in post_ids])
+
+
+# 検索用文字列とFTS5テーブルを作り直す(店舗名の変更やbulk操作の後に使用)
+def reindex_posts(queryset, batch_size=500):
+    from .models import Post
+
+    batch = []
+    count = 0
+    for post in queryset.select_related('restaurant').iterator(chunk_size=batch_size):
+        post.search_document = document_for_post(post)
+        batch.append(post)
+        if len(batch) >= batch_size:
+            count += _save_documents(Post, batch)
+            batch = []
+    if batch:
+        count += _save_documents(Post, batch)
+    return count
+
+
+def _save_documents(model, posts):
+    model.objects.bulk_update(posts, ['search_document'])
+    index_posts((post.id, post.search_document) for post in posts)
+    return len(posts)
+
+
+# 検索を実行して、関連度順に並んだ投稿IDを返す
+# SEARCH_TIMEOUT_MS を超えた場合は途中で打ち切り、timed_out=Trueを返す
+def search_post_ids(query, limit, offset=0):
+    terms = normalize(query).split()
+    if not terms:
+        return SearchResult([], False)
+
+    try:
+        with _time_budget(getattr(settings, 'SEARCH_TIMEOUT_MS', 300)):
+            if connection.vendor == 'postgresql':
+                ids = _search_postgres(terms, limit, offset)
+            elif fts_available() and all(len(term) >= MIN_TRIGRAM_LENGTH for term in terms):
+                ids = _search_fts5(terms, limit, offset)
+            else:
+                ids = _search_like(terms, limit, offset)
+    except DatabaseError:
+        # statement_timeout(Postgres)やprogress handlerによる中断(SQLite)
+        return SearchResult([], True)
+    return SearchResult(ids, False)
+
+
+def _search_postgres(terms, limit, offset):
+    from django.contrib.postgres.search import TrigramSimilarity
+    from .models import Post
+
+    queryset = Post.objects.all()
+    for term in terms:
+        # LIKE '%term%' はgin_trgm_opsのインデックスで解決される
+        queryset = queryset.filter(search_document__contains=term)
+    queryset = queryset.annotate(rank=TrigramSimilarity('search_document', ' '.join(terms)))
+    return list(queryset.order_by('-rank', '-id').values_list('id', flat=True)[offset:offset + limit])
+
+
+def _search_fts5(terms, limit, offset):
+    # 各語をフレーズとしてAND検索し、bm25の順位(rank)で並べる
+    match = ' AND '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT rowid FROM {} WHERE {} MATCH %s ORDER BY rank, rowid DESC LIMIT %s OFFSET %s'.format(FTS_TABLE, FTS_TABLE),
+            [match, limit, offset],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _search_like(terms, limit, offset):
+    from .models import Post
+
+    queryset = Post.objects.all()
+    for term in terms:
+        queryset = queryset.filter(search_document__contains=term)
+    return list(queryset.order_by('-created_on', '-id').values_list('id', flat=True)[offset:offset + limit])
+
+
+# 検索クエリの実行時間に上限を設ける
+@contextmanager
+def _time_budget(milliseconds):
+    if connection.vendor == 'postgresql':
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL statement_timeout = %s', [int(milliseconds)])
+            yield
+    elif connection.vendor == 'sqlite':
+        connection.ensure_connection()
+        deadline = time.monotonic() + milliseconds / 1000.0
+        # 0以外を返すとSQLiteが実行中のクエリを中断する
+        connection.connection.set_progress_handler(lambda: int(time.monotonic() > deadline), 1000)
+        try:
+            yield
+        finally:
+            connection.connection.set_progress_handler(None, 0)
+    else:
+        yield
@@ -1,8 +1,16 @@
+import os
+
 # Djangoの認証システムからユーザーモデルを取得する関数をインポート
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, router, transaction
+from django.db.models.signals import m2m_changed
 # Django Rest Frameworkからシリアライザーズをインポート
 from rest_framework import serializers
-from .models import Profile, Post, Restaurant, Category
+from rest_framework.settings import api_settings
+from . import images, rankings, restaurants, signed_uploads, uploads
+from django.conf import settings
+from .models import Profile, Post, Restaurant, Category, RestaurantStats, RestaurantCategoryStats, ChunkedUpload, RankingEntry
 
 # UserSerializer
 class UserSerializer(serializers.ModelSerializer):
@@ -27,31 +35,379 @@ class ProfileSerializer(serializers.ModelSerializer):
     # created_onフィールドをDateTimeFieldとして定義（"%Y-%m-%d"）でフォーマットしてシリアライズ)
     # read_only=True：このフィールドが読み取り専用
     created_on = serializers.DateTimeField(format="%Y-%m-%d", read_only=True)
+    # 画像の縮小版のURL {幅: {"webp": URL, "jpg": URL}} (作成前は空)
+    img_variants = serializers.SerializerMethodField()
 
     # Metaクラスはシリアライザーの動作を制御します。
     class Meta:
         # このシリアライザーが扱うモデル：Profileモデル
         model = Profile
         # ProfileモデルのどのフィールドをAPIで公開するかを定義(ID、ニックネーム、ユーザープロフィール、作成日時、画像が公開)
-        fields = ('id', 'nickName', 'userProfile', 'created_on', 'img')
+        fields = ('id', 'nickName', 'userProfile', 'created_on', 'img', 'img_variants')
         # userProfileフィールドが読み取り専用（'read_only': True）であることを指定
         # Django側で自動でユーザの割り当てを行うようにする
         extra_kwargs = {'userProfile': {'read_only': True}}
 
+    def get_img_variants(self, obj):
+        return images.variant_urls(obj, 'img')
+
+# 店舗の集計値(投稿数・平均スコア・価格帯・スコアの分布)
+class RestaurantStatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = RestaurantStats
+        fields = ('post_count', 'avg_score', 'avg_price', 'price_min', 'price_max', 'score_histogram')
+        read_only_fields = fields
+
+# 店舗のカテゴリーごとの集計値
+class RestaurantCategoryStatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = RestaurantCategoryStats
+        fields = ('category', 'post_count', 'avg_score')
+        read_only_fields = fields
+
 class RestaurantSerializer(serializers.ModelSerializer):
+    # 集計値はビューでselect_related('stats')しておくことで追加のクエリなしで返す
+    stats = RestaurantStatsSerializer(read_only=True)
+
     class Meta:
         model = Restaurant
-        fields = ('id', 'name', 'location')
+        fields = ('id', 'name', 'location', 'latitude', 'longitude', 'stats')
+
+    # 店舗名・場所が同じ(正規化して一致する)店舗がすでにある場合は作成・変更しない
+    # 店舗名・場所を変更しない更新(緯度・経度だけのPATCHなど)では確認しない
+    def validate(self, attrs):
+        if 'name' not in attrs and 'location' not in attrs:
+            return attrs
+        name = attrs.get('name', getattr(self.instance, 'name', ''))
+        location = attrs.get('location', getattr(self.instance, 'location', ''))
+        existing = restaurants.find(name, location, self._other_restaurants())
+        if existing is not None:
+            raise serializers.ValidationError(self._duplicate_message(existing), code='unique')
+        return attrs
+
+    # 確認と保存の間に同じ店舗が作成された場合は、dedup_keyのユニークインデックスの違反を400にする
+    def create(self, validated_data):
+        return self._save_unique(super().create, validated_data)
+
+    def update(self, instance, validated_data):
+        return self._save_unique(super().update, instance, validated_data)
+
+    def _save_unique(self, save, *args):
+        validated_data = args[-1]
+        try:
+            with transaction.atomic():
+                return save(*args)
+        except IntegrityError:
+            name = validated_data.get('name', getattr(self.instance, 'name', ''))
+            location = validated_data.get('location', getattr(self.instance, 'location', ''))
+            existing = restaurants.find(name, location, self._other_restaurants())
+            if existing is None:
+                raise
+            raise serializers.ValidationError(
+                {api_settings.NON_FIELD_ERRORS_KEY: [self._duplicate_message(existing)]}, code='unique'
+            )
+
+    def _other_restaurants(self):
+        queryset = Restaurant.objects.all()
+        if self.instance is not None:
+            queryset = queryset.exclude(pk=self.instance.pk)
+        return queryset
+
+    def _duplicate_message(self, existing):
+        return 'A restaurant with this name and location already exists (id={}).'.format(existing.pk)
+
+# 店舗詳細ではカテゴリーごとの集計値も返す
+class RestaurantDetailSerializer(RestaurantSerializer):
+    category_stats = RestaurantCategoryStatsSerializer(many=True, read_only=True)
+
+    class Meta(RestaurantSerializer.Meta):
+        fields = RestaurantSerializer.Meta.fields + ('category_stats',)
+
+# 近くの店舗の検索結果(distance: 検索した地点からの距離(km))
+class RestaurantNearbySerializer(RestaurantSerializer):
+    distance = serializers.FloatField(read_only=True)
+
+    class Meta(RestaurantSerializer.Meta):
+        fields = RestaurantSerializer.Meta.fields + ('distance',)
 
 class CategorySerializer(serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = ('id', 'name')
 
+# 投稿のカテゴリーIDの一覧
+# PrimaryKeyRelatedField(many=True)のようにIDごとにクエリを発行せず、すべてのIDを1回のIN句のクエリで確認する
+class CategoryIdListField(serializers.ListField):
+    child = serializers.IntegerField()
+    default_error_messages = {
+        'does_not_exist': 'Invalid pk "{pk_value}" - object does not exist.',
+    }
+
+    def to_representation(self, value):
+        return [category.pk for category in value.all()]
+
+    def to_internal_value(self, data):
+        category_ids = list(dict.fromkeys(super().to_internal_value(data)))
+        found = set(Category.objects.filter(pk__in=category_ids).values_list('pk', flat=True))
+        for category_id in category_ids:
+            if category_id not in found:
+                self.fail('does_not_exist', pk_value=category_id)
+        return category_ids
+
 class PostSerializer(serializers.ModelSerializer):
     created_on = serializers.DateTimeField(format="%Y-%m-%d", read_only=True)
+    category = CategoryIdListField(allow_empty=False)
+    # メニュー画像の縮小版のURL {幅: {"webp": URL, "jpg": URL}} (作成前は空)
+    menu_item_photo_variants = serializers.SerializerMethodField()
+
     class Meta:
         model = Post
         fields = ('id', 'created_on', 'author', 'restaurant', 'category', 'menu_item', 'score', 'price', 'menu_item_photo',
-                  'menu_item_model', 'review_text')
-        extra_kwargs = {'author': {'read_only': True}}
\ No newline at end of file
+                  'menu_item_photo_variants', 'menu_item_model', 'review_text')
+        extra_kwargs = {'author': {'read_only': True}}
+
+    def get_menu_item_photo_variants(self, obj):
+        return images.variant_urls(obj, 'menu_item_photo')
+
+    # 投稿の保存とカテゴリーの紐付けを1つのトランザクションで行う
+    def create(self, validated_data):
+        category_ids = validated_data.pop('category', [])
+        with transaction.atomic():
+            post = super().create(validated_data)
+            set_post_categories(post, category_ids, created=True)
+        return post
+
+    def update(self, instance, validated_data):
+        category_ids = validated_data.pop('category', None)
+        with transaction.atomic():
+            post = super().update(instance, validated_data)
+            if category_ids is not None:
+                set_post_categories(post, category_ids)
+        return post
+
+# 投稿のカテゴリーの紐付けを差分だけ更新する(中間テーブルの行のまとめての削除・追加)
+# clear()してから追加し直したり、1件ずつ追加したりはしない。
+# 集計値やキャッシュの更新はシグナル(m2m_changed)で行うため、post.category.add/removeと同じようにシグナルを送る
+def set_post_categories(post, category_ids, created=False):
+    through = Post.category.through
+    category_ids = set(category_ids)
+    prefetched = getattr(post, '_prefetched_objects_cache', {}).get('category')
+    if created:
+        current = set()
+    elif prefetched is not None:
+        # ビューでprefetch_relatedしたカテゴリーがあればそれを使う
+        current = {category.pk for category in prefetched}
+    else:
+        current = set(through.objects.filter(post_id=post.pk).values_list('category_id', flat=True))
+    removed = current - category_ids
+    added = category_ids - current
+
+    if removed:
+        _send_category_signal(post, 'pre_remove', removed)
+        through.objects.filter(post_id=post.pk, category_id__in=removed).delete()
+        _send_category_signal(post, 'post_remove', removed)
+    if added:
+        _send_category_signal(post, 'pre_add', added)
+        # 同時に同じ紐付けが追加されていても失敗しないようにする(post.category.addと同じ)
+        through.objects.bulk_create(
+            [through(post_id=post.pk, category_id=category_id) for category_id in sorted(added)], ignore_conflicts=True
+        )
+        _send_category_signal(post, 'post_add', added)
+    # 変更したのでprefetch_relatedの結果は使わない
+    getattr(post, '_prefetched_objects_cache', {}).pop('category', None)
+
+def _send_category_signal(post, action, pk_set):
+    m2m_changed.send(
+        sender=Post.category.through, instance=post, action=action, reverse=False,
+        model=Category, pk_set=set(pk_set), using=router.db_for_write(Post, instance=post),
+    )
+
+# 投稿の読み取り専用のシリアライザー(一覧・詳細・検索)
+# ModelSerializerのようにフィールドごとのシリアライザーを通さず、辞書を直接組み立てる(展開しない場合の出力はPostSerializerと同じ)
+# context['expand']: IDの代わりに中身を返す関連(restaurant / category)と、追加で返す投稿者のプロフィール(author_profile)
+# context['fields']: 返すフィールドの一覧(Noneの場合はすべて)
+# 関連はビューでselect_related/prefetch_relatedしておくこと(PostReadMixin)
+class PostReadSerializer(serializers.BaseSerializer):
+    fields_all = PostSerializer.Meta.fields
+    expandable = ('restaurant', 'category', 'author_profile')
+    date_field = serializers.DateTimeField(format="%Y-%m-%d")
+
+    @classmethod
+    def field_names(cls, expand=()):
+        names = list(cls.fields_all)
+        if 'author_profile' in expand:
+            names.insert(names.index('author') + 1, 'author_profile')
+        return names
+
+    def to_representation(self, post):
+        getters = getattr(self, '_getters', None)
+        if getters is None:
+            getters = self._getters = self._build_getters()
+        return {name: getter(post) for name, getter in getters}
+
+    def _build_getters(self):
+        expand = self.context.get('expand', ())
+        request = self.context.get('request')
+        fields = self.context.get('fields') or self.field_names(expand)
+        getters = {
+            'id': lambda post: post.id,
+            'created_on': lambda post: self.date_field.to_representation(post.created_on),
+            'author': lambda post: post.author_id,
+            'restaurant': lambda post: post.restaurant_id,
+            'category': lambda post: [category.pk for category in post.category.all()],
+            'menu_item': lambda post: post.menu_item,
+            'score': lambda post: post.score,
+            'price': lambda post: post.price,
+            'menu_item_photo': lambda post: _file_url(post.menu_item_photo, request),
+            'menu_item_photo_variants': lambda post: images.variant_urls(post, 'menu_item_photo'),
+            'menu_item_model': lambda post: _file_url(post.menu_item_model, request),
+            'review_text': lambda post: post.review_text,
+        }
+        if 'restaurant' in expand:
+            getters['restaurant'] = lambda post: _restaurant_data(post.restaurant)
+        if 'category' in expand:
+            getters['category'] = lambda post: [{'id': c.pk, 'name': c.name} for c in post.category.all()]
+        if 'author_profile' in expand:
+            getters['author_profile'] = lambda post: _profile_data(_related(post.author, 'profile'), request, self.date_field)
+        return [(name, getters[name]) for name in fields]
+
+# FileField/ImageFieldをDRFのFileFieldと同じ形(リクエストがあれば絶対URL、なければNone)にする
+def _file_url(file, request):
+    if not file:
+        return None
+    url = file.url
+    return request.build_absolute_uri(url) if request is not None else url
+
+# 逆方向の1対1の関連(存在しない場合はNone)
+def _related(instance, name):
+    try:
+        return getattr(instance, name)
+    except ObjectDoesNotExist:
+        return None
+
+def _restaurant_data(restaurant):
+    stats = _related(restaurant, 'stats')
+    return {
+        'id': restaurant.id,
+        'name': restaurant.name,
+        'location': restaurant.location,
+        'latitude': restaurant.latitude,
+        'longitude': restaurant.longitude,
+        'stats': None if stats is None else {
+            'post_count': stats.post_count,
+            'avg_score': stats.avg_score,
+            'avg_price': stats.avg_price,
+            'price_min': stats.price_min,
+            'price_max': stats.price_max,
+            'score_histogram': stats.score_histogram,
+        },
+    }
+
+def _profile_data(profile, request, date_field):
+    if profile is None:
+        return None
+    return {
+        'id': profile.id,
+        'nickName': profile.nickName,
+        'userProfile': profile.userProfile_id,
+        'created_on': date_field.to_representation(profile.created_on),
+        'img': _file_url(profile.img, request),
+        'img_variants': images.variant_urls(profile, 'img'),
+    }
+
+# 3Dモデルの分割アップロード
+class ChunkedUploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ChunkedUpload
+        fields = ('id', 'post', 'filename', 'size', 'offset', 'status', 'created_on')
+        read_only_fields = ('offset', 'status', 'created_on')
+
+    def validate_post(self, post):
+        # 自分の投稿にだけアップロードできる
+        if post.author_id != self.context['request'].user.pk:
+            raise serializers.ValidationError('You can only upload files to your own posts.')
+        return post
+
+    def validate_size(self, size):
+        max_size = getattr(settings, 'CHUNKED_UPLOAD_MAX_SIZE', 200 * 1024 * 1024)
+        if size <= 0 or size > max_size:
+            raise serializers.ValidationError('Size must be between 1 and {} bytes.'.format(max_size))
+        return size
+
+    def validate_filename(self, filename):
+        if os.path.splitext(filename)[1].lower() not in uploads.MODEL_EXTENSIONS:
+            raise serializers.ValidationError(
+                'Unsupported file type. Allowed: {}.'.format(', '.join(uploads.MODEL_EXTENSIONS))
+            )
+        return filename
+
+# 署名付きアップロードURLの発行リクエスト
+# target: post_photo(Post.menu_item_photo) / post_model(Post.menu_item_model) / avatar(Profile.img)
+# id: 投稿またはプロフィールのID
+class UploadUrlSerializer(serializers.Serializer):
+    target = serializers.ChoiceField(choices=sorted(signed_uploads.TARGETS))
+    id = serializers.IntegerField()
+    filename = serializers.CharField(max_length=200)
+    content_type = serializers.CharField(max_length=100, default='application/octet-stream')
+
+# 投稿の一括インポート(api.bulk)の1行分
+# 店舗・カテゴリーはIDではなく名前で指定する(店舗は店舗名と場所(restaurant_location)で指定する)
+# author(メールアドレス)はmanage.py import_postsでのみ使用し、APIでは常にリクエストしたユーザーの投稿になる
+class PostImportRowSerializer(serializers.Serializer):
+    menu_item = serializers.CharField(max_length=200)
+    restaurant = serializers.CharField(max_length=200)
+    restaurant_location = serializers.CharField(max_length=200)
+    category = serializers.ListField(child=serializers.CharField(max_length=50), required=False, default=list)
+    score = serializers.IntegerField(min_value=1, max_value=5, default=3)
+    price = serializers.IntegerField()
+    review_text = serializers.CharField(required=False, allow_blank=True, allow_null=True, default=None)
+    author = serializers.EmailField(required=False)
+
+# 店舗名・場所による店舗の検索(GET /api/restaurant/lookup/)・取得または作成(POST /api/restaurant/lookup/)
+class RestaurantKeySerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=200)
+    location = serializers.CharField(max_length=200)
+
+# 入力補完の条件(/api/autocomplete/<restaurant|category|menu_item>/?q=&limit=)
+class AutocompleteQuerySerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=100, trim_whitespace=False)
+    limit = serializers.IntegerField(min_value=1, max_value=getattr(settings, 'AUTOCOMPLETE_MAX_LIMIT', 20),
+                                     default=getattr(settings, 'AUTOCOMPLETE_LIMIT', 10))
+
+# 近くの店舗の検索条件(/api/restaurant/nearby/?lat=&lng=&radius=、radiusはkm)
+class NearbyQuerySerializer(serializers.Serializer):
+    lat = serializers.FloatField(min_value=-90, max_value=90)
+    lng = serializers.FloatField(min_value=-180, max_value=180)
+    radius = serializers.FloatField(min_value=0.01, default=1.0)
+
+    def validate_radius(self, radius):
+        max_radius = getattr(settings, 'NEARBY_MAX_RADIUS_KM', 20)
+        if radius > max_radius:
+            raise serializers.ValidationError('Ensure this value is less than or equal to {}.'.format(max_radius))
+        return radius
+
+# ランキングの条件(/api/ranking/<kind>/?category=&limit=、categoryを省略すると全カテゴリーのランキング)
+class RankingQuerySerializer(serializers.Serializer):
+    category = serializers.IntegerField(min_value=1, required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=getattr(settings, 'RANKING_SIZE', 100),
+                                     default=getattr(settings, 'RANKING_PAGE_SIZE', 20))
+
+# ランキングの1行 {rank, score, post} / {rank, score, restaurant}
+# 投稿はPostReadSerializer(context['expand']で展開)、店舗はRestaurantSerializerで返す
+class RankingEntrySerializer(serializers.BaseSerializer):
+    def to_representation(self, entry):
+        data = {'rank': entry.rank, 'score': rankings.display_score(entry.kind, entry.score, self.context.get('now'))}
+        if entry.kind == RankingEntry.KIND_TRENDING:
+            data['post'] = self._nested('post', PostReadSerializer).to_representation(entry.post)
+        else:
+            data['restaurant'] = self._nested('restaurant', RestaurantSerializer).to_representation(entry.restaurant)
+        return data
+
+    # 入れ子のシリアライザーは行ごとに作らず使い回す
+    def _nested(self, name, serializer_class):
+        nested = getattr(self, '_nested_serializers', None)
+        if nested is None:
+            nested = self._nested_serializers = {}
+        if name not in nested:
+            nested[name] = serializer_class(context=self.context)
+        return nested[name]
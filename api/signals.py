@@ -0,0 +1,179 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from . import autocomplete, geo, images, media, restaurants, search, stats
+from .authentication import forget_user_state
+from .cache import invalidate
+from .models import Post, Profile, Restaurant, RestaurantStats, Category, User
+
+
+# 投稿の保存前に全文検索用の文字列を作り直す
+@receiver(pre_save, sender=Post)
+def update_post_search_document(sender, instance, **kwargs):
+    instance.search_document = search.document_for_post(instance)
+
+
+@receiver(post_save, sender=Post)
+def index_post(sender, instance, **kwargs):
+    search.index_posts([(instance.id, instance.search_document)])
+
+
+@receiver(post_delete, sender=Post)
+def unindex_post(sender, instance, **kwargs):
+    search.unindex_posts([instance.id])
+
+
+# 入力補完(api.autocomplete)用の正規化した名前を保存前に作り直す
+@receiver(pre_save, sender=Restaurant)
+@receiver(pre_save, sender=Category)
+def update_normalized_name(sender, instance, **kwargs):
+    instance.name_normalized = autocomplete.normalize(instance.name, sender._meta.get_field('name_normalized').max_length)
+
+
+@receiver(pre_save, sender=Post)
+def update_normalized_menu_item(sender, instance, **kwargs):
+    instance.menu_item_normalized = autocomplete.normalize(instance.menu_item)
+
+
+# 店舗の保存前に緯度・経度からgeohashを作り直す
+@receiver(pre_save, sender=Restaurant)
+def update_restaurant_geohash(sender, instance, **kwargs):
+    if instance.latitude is None or instance.longitude is None:
+        instance.geohash = ''
+    else:
+        instance.geohash = geo.encode(instance.latitude, instance.longitude)
+
+
+# 店舗の作成時と店舗名・場所の変更時に重複チェック用のキーを作り直す
+# (キーがNULLの既存の重複は、店舗名・場所を変えない限りNULLのままにする)
+@receiver(pre_save, sender=Restaurant)
+def update_restaurant_dedup_key(sender, instance, **kwargs):
+    if instance.has_changed('name', 'location'):
+        instance.dedup_key = restaurants.restaurant_key(instance.name, instance.location)
+
+
+# 店舗名・場所が変わったら、その店舗の投稿の検索用文字列を作り直す
+@receiver(post_save, sender=Restaurant)
+def reindex_restaurant_posts(sender, instance, created, **kwargs):
+    if not created and instance.has_changed('name', 'location'):
+        search.reindex_posts(instance.posts.all())
+
+
+# 店舗の集計値(RestaurantStats)を投稿の作成・更新・削除に合わせて差分更新する
+@receiver(post_save, sender=Restaurant)
+def create_restaurant_stats(sender, instance, created, **kwargs):
+    if created:
+        RestaurantStats.objects.get_or_create(restaurant=instance)
+
+
+@receiver(post_save, sender=Post)
+def update_restaurant_stats(sender, instance, created, **kwargs):
+    stats.post_saved(instance, created)
+
+
+# 削除後は中間テーブルの行も消えているため、削除前にカテゴリーを覚えておく
+@receiver(pre_delete, sender=Post)
+def remember_post_categories(sender, instance, **kwargs):
+    instance._category_ids = list(instance.category.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Post)
+def remove_post_from_restaurant_stats(sender, instance, **kwargs):
+    stats.post_deleted(instance, getattr(instance, '_category_ids', []))
+
+
+@receiver(m2m_changed, sender=Post.category.through)
+def update_restaurant_category_stats(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # clear()はpk_setが渡されないので、消える前の紐付けを覚えておく
+        related = instance.posts if reverse else instance.category
+        instance._cleared_ids = set(related.values_list('id', flat=True))
+        return
+    if action == 'post_clear':
+        action, pk_set = 'post_remove', getattr(instance, '_cleared_ids', set())
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+
+    sign = 1 if action == 'post_add' else -1
+    if reverse:
+        stats.post_categories_changed(pk_set, [instance.pk], sign)
+    else:
+        stats.post_categories_changed([instance.pk], pk_set, sign)
+
+
+# カテゴリーの付け替えも投稿の更新として記録する(ランキング(api.rankings)のカテゴリーごとのリストの差分更新用)
+@receiver(m2m_changed, sender=Post.category.through)
+def touch_post_updated_on(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_clear':
+        post_ids = getattr(instance, '_cleared_ids', set()) if reverse else [instance.pk]
+    elif action in ('post_add', 'post_remove') and pk_set:
+        post_ids = pk_set if reverse else [instance.pk]
+    else:
+        return
+    Post.objects.filter(id__in=post_ids).update(updated_on=timezone.now())
+
+
+# 読み取りAPIのレスポンスキャッシュ(api.cache)を無効にする
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+@receiver(m2m_changed, sender=Post.category.through)
+def invalidate_post_cache(sender, **kwargs):
+    invalidate('post')
+
+
+@receiver(post_save, sender=Restaurant)
+@receiver(post_delete, sender=Restaurant)
+def invalidate_restaurant_cache(sender, **kwargs):
+    invalidate('restaurant')
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_cache(sender, **kwargs):
+    invalidate('category')
+
+
+# プロフィールは投稿の?expand=author_profileに埋め込まれる
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def invalidate_profile_cache(sender, **kwargs):
+    invalidate('profile')
+
+
+# ユーザーの無効化・削除がJWT認証(api.authentication)にすぐ反映されるよう、キャッシュした状態を消す
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_cached_user_state(sender, instance, **kwargs):
+    forget_user_state(instance.pk)
+
+
+# 投稿のメニュー画像・プロフィール画像がアップロードされたら縮小版を作る(api.images)
+@receiver(pre_save, sender=Post)
+@receiver(pre_save, sender=Profile)
+def prepare_image_variants(sender, instance, **kwargs):
+    images.prepare_variants(instance)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Profile)
+def schedule_image_variants(sender, instance, **kwargs):
+    images.schedule_pending_variants(instance)
+
+
+# ファイルの差し替え・削除で使われなくなったファイルをストレージから消す(api.media)
+@receiver(pre_save, sender=Post)
+@receiver(pre_save, sender=Profile)
+def prepare_file_cleanup(sender, instance, **kwargs):
+    media.prepare_cleanup(instance)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Profile)
+def schedule_file_cleanup(sender, instance, **kwargs):
+    media.schedule_replaced(instance)
+
+
+@receiver(post_delete, sender=Post)
+@receiver(post_delete, sender=Profile)
+def schedule_deleted_file_cleanup(sender, instance, **kwargs):
+    media.schedule_deleted(instance)
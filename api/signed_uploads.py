@@ -0,0 +1,164 @@
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+from django.utils.module_loading import import_string
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
+
+from . import images
+
+# 署名付きURLによるストレージへの直接アップロード
+# 1. POST /api/upload_url/     アップロード先のファイル名(upload_post_path等で決める)と署名付きのPUT先URLを発行
+# 2. クライアントがファイルをPUT先へ直接送信(APIのワーカーはファイルのバイト列を扱わない)
+# 3. POST /api/upload_confirm/ ストレージにファイルがあることを確認してモデルのフィールドに紐付ける
+# PUT先は設定(DIRECT_UPLOAD_BACKEND)で切り替える
+#   GoogleCloudUploadBackend: GCSのV4署名付きURL
+#   LocalUploadBackend      : このAPIの/api/upload_local/<token>/ (オフライン・テスト用のストレージの代わり)
+
+TOKEN_SALT = 'api.signed_uploads'
+
+# アップロードの対象: (モデル, フィールド, 所有者のユーザーIDを表す属性)
+TARGETS = {
+    'post_photo': ('api.Post', 'menu_item_photo', 'author_id'),
+    'post_model': ('api.Post', 'menu_item_model', 'author_id'),
+    'avatar': ('api.Profile', 'img', 'userProfile_id'),
+}
+
+IMAGE_CONTENT_TYPES = ('image/jpeg', 'image/png', 'image/webp', 'image/gif')
+MODEL_CONTENT_TYPES = ('application/octet-stream', 'model/gltf-binary', 'model/gltf+json', 'model/vnd.usdz+zip')
+
+# 対象ごとに受け付けるContent-Typeと、最大サイズ(設定名, 未設定時のバイト数)
+LIMITS = {
+    'post_photo': (IMAGE_CONTENT_TYPES, ('DIRECT_UPLOAD_MAX_IMAGE_SIZE', 20 * 1024 * 1024)),
+    'post_model': (MODEL_CONTENT_TYPES, ('DIRECT_UPLOAD_MAX_SIZE', 200 * 1024 * 1024)),
+    'avatar': (IMAGE_CONTENT_TYPES, ('DIRECT_UPLOAD_MAX_IMAGE_SIZE', 20 * 1024 * 1024)),
+}
+
+
+def expires_in():
+    return getattr(settings, 'DIRECT_UPLOAD_EXPIRES', 15 * 60)
+
+
+def get_backend():
+    path = getattr(settings, 'DIRECT_UPLOAD_BACKEND', None)
+    if not path:
+        gcs = getattr(settings, 'STORAGE_BACKEND', 'gcs') == 'gcs'
+        path = 'api.signed_uploads.GoogleCloudUploadBackend' if gcs else 'api.signed_uploads.LocalUploadBackend'
+    return import_string(path)()
+
+
+def max_size(target):
+    return getattr(settings, *LIMITS[target][1])
+
+
+def _get_owned_instance(target, pk, user_id):
+    label, field_name, owner_attr = TARGETS[target]
+    instance = apps.get_model(label).objects.filter(pk=pk).first()
+    if instance is None:
+        raise NotFound()
+    if getattr(instance, owner_attr) != user_id:
+        raise PermissionDenied('You can only upload files to your own {}.'.format(instance._meta.model_name))
+    return instance, field_name
+
+
+# アップロード先を発行する
+def issue(target, pk, filename, content_type, user_id, request):
+    instance, field_name = _get_owned_instance(target, pk, user_id)
+    if content_type not in LIMITS[target][0]:
+        raise ValidationError({'content_type': ['Unsupported content type: {}.'.format(content_type)]})
+    field_file = getattr(instance, field_name)
+    # ファイル名はフィールドのupload_to(upload_post_path/upload_model_path/upload_avatar_path)で決める
+    name = field_file.field.generate_filename(instance, filename)
+    token = signing.dumps(
+        {'t': target, 'pk': pk, 'n': name, 'u': user_id, 'c': content_type},
+        salt=TOKEN_SALT, compress=True,
+    )
+    upload = get_backend().upload_target(field_file.storage, name, content_type, max_size(target), token, request)
+    upload.update({'token': token, 'name': name, 'expires_in': expires_in()})
+    return upload
+
+
+def load_token(token):
+    try:
+        # 確認はPUTの後に行うので、URLの有効期間より少し長く受け付ける
+        return signing.loads(token, salt=TOKEN_SALT, max_age=expires_in() * 2)
+    except signing.BadSignature:
+        raise ValidationError({'token': ['Invalid or expired upload token.']})
+
+
+# アップロードされたファイルをモデルのフィールドに紐付ける
+def confirm(token, user_id):
+    payload = load_token(token)
+    if payload['u'] != user_id:
+        raise PermissionDenied()
+    instance, field_name = _get_owned_instance(payload['t'], payload['pk'], user_id)
+    storage = getattr(instance, field_name).storage
+    if not storage.exists(payload['n']):
+        raise ValidationError({'token': ['The file has not been uploaded yet.']})
+    # PUT先の制限をすり抜けたファイルは紐付けずに削除する(同じトークンでの再アップロードはできない)
+    error = _check_uploaded(storage, payload['n'], payload['t'])
+    if error:
+        storage.delete(payload['n'])
+        raise ValidationError({'token': [error]})
+
+    if getattr(instance, field_name).name != payload['n']:
+        # 保存済みのファイル名を設定するだけなので、保存時にストレージへの再アップロードは起きない
+        setattr(instance, field_name, payload['n'])
+        instance.save()
+    return instance
+
+
+def _check_uploaded(storage, name, target):
+    limit = max_size(target)
+    if not 0 < storage.size(name) <= limit:
+        return 'Size must be between 1 and {} bytes.'.format(limit)
+    if LIMITS[target][0] is IMAGE_CONTENT_TYPES:
+        with storage.open(name) as f:
+            if not images.is_valid_image(f):
+                return 'The uploaded file is not a valid image.'
+    return None
+
+
+class GoogleCloudUploadBackend:
+    def upload_target(self, storage, name, content_type, max_size, token, request):
+        blob = storage.bucket.blob(storage._normalize_name(name))
+        # 署名に含めるヘッダー(付けない・値の違うPUTはGCSに拒否される)
+        #   x-goog-content-length-range: 受け付けるサイズの範囲
+        #   x-goog-if-generation-match: 0 オブジェクトがまだない場合だけ作成する(確認後の上書きを防ぐ)
+        #   Cache-Control: ストレージから保存するファイルと同じ値
+        headers = {
+            'x-goog-content-length-range': '1,{}'.format(max_size),
+            'x-goog-if-generation-match': '0',
+        }
+        if storage.cache_control:
+            headers['Cache-Control'] = storage.cache_control
+        url = blob.generate_signed_url(
+            version='v4', method='PUT', content_type=content_type, headers=headers,
+            expiration=timedelta(seconds=expires_in()),
+        )
+        return {'url': url, 'method': 'PUT', 'headers': dict(headers, **{'Content-Type': content_type})}
+
+
+class LocalUploadBackend:
+    def upload_target(self, storage, name, content_type, max_size, token, request):
+        url = request.build_absolute_uri(reverse('user:uploadlocal', kwargs={'token': token}))
+        return {'url': url, 'method': 'PUT', 'headers': {'Content-Type': content_type}}
+
+    # /api/upload_local/<token>/ が受け取ったボディをストレージに保存する
+    def store(self, token, stream, content_length, content_type):
+        from django.core.files import File
+
+        payload = load_token(token)
+        label, field_name, _ = TARGETS[payload['t']]
+        storage = apps.get_model(label)._meta.get_field(field_name).storage
+        limit = max_size(payload['t'])
+        if content_length <= 0 or content_length > limit:
+            raise ValidationError({'Content-Length': ['Size must be between 1 and {} bytes.'.format(limit)]})
+        if content_type != payload['c']:
+            raise ValidationError({'Content-Type': ['Content-Type must be {}.'.format(payload['c'])]})
+        # 署名したファイル名のまま保存する(GCSのx-goog-if-generation-matchと同じく既存のファイルは上書きしない)
+        if storage.exists(payload['n']):
+            raise ValidationError({'token': ['The file has already been uploaded.']})
+        return storage.save(payload['n'], File(stream, name=payload['n']))
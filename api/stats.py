@@ -0,0 +1,200 @@
+from django.apps import apps as global_apps
+from django.db.models import Count, F, Max, Min, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.utils import timezone
+
+# 店舗ごとの集計値(RestaurantStats / RestaurantCategoryStats)の管理
+# 投稿の作成・更新・削除ではその投稿の分だけ加算・減算し(F式によるUPDATE)、
+# 最安値・最高値のように差分で戻せない値だけ対象店舗の投稿から集計し直す
+
+SCORES = (1, 2, 3, 4, 5)
+
+
+def _score_field(score):
+    return 'score_{}_count'.format(score)
+
+
+# 投稿1件分を店舗の集計値に加算(sign=1)・減算(sign=-1)する
+def _apply_post(restaurant_id, score, price, sign, apps=global_apps):
+    RestaurantStats = apps.get_model('api', 'RestaurantStats')
+    updates = {
+        'post_count': F('post_count') + sign,
+        'score_sum': F('score_sum') + sign * score,
+        'price_sum': F('price_sum') + sign * price,
+        # update()ではauto_nowが効かないため明示する(ランキングの差分更新で使う)
+        'updated_on': timezone.now(),
+    }
+    if score in SCORES:
+        updates[_score_field(score)] = F(_score_field(score)) + sign
+    if sign > 0:
+        updates['price_min'] = Least(Coalesce(F('price_min'), Value(price)), Value(price))
+        updates['price_max'] = Greatest(Coalesce(F('price_max'), Value(price)), Value(price))
+
+    updated = RestaurantStats.objects.filter(restaurant_id=restaurant_id).update(**updates)
+    if not updated and sign > 0:
+        # 集計行がまだない店舗は投稿から集計して作成する
+        # (減算時は作成しない。店舗の削除で投稿がまとめて削除される場合など)
+        refresh_restaurants([restaurant_id], apps=apps)
+    elif updated and sign < 0:
+        _refresh_price_range(restaurant_id, price, apps=apps)
+
+
+# 取り除いた値段が最安値・最高値だった場合だけ、その店舗の最安値・最高値を集計し直す
+def _refresh_price_range(restaurant_id, price, apps=global_apps):
+    Post = apps.get_model('api', 'Post')
+    RestaurantStats = apps.get_model('api', 'RestaurantStats')
+    prices = Post.objects.filter(restaurant_id=OuterRef('restaurant_id')).order_by().values('restaurant_id')
+    RestaurantStats.objects.filter(restaurant_id=restaurant_id).filter(
+        Q(price_min__gte=price) | Q(price_max__lte=price)
+    ).update(
+        price_min=Subquery(prices.annotate(value=Min('price')).values('value')),
+        price_max=Subquery(prices.annotate(value=Max('price')).values('value')),
+    )
+
+
+# 店舗×カテゴリーの集計値に投稿を加算・減算する
+# カテゴリーの数によらず、UPDATE 1回(加算時は既存の行の確認とまとめてのINSERTを加えて3回)で済ませる
+def _apply_categories(restaurant_id, category_ids, score, sign, apps=global_apps):
+    RestaurantCategoryStats = apps.get_model('api', 'RestaurantCategoryStats')
+    category_ids = set(category_ids)
+    if not category_ids:
+        return
+    queryset = RestaurantCategoryStats.objects.filter(restaurant_id=restaurant_id, category_id__in=category_ids)
+    missing = set()
+    if sign > 0:
+        missing = category_ids - set(queryset.values_list('category_id', flat=True))
+    if missing != category_ids:
+        queryset.update(
+            post_count=F('post_count') + sign, score_sum=F('score_sum') + sign * score, updated_on=timezone.now()
+        )
+    if missing:
+        RestaurantCategoryStats.objects.bulk_create([
+            RestaurantCategoryStats(restaurant_id=restaurant_id, category_id=category_id, post_count=1, score_sum=score)
+            for category_id in sorted(missing)
+        ])
+
+
+def post_saved(post, created):
+    if created:
+        _apply_post(post.restaurant_id, int(post.score), post.price, 1)
+        return
+    # 読み込んでいない(only/defer)フィールドは保存されないので変更なしとして扱う
+    if not post.has_changed('restaurant_id', 'score', 'price'):
+        return
+    loaded = getattr(post, '_loaded_values', None)
+    if loaded is None or not all(attname in loaded for attname in ('restaurant_id', 'score', 'price')):
+        # 変更前の値が分からない場合(.only()/.defer()で読み込んでいないフィールドがある場合も)はその店舗を集計し直す
+        refresh_restaurants({post.restaurant_id, (loaded or {}).get('restaurant_id', post.restaurant_id)})
+        return
+    score, price = int(post.score), post.price
+
+    old_restaurant_id = post.loaded_value('restaurant_id')
+    old_score = int(post.loaded_value('score'))
+    old_price = post.loaded_value('price')
+    _apply_post(old_restaurant_id, old_score, old_price, -1)
+    _apply_post(post.restaurant_id, score, price, 1)
+    if post.has_changed('restaurant_id', 'score'):
+        category_ids = list(post.category.values_list('id', flat=True))
+        _apply_categories(old_restaurant_id, category_ids, old_score, -1)
+        _apply_categories(post.restaurant_id, category_ids, score, 1)
+
+
+# category_idsは削除前(pre_delete)に取得しておいた投稿のカテゴリー
+def post_deleted(post, category_ids):
+    score = int(post.score)
+    _apply_post(post.restaurant_id, score, post.price, -1)
+    _apply_categories(post.restaurant_id, category_ids, score, -1)
+
+
+# 投稿とカテゴリーの紐付けの追加・削除(post.category.add/remove/set、category.posts.add/removeの両方向)
+def post_categories_changed(post_ids, category_ids, sign):
+    from .models import Post
+
+    for post in Post.objects.filter(id__in=post_ids).only('id', 'restaurant_id', 'score'):
+        _apply_categories(post.restaurant_id, category_ids, int(post.score), sign)
+
+
+# 指定した店舗の集計値を投稿から集計し直す(最初の作成、bulk操作・店舗の統合の後など)
+def refresh_restaurants(restaurant_ids, apps=global_apps):
+    Post = apps.get_model('api', 'Post')
+    RestaurantStats = apps.get_model('api', 'RestaurantStats')
+    RestaurantCategoryStats = apps.get_model('api', 'RestaurantCategoryStats')
+    restaurant_ids = list(restaurant_ids)
+
+    rows = {
+        row['restaurant_id']: row
+        for row in _aggregate_posts(Post.objects.filter(restaurant_id__in=restaurant_ids))
+    }
+    RestaurantStats.objects.filter(restaurant_id__in=restaurant_ids).delete()
+    RestaurantStats.objects.bulk_create(
+        [_stats_from_row(RestaurantStats, restaurant_id, rows.get(restaurant_id)) for restaurant_id in restaurant_ids]
+    )
+
+    RestaurantCategoryStats.objects.filter(restaurant_id__in=restaurant_ids).delete()
+    RestaurantCategoryStats.objects.bulk_create(
+        _category_stats(Post, RestaurantCategoryStats, Q(post__restaurant_id__in=restaurant_ids))
+    )
+
+
+# 全店舗の集計値を作り直す(manage.py rebuild_restaurant_stats)
+def rebuild_all(batch_size=1000, apps=global_apps):
+    Post = apps.get_model('api', 'Post')
+    Restaurant = apps.get_model('api', 'Restaurant')
+    RestaurantStats = apps.get_model('api', 'RestaurantStats')
+    RestaurantCategoryStats = apps.get_model('api', 'RestaurantCategoryStats')
+
+    rows = {row['restaurant_id']: row for row in _aggregate_posts(Post.objects.all())}
+    RestaurantStats.objects.all().delete()
+    batch = []
+    count = 0
+    for restaurant_id in Restaurant.objects.values_list('id', flat=True).iterator(chunk_size=batch_size):
+        batch.append(_stats_from_row(RestaurantStats, restaurant_id, rows.get(restaurant_id)))
+        if len(batch) >= batch_size:
+            RestaurantStats.objects.bulk_create(batch)
+            count += len(batch)
+            batch = []
+    RestaurantStats.objects.bulk_create(batch)
+    count += len(batch)
+
+    RestaurantCategoryStats.objects.all().delete()
+    # 1回のINSERTの行数はDBに合わせてDjangoが決める(SQLiteはbatch_sizeを明示すると上限を超えることがある)
+    RestaurantCategoryStats.objects.bulk_create(_category_stats(Post, RestaurantCategoryStats, Q()))
+    return count
+
+
+# 店舗ごとに1回のGROUP BYでまとめて集計する
+def _aggregate_posts(queryset):
+    annotations = {
+        'post_count': Count('id'),
+        'score_sum': Sum('score'),
+        'price_sum': Sum('price'),
+        'price_min': Min('price'),
+        'price_max': Max('price'),
+    }
+    for score in SCORES:
+        annotations[_score_field(score)] = Count('id', filter=Q(score=score))
+    return queryset.order_by().values('restaurant_id').annotate(**annotations)
+
+
+def _stats_from_row(model, restaurant_id, row):
+    if row is None:
+        return model(restaurant_id=restaurant_id)
+    values = dict(row)
+    values['restaurant_id'] = restaurant_id
+    return model(**values)
+
+
+def _category_stats(Post, model, condition):
+    rows = (
+        Post.category.through.objects.filter(condition)
+        .order_by()
+        .values('post__restaurant_id', 'category_id')
+        .annotate(post_count=Count('post_id'), score_sum=Sum('post__score'))
+    )
+    return [
+        model(
+            restaurant_id=row['post__restaurant_id'], category_id=row['category_id'],
+            post_count=row['post_count'], score_sum=row['score_sum'],
+        )
+        for row in rows
+    ]
@@ -0,0 +1,101 @@
+import os
+import posixpath
+import re
+import threading
+
+from django.conf import settings
+
+# メディアファイルのストレージ(settings.STORAGE_BACKEND)
+#   gcs    : api.storage.gcs.GoogleCloudStorage(本番)
+#   local  : FileSystemStorage(MEDIA_ROOT、開発用)
+#   memory : api.storage.memory.InMemoryStorage(テスト・ベンチマーク用)
+# GCSの認証情報は設定の読み込み時ではなく、最初にGCSのクライアントを使う時に読み込む
+# (google.oauth2のimportと鍵ファイルの解析がワーカーの起動・管理コマンドの実行のたびにかかっていたため)
+# どのストレージも、内容のハッシュを名前に含むファイル(api.models.upload_post_path等)は重複して保存しない(DeduplicateMixin)
+
+# 内容のSHA-256から決めた名前(縮小版の '<ハッシュ>.w320.webp' も含む)
+CONTENT_ADDRESSED_RE = re.compile(r'(?:^|/)[0-9a-f]{64}(?:\.[^/]*)?$')
+
+_credentials = None
+_credentials_loaded = False
+_credentials_lock = threading.Lock()
+
+
+# GCSの認証情報(サービスアカウント)
+# GS_CREDENTIALS_JSON(鍵のJSONそのもの) → GS_CREDENTIALS_FILE(鍵ファイル)の順に探し、
+# どちらもなければNone(Application Default Credentials)を返す
+def get_credentials():
+    global _credentials, _credentials_loaded
+    if _credentials_loaded:
+        return _credentials
+    with _credentials_lock:
+        if not _credentials_loaded:
+            _credentials = _load_credentials()
+            _credentials_loaded = True
+    return _credentials
+
+
+def _load_credentials():
+    info = getattr(settings, 'GS_CREDENTIALS_JSON', None)
+    path = getattr(settings, 'GS_CREDENTIALS_FILE', None)
+    if not info and not (path and os.path.exists(path)):
+        return None
+    import json
+    from google.oauth2 import service_account
+    if info:
+        return service_account.Credentials.from_service_account_info(json.loads(info))
+    return service_account.Credentials.from_service_account_file(path)
+
+
+# 設定を変えた時(テスト)に認証情報を読み込み直す
+def reset_credentials():
+    global _credentials, _credentials_loaded
+    with _credentials_lock:
+        _credentials, _credentials_loaded = None, False
+
+
+def is_content_addressed(name):
+    return bool(name) and CONTENT_ADDRESSED_RE.search(name) is not None
+
+
+# 内容から決めた名前のファイルは同じ名前なら内容も同じなので、保存済みならアップロードせずにその名前を返す
+# その際にファイルの更新日時を今にして、掃除(api.media.collect_garbage)のmin_ageの間は消されないようにする
+# (古い参照がなくなって掃除の対象になっていたファイルを、新しい行が参照し直す場合があるため)
+# 確認から更新までの間に消された場合は、通常通りアップロードし直す
+class DeduplicateMixin:
+    def save(self, name, content, max_length=None):
+        if is_content_addressed(name) and self.exists(name) and self.touch(name):
+            return name
+        return super().save(name, content, max_length=max_length)
+
+    # ファイルの更新日時を今にする(ファイルがなければFalse)
+    def touch(self, name):
+        raise NotImplementedError('subclasses of DeduplicateMixin must provide a touch() method')
+
+
+# prefix以下のファイルを [(名前, サイズ, 更新日時), ...] のページごとに返す(api.mediaの掃除用)
+# ストレージにlist_pagesがあればそれを使い(GCSのバケットの一覧のページ)、なければlistdirでディレクトリを順にたどる
+def list_files(storage, prefix='', page_size=1000):
+    list_pages = getattr(storage, 'list_pages', None)
+    if list_pages is not None:
+        yield from list_pages(prefix, page_size)
+        return
+    page = []
+    for name in _walk(storage, prefix.strip('/')):
+        page.append((name, storage.size(name), storage.get_modified_time(name)))
+        if len(page) >= page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def _walk(storage, path):
+    try:
+        directories, files = storage.listdir(path)
+    except FileNotFoundError:
+        return
+    for file_name in files:
+        yield posixpath.join(path, file_name) if path else file_name
+    for directory in directories:
+        yield from _walk(storage, posixpath.join(path, directory) if path else directory)
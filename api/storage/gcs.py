@@ -0,0 +1,66 @@
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.encoding import filepath_to_uri
+from google.cloud.exceptions import NotFound
+from storages.backends import gcloud
+from storages.utils import clean_name, setting
+
+from . import DeduplicateMixin, get_credentials
+
+
+# django-storagesのGoogleCloudStorageで、認証情報(GS_CREDENTIALS)を最初にクライアントを作る時に読み込むもの
+# (バケットへのアクセス・署名付きURLの作成の直前まで鍵ファイルを読まない)
+# ファイルのURLは公開バケット(またはCDN)のMEDIA_URL + ファイル名にする。GS_QUERYSTRING_AUTHの場合は署名付きURL
+# (署名付きURLはリクエストごとに変わるためCDN・ブラウザにキャッシュされず、1件ごとに署名の計算もかかる)
+class GoogleCloudStorage(DeduplicateMixin, gcloud.GoogleCloudStorage):
+    querystring_auth = setting('GS_QUERYSTRING_AUTH', False)
+
+    @property
+    def client(self):
+        if self._client is None and self.credentials is None:
+            self.credentials = get_credentials()
+        return super().client
+
+    def url(self, name):
+        if self.querystring_auth:
+            return super().url(name)
+        return urljoin(settings.MEDIA_URL, filepath_to_uri(self._normalize_name(clean_name(name))))
+
+    # prefix以下のファイルをバケットの一覧のページごとに返す(api.storage.list_files)
+    # 1ページの件数はpage_size(APIの上限は1000件)。一覧には名前・サイズ・更新日時だけを含めさせる
+    def list_pages(self, prefix='', page_size=1000):
+        offset = len(self.location.strip('/')) + 1 if self.location.strip('/') else 0
+        blobs = self.bucket.list_blobs(
+            prefix=self._normalize_name(clean_name(prefix)) if prefix else self.location,
+            fields='items(name,size,updated),nextPageToken',
+        )
+        # list_blobsのmax_resultsは全体の件数なので、ページの件数はリクエストのmaxResultsで指定する
+        blobs.extra_params['maxResults'] = page_size
+        for page in blobs.pages:
+            yield [(blob.name[offset:], blob.size, blob.updated) for blob in page]
+
+    # FileSystemStorageと同じく、存在しないファイルの削除はエラーにしない
+    def delete(self, name):
+        try:
+            super().delete(name)
+        except NotFound:
+            pass
+
+    # FileSystemStorageと同じく、存在しないファイルはFileNotFoundError
+    def get_modified_time(self, name):
+        try:
+            return super().get_modified_time(name)
+        except NotFound:
+            raise FileNotFoundError(name)
+
+    # メタデータを書き換えてオブジェクトの更新日時(updated)を今にする
+    def touch(self, name):
+        blob = self.bucket.blob(self._normalize_name(clean_name(name)))
+        blob.metadata = {'touched-at': timezone.now().isoformat()}
+        try:
+            blob.patch()
+        except NotFound:
+            return False
+        return True
@@ -0,0 +1,86 @@
+import threading
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import filepath_to_uri
+
+from . import DeduplicateMixin
+
+
+# プロセスのメモリにファイルを保存するストレージ(テスト・ベンチマーク用。プロセスを終了すると消える)
+# ファイル名(/区切り)ごとに(内容, 保存日時)を持つ
+@deconstructible
+class InMemoryStorage(DeduplicateMixin, Storage):
+    def __init__(self, base_url=None):
+        self.base_url = base_url
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def _open(self, name, mode='rb'):
+        with self._lock:
+            content, _ = self._entry(name)
+        return ContentFile(content, name=name)
+
+    def _save(self, name, content):
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        data = content.read()
+        if isinstance(data, str):
+            data = data.encode()
+        with self._lock:
+            self._files[name] = (data, timezone.now())
+        return name
+
+    def exists(self, name):
+        with self._lock:
+            return name in self._files
+
+    def delete(self, name):
+        with self._lock:
+            self._files.pop(name, None)
+
+    def touch(self, name):
+        with self._lock:
+            if name not in self._files:
+                return False
+            self._files[name] = (self._files[name][0], timezone.now())
+        return True
+
+    def size(self, name):
+        with self._lock:
+            return len(self._entry(name)[0])
+
+    def listdir(self, path):
+        prefix = path.strip('/') + '/' if path.strip('/') else ''
+        directories, files = set(), []
+        with self._lock:
+            names = list(self._files)
+        for name in names:
+            if not name.startswith(prefix):
+                continue
+            head, sep, tail = name[len(prefix):].partition('/')
+            if sep:
+                directories.add(head)
+            else:
+                files.append(head)
+        return sorted(directories), sorted(files)
+
+    def url(self, name):
+        base_url = self.base_url if self.base_url is not None else settings.MEDIA_URL
+        return urljoin(base_url, filepath_to_uri(name))
+
+    def get_modified_time(self, name):
+        with self._lock:
+            return self._entry(name)[1]
+
+    get_created_time = get_accessed_time = get_modified_time
+
+    def _entry(self, name):
+        try:
+            return self._files[name]
+        except KeyError:
+            raise FileNotFoundError(name)
@@ -0,0 +1,30 @@
+# テスト用のヘルパー
+# MetricsMiddleware(api.metrics)がレスポンスに付けた計測結果から、エンドポイントのクエリ数が
+# ビューのquery_budgetを超えていないかを確認する(N+1のクエリの混入を防ぐ)
+#
+#   class PostListTests(QueryBudgetTestMixin, APITestCase):
+#       def test_post_list(self):
+#           self.assertWithinQueryBudget(self.client.get('/api/post_list/'))
+
+
+def assert_within_query_budget(response, budget=None):
+    metrics = getattr(response, 'metrics', None)
+    if metrics is None:
+        raise AssertionError('Response has no metrics; is api.metrics.MetricsMiddleware installed?')
+    budget = budget if budget is not None else metrics.query_budget
+    if budget is None:
+        raise AssertionError('{} does not declare a query_budget.'.format(metrics.view))
+    if metrics.queries > budget:
+        raise AssertionError('{} ran {} queries (budget {}):\n{}'.format(
+            metrics.view, metrics.queries, budget,
+            '\n'.join('{}. {}'.format(index, sql) for index, sql in enumerate(metrics.statements, start=1)),
+        ))
+    return metrics.queries
+
+
+class QueryBudgetTestMixin:
+    def assertWithinQueryBudget(self, response, budget=None):
+        try:
+            return assert_within_query_budget(response, budget)
+        except AssertionError as exc:
+            self.fail(str(exc))
@@ -1,3 +1,1366 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import Permission
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import autocomplete, bulk, cache, connections, geo, media, rankings, restaurants, search, stats, storage, uploads
+from .authentication import CachedTokenUser, get_user_state
+from .models import (
+    Category, ChunkedUpload, Post, Profile, RankingEntry, Restaurant, RestaurantCategoryStats, RestaurantStats, User,
+)
+from .testing import QueryBudgetTestMixin
+
+
+# テスト用のデータ: ユーザー1人・店舗1件・カテゴリーcategories件と、投稿count件
+# 投稿のカテゴリーは先頭から (番号 % categories) + 1 件
+def create_posts(count, categories=3):
+    user = User.objects.create_user('author@example.com', 'password')
+    restaurant = Restaurant.objects.create(name='Sushi Dai', location='Tokyo Tsukiji')
+    category_list = [Category.objects.create(name='category{}'.format(index)) for index in range(categories)]
+    posts = []
+    for index in range(count):
+        post = Post.objects.create(
+            author=user, restaurant=restaurant, menu_item='item{}'.format(index),
+            score=(index % 5) + 1, price=100 * index, review_text='good {}'.format(index),
+        )
+        post.category.set(category_list[:(index % categories) + 1])
+        posts.append(post)
+    return user, restaurant, category_list, posts
+
+
+def png(color=(255, 0, 0), size=(400, 300)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+# 集計(RestaurantStats・RestaurantCategoryStats)の全件
+def stats_snapshot():
+    restaurant_stats = sorted(RestaurantStats.objects.values_list(
+        'restaurant_id', 'post_count', 'score_sum', 'price_sum', 'price_min', 'price_max',
+        'score_1_count', 'score_2_count', 'score_3_count', 'score_4_count', 'score_5_count',
+    ))
+    category_stats = sorted(RestaurantCategoryStats.objects.filter(post_count__gt=0).values_list(
+        'restaurant_id', 'category_id', 'post_count', 'score_sum',
+    ))
+    return restaurant_stats, category_stats
+
+
+# メディアファイル・分割アップロードの一時ファイルをテストごとの一時ディレクトリに保存する
+class TempMediaMixin:
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.media_settings = override_settings(
+            DEFAULT_FILE_STORAGE='api.storage.local.FileSystemStorage', MEDIA_ROOT=self.media_root,
+            CHUNKED_UPLOAD_DIR=os.path.join(self.media_root, 'chunked_uploads'), IMAGE_PIPELINE_SYNC=True,
+        )
+        self.media_settings.enable()
+
+    def tearDown(self):
+        self.media_settings.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        super().tearDown()
+
+
+class CacheClearMixin:
+    # レスポンスキャッシュのバージョンはテストをまたいで残るので、テストごとに消す
+    def setUp(self):
+        super().setUp()
+        caches[settings.API_CACHE_ALIAS].clear()
+
+
+@override_settings(API_CACHE_ENABLED=False)
+class QueryBudgetTests(QueryBudgetTestMixin, TestCase):
+    # 投稿の件数が増えてもクエリ数がビューのquery_budgetを超えない(N+1のクエリがない)
+    def test_read_endpoints_within_budget(self):
+        user, restaurant, categories, posts = create_posts(8)
+        Profile.objects.create(userProfile=user, nickName='author')
+        client = APIClient()
+        for url in ('/api/post_list/', '/api/restaurant/', '/api/category/', '/api/profile/',
+                    '/api/post_detail/{}/'.format(posts[0].id), '/api/restaurant/{}/'.format(restaurant.id)):
+            self.assertWithinQueryBudget(client.get(url))
+        client.force_authenticate(user)
+        self.assertWithinQueryBudget(client.get('/api/myprofile/'))
+
+    def test_server_timing_header(self):
+        response = APIClient().get('/api/category/')
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertEqual(response.metrics.view, 'user:category-list')
+
+
+class MetricsViewTests(TestCase):
+    def test_requires_token_or_staff(self):
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'api_requests_total', response.content)
+
+        staff = User.objects.create_user('staff@example.com', 'password')
+        staff.is_staff = True
+        staff.save()
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+@override_settings(API_CACHE_ENABLED=False)
+class PostListPaginationTests(QueryBudgetTestMixin, TestCase):
+    def test_cursor_pages_cover_all_posts_in_order(self):
+        create_posts(25)
+        client = APIClient()
+        response = client.get('/api/post_list/', {'page_size': 10})
+        self.assertWithinQueryBudget(response)
+        self.assertEqual(len(response.data['results']), 10)
+        ids = [post['id'] for post in response.data['results']]
+        while response.data['next']:
+            response = client.get(response.data['next'])
+            self.assertWithinQueryBudget(response)
+            ids += [post['id'] for post in response.data['results']]
+        self.assertEqual(ids, sorted(ids, reverse=True))
+        self.assertEqual(len(ids), 25)
+
+    # 1ページ目を読んだ後に投稿が増えても、次のページがずれない
+    def test_new_post_does_not_shift_next_page(self):
+        user, restaurant, categories, posts = create_posts(6)
+        client = APIClient()
+        first = client.get('/api/post_list/', {'page_size': 3})
+        new_post = Post.objects.create(author=user, restaurant=restaurant, menu_item='new', score=3, price=100)
+        new_post.category.set(categories[:1])
+        second = client.get(first.data['next'])
+        self.assertEqual([post['id'] for post in second.data['results']], [post.id for post in posts[2::-1]])
+
+    def test_previous_page(self):
+        create_posts(6)
+        client = APIClient()
+        first = client.get('/api/post_list/', {'page_size': 4})
+        second = client.get(first.data['next'])
+        self.assertEqual(client.get(second.data['previous']).data['results'], first.data['results'])
+
+
+@override_settings(API_CACHE_ENABLED=False)
+class PostSearchTests(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.restaurant = Restaurant.objects.create(name='Menya', location='Kyoto')
+        self.category = Category.objects.create(name='noodles')
+
+    def create_post(self, menu_item, review_text=''):
+        post = Post.objects.create(author=self.user, restaurant=self.restaurant, menu_item=menu_item,
+                                   score=3, price=800, review_text=review_text)
+        post.category.set([self.category])
+        return post
+
+    def search(self, query):
+        response = APIClient().get('/api/post/search/', {'q': query})
+        self.assertWithinQueryBudget(response)
+        return [post['id'] for post in response.data['results']]
+
+    # 語を多く含む投稿が先に並ぶ(SQLiteはFTS5のbm25、Postgresはpg_trgmのsimilarity)
+    def test_ranked_by_relevance(self):
+        weak = self.create_post('tonkotsu', 'a long review that mentions ramen once among many other words here')
+        strong = self.create_post('ramen', 'ramen ramen')
+        self.create_post('udon', 'no match')
+        self.assertEqual(self.search('ramen'), [strong.id, weak.id])
+
+    # 全角・大文字の違いを吸収し、全ての語を含む投稿だけを返す
+    def test_normalized_and_all_terms(self):
+        both = self.create_post('Miso Ramen', 'rich broth')
+        self.create_post('Shoyu Ramen', 'light broth')
+        self.assertEqual(self.search('ＭＩＳＯ ramen'), [both.id])
+        self.assertEqual(self.search('kyoto miso'), [both.id])
+
+    # トライグラムより短い語はLIKEで検索する(新しい順)
+    def test_short_terms_use_like(self):
+        older = self.create_post('ax special')
+        newer = self.create_post('ax deluxe')
+        self.create_post('bx special')
+        self.assertEqual(search.search_post_ids('ax', 10).ids, [newer.id, older.id])
+        self.assertEqual(self.search('ax special'), [older.id])
+
+    def test_search_document_follows_restaurant_rename(self):
+        post = self.create_post('gyoza')
+        self.restaurant.name = 'Gyoza Oh'
+        self.restaurant.save()
+        self.assertIn(post.id, self.search('gyoza oh'))
+
+    def test_query_required(self):
+        self.assertEqual(APIClient().get('/api/post/search/', {'q': ' '}).status_code, 400)
+
+
+class RestaurantStatsTests(QueryBudgetTestMixin, TestCase):
+    # 投稿の追加・変更・削除・カテゴリーの変更で更新した集計が、全件から作り直した集計と一致する
+    def test_incremental_updates_match_rebuild(self):
+        user, restaurant, categories, posts = create_posts(10)
+        other = Restaurant.objects.create(name='Other', location='Osaka')
+        posts[3].price, posts[3].score = 99999, 1
+        posts[3].save()
+        moved = Post.objects.get(pk=posts[4].pk)
+        moved.restaurant = other
+        moved.save()
+        posts[0].delete()
+        Post.objects.get(pk=posts[9].pk).delete()
+        posts[5].category.remove(categories[0])
+        posts[6].category.clear()
+        categories[2].posts.add(posts[7], posts[8])
+        posts[1].category.set([categories[1], categories[2]])
+
+        incremental = stats_snapshot()
+        call_command('rebuild_restaurant_stats', stdout=io.StringIO())
+        self.assertEqual(stats_snapshot(), incremental)
+        self.assertEqual(RestaurantStats.objects.get(restaurant=restaurant).post_count, 7)
+
+    # only()で読み込んだ投稿の保存では、読み込んでいない値を変更前の値として扱わない
+    def test_deferred_save_keeps_stats(self):
+        user, restaurant, categories, posts = create_posts(3)
+        before = stats_snapshot()
+        post = Post.objects.only('id', 'menu_item').get(pk=posts[0].pk)
+        post.menu_item = 'renamed'
+        post.save()
+        self.assertEqual(stats_snapshot(), before)
+
+        post = Post.objects.only('id', 'score').get(pk=posts[1].pk)
+        post.score = 5
+        post.save()
+        incremental = stats_snapshot()
+        stats.rebuild_all()
+        self.assertEqual(stats_snapshot(), incremental)
+
+    @override_settings(API_CACHE_ENABLED=False)
+    def test_stats_in_restaurant_response(self):
+        user, restaurant, categories, posts = create_posts(5)
+        response = APIClient().get('/api/restaurant/{}/'.format(restaurant.id))
+        self.assertWithinQueryBudget(response)
+        self.assertEqual(response.data['stats']['post_count'], 5)
+        self.assertEqual(response.data['stats']['price_min'], 0)
+        self.assertEqual(response.data['stats']['price_max'], 400)
+        self.assertEqual(response.data['stats']['score_histogram'], {'1': 1, '2': 1, '3': 1, '4': 1, '5': 1})
+
+    def test_restaurant_delete_removes_stats(self):
+        user, restaurant, categories, posts = create_posts(2)
+        restaurant.delete()
+        self.assertFalse(RestaurantStats.objects.filter(restaurant_id=restaurant.id).exists())
+
+
+@override_settings(API_CACHE_ENABLED=True)
+class ResponseCacheTests(CacheClearMixin, TestCase):
+    def test_cached_until_post_changes(self):
+        user, restaurant, categories, posts = create_posts(3)
+        client = APIClient()
+        first = client.get('/api/post_list/')
+        with self.assertNumQueries(0):
+            second = client.get('/api/post_list/')
+        self.assertEqual(first.content, second.content)
+        with self.assertNumQueries(0):
+            not_modified = client.get('/api/post_list/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+        posts[0].menu_item = 'changed'
+        posts[0].save()
+        response = client.get('/api/post_list/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('changed', [post['menu_item'] for post in response.json()['results']])
+
+    def test_expanded_posts_follow_restaurant_and_profile_changes(self):
+        user, restaurant, categories, posts = create_posts(2)
+        profile = Profile.objects.create(userProfile=user, nickName='before')
+        client = APIClient()
+        url = '/api/post_list/?expand=restaurant,author_profile'
+        client.get(url)
+        restaurant.name = 'Renamed'
+        restaurant.save()
+        profile.nickName = 'after'
+        profile.save()
+        result = client.get(url).json()['results'][0]
+        self.assertEqual(result['restaurant']['name'], 'Renamed')
+        self.assertEqual(result['author_profile']['nickName'], 'after')
+
+    def test_restaurant_stats_follow_post_delete(self):
+        user, restaurant, categories, posts = create_posts(4)
+        client = APIClient()
+        client.get('/api/restaurant/')
+        posts[0].delete()
+        self.assertEqual(client.get('/api/restaurant/').json()[0]['stats']['post_count'], 3)
+
+    def test_write_through_api_invalidates(self):
+        create_posts(1)
+        client = APIClient()
+        self.assertEqual(len(client.get('/api/category/').json()), 3)
+        self.assertEqual(client.post('/api/category/', {'name': 'new'}).status_code, 201)
+        self.assertEqual(len(client.get('/api/category/').json()), 4)
+
+    # 認証ヘッダーのあるリクエストはキャッシュしない
+    def test_authenticated_requests_bypass_cache(self):
+        user, restaurant, categories, posts = create_posts(1)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='JWT {}'.format(AccessToken.for_user(user)))
+        response = client.get('/api/category/')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+
+@override_settings(API_CACHE_ENABLED=True)
+class CacheInvalidationCommitTests(CacheClearMixin, TransactionTestCase):
+    # トランザクション内ではすぐにバージョンを上げ、確定時にもう一度上げる
+    def test_invalidate_bumps_again_on_commit(self):
+        before, = cache.get_versions(['post'])
+        with transaction.atomic():
+            cache.invalidate('post')
+            during, = cache.get_versions(['post'])
+        after, = cache.get_versions(['post'])
+        self.assertEqual((during, after), (before + 1, before + 2))
+
+
+@override_settings(API_CACHE_ENABLED=False)
+class JWTAuthenticationTests(CacheClearMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {}'.format(AccessToken.for_user(self.user)))
+
+    def token_user(self, user):
+        token = AccessToken.for_user(user)
+        return CachedTokenUser(token, get_user_state(user.pk))
+
+    # ユーザーの状態はキャッシュするので、認証でユーザーの行を読まない
+    def test_authenticated_request_skips_user_query(self):
+        self.client.get('/api/myprofile/')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/api/myprofile/').status_code, 200)
+        response = self.client.post('/api/profile/', {'nickName': 'nick'})
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(Profile.objects.get().userProfile_id, self.user.pk)
+
+    # 無効化・削除はシグナルでキャッシュを消すのですぐに反映される
+    def test_inactive_and_deleted_users_are_rejected(self):
+        self.assertEqual(self.client.get('/api/myprofile/').status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/myprofile/').status_code, 401)
+        self.user.is_active = True
+        self.user.save()
+        self.assertEqual(self.client.get('/api/myprofile/').status_code, 200)
+        self.user.delete()
+        self.assertEqual(self.client.get('/api/myprofile/').status_code, 401)
+
+    def test_token_user_delegates_to_db_user(self):
+        token_user = self.token_user(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual((token_user.pk, token_user.is_active, token_user.is_staff), (self.user.pk, True, False))
+            self.assertTrue(token_user.is_authenticated)
+        self.assertEqual(token_user.get_username(), 'author@example.com')
+        self.assertEqual(token_user.email, 'author@example.com')
+        self.assertEqual(token_user, self.user)
+        self.assertEqual(len({token_user, self.token_user(self.user)}), 1)
+
+        self.assertFalse(token_user.has_perm('api.change_post'))
+        self.user.user_permissions.add(Permission.objects.get(codename='change_post'))
+        token_user = self.token_user(self.user)
+        self.assertTrue(token_user.has_perm('api.change_post'))
+        self.assertTrue(token_user.has_perms(['api.change_post']))
+        self.assertTrue(token_user.has_module_perms('api'))
+        self.assertEqual(list(token_user.user_permissions.values_list('codename', flat=True)), ['change_post'])
+
+        token_user.email = 'renamed@example.com'
+        token_user.save()
+        self.assertEqual(User.objects.get(pk=self.user.pk).email, 'renamed@example.com')
+
+    def test_superuser_has_all_permissions_without_query(self):
+        admin = User.objects.create_superuser('admin@example.com', 'password')
+        token_user = self.token_user(admin)
+        with self.assertNumQueries(0):
+            self.assertTrue(token_user.has_perm('api.delete_post'))
+            self.assertTrue(token_user.has_perms(['api.add_post', 'api.delete_post']))
+            self.assertTrue(token_user.has_module_perms('api'))
+
+
+@override_settings(API_CACHE_ENABLED=False, CHUNKED_UPLOAD_MAX_CHUNK_SIZE=1000)
+class ChunkedUploadTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user, self.restaurant, self.categories, self.posts = create_posts(1)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.data = os.urandom(2500)
+
+    def start(self, filename='dish.glb'):
+        response = self.client.post('/api/model_upload/', {
+            'post': self.posts[0].id, 'filename': filename, 'size': len(self.data),
+        })
+        self.assertEqual(response.status_code, 201, response.data)
+        return '/api/model_upload/{}/'.format(response.data['id'])
+
+    def put(self, url, start, end):
+        return self.client.generic(
+            'PUT', url, self.data[start:end], content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE='bytes {}-{}/{}'.format(start, end - 1, len(self.data)),
+        )
+
+    def test_resume_and_finalize(self):
+        url = self.start()
+        self.assertEqual(self.put(url, 0, 1000).data['offset'], 1000)
+        # 中断後はGETでoffsetを確認し、そこから続きを送る
+        self.assertEqual(self.client.get(url).data['offset'], 1000)
+        self.assertEqual(self.put(url, 1000, 2000).data['offset'], 2000)
+        self.assertEqual(self.put(url, 2000, 2500).data['offset'], 2500)
+
+        response = self.client.post(url + 'finalize/', {'sha256': hashlib.sha256(self.data).hexdigest()})
+        self.assertEqual(response.status_code, 200, response.data)
+        post = Post.objects.get(pk=self.posts[0].pk)
+        with post.menu_item_model.open('rb') as model_file:
+            self.assertEqual(model_file.read(), self.data)
+        self.assertEqual(ChunkedUpload.objects.get().status, ChunkedUpload.STATUS_COMPLETE)
+        # 一時ファイル(.part・.chunk)は残らない
+        self.assertEqual(os.listdir(uploads.staging_dir()), [])
+
+    def test_offset_mismatch_returns_current_offset(self):
+        url = self.start()
+        self.put(url, 0, 1000)
+        response = self.put(url, 0, 1000)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['offset'], 1000)
+        self.assertEqual(self.put(url, 2000, 2500).status_code, 409)
+        # 上限を超えるチャンクは受け付けず、offsetも進まない
+        self.assertEqual(self.put(url, 1000, 2500).status_code, 400)
+        self.assertEqual(self.client.get(url).data['offset'], 1000)
+        self.assertEqual(os.path.getsize(uploads.staging_path(ChunkedUpload.objects.get())), 1000)
+
+    def test_finalize_checks_size_and_checksum(self):
+        url = self.start()
+        self.put(url, 0, 1000)
+        self.assertEqual(self.client.post(url + 'finalize/', {'sha256': 'x'}).status_code, 400)
+        self.put(url, 1000, 2000)
+        self.put(url, 2000, 2500)
+        response = self.client.post(url + 'finalize/', {'sha256': hashlib.sha256(b'other').hexdigest()})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('sha256', response.data)
+        self.assertFalse(Post.objects.get(pk=self.posts[0].pk).menu_item_model)
+
+    def test_only_model_files_are_accepted(self):
+        for filename in ('dish.GLB', 'dish.gltf', 'dish.usdz'):
+            self.start(filename)
+        for filename in ('dish.exe', 'dish.glb.html', 'dish'):
+            response = self.client.post('/api/model_upload/', {
+                'post': self.posts[0].id, 'filename': filename, 'size': len(self.data),
+            })
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('filename', response.data)
+
+    def test_other_users_cannot_upload(self):
+        url = self.start()
+        other = User.objects.create_user('other@example.com', 'password')
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.put(url, 0, 1000).status_code, 404)
+        response = self.client.post('/api/model_upload/', {
+            'post': self.posts[0].id, 'filename': 'dish.glb', 'size': len(self.data),
+        })
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(API_CACHE_ENABLED=False, DIRECT_UPLOAD_BACKEND='api.signed_uploads.LocalUploadBackend')
+class SignedUploadTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user, self.restaurant, self.categories, self.posts = create_posts(1)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # PUT先は署名付きURLなので認証しない
+        self.uploader = APIClient()
+
+    def issue(self, target='post_model', filename='dish.glb', **data):
+        response = self.client.post('/api/upload_url/', dict(data, target=target, id=self.posts[0].id, filename=filename))
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.data
+
+    def put(self, upload, body, content_type=None):
+        content_type = content_type or upload['headers']['Content-Type']
+        return self.uploader.generic('PUT', upload['url'], body, content_type=content_type)
+
+    def confirm(self, upload):
+        return self.client.post('/api/upload_confirm/', {'token': upload['token']})
+
+    def test_issue_put_and_confirm(self):
+        upload = self.issue()
+        self.assertRegex(upload['name'], r'^models/[0-9a-f]{32}\.glb$')
+        # PUTの前は確認できない
+        self.assertEqual(self.confirm(upload).status_code, 400)
+        self.assertEqual(self.put(upload, b'glb data').status_code, 204)
+        response = self.confirm(upload)
+        self.assertEqual(response.status_code, 200, response.data)
+        with Post.objects.get(pk=self.posts[0].pk).menu_item_model.open('rb') as model_file:
+            self.assertEqual(model_file.read(), b'glb data')
+        # 同じトークンで上書きはできない
+        self.assertEqual(self.put(upload, b'replaced').status_code, 400)
+        self.assertEqual(self.uploader.generic('PUT', '/api/upload_local/bad/', b'x').status_code, 400)
+
+    def test_content_type_and_size_limits(self):
+        self.assertEqual(self.client.post('/api/upload_url/', {
+            'target': 'post_photo', 'id': self.posts[0].id, 'filename': 'dish.png',
+        }).status_code, 400)
+        upload = self.issue()
+        self.assertEqual(self.put(upload, b'glb data', content_type='image/png').status_code, 400)
+        with override_settings(DIRECT_UPLOAD_MAX_SIZE=4):
+            self.assertEqual(self.put(upload, b'glb data').status_code, 400)
+        self.assertFalse(default_storage.exists(upload['name']))
+
+    def test_invalid_image_is_deleted_on_confirm(self):
+        upload = self.issue('post_photo', 'dish.png', content_type='image/png')
+        self.assertEqual(self.put(upload, b'not an image').status_code, 204)
+        self.assertEqual(self.confirm(upload).status_code, 400)
+        self.assertFalse(default_storage.exists(upload['name']))
+        self.assertFalse(Post.objects.get(pk=self.posts[0].pk).menu_item_photo)
+
+        upload = self.issue('post_photo', 'dish.png', content_type='image/png')
+        self.assertEqual(self.put(upload, png(size=(10, 10))).status_code, 204)
+        self.assertEqual(self.confirm(upload).status_code, 200)
+
+    def test_only_owner_can_issue_and_confirm(self):
+        upload = self.issue()
+        self.put(upload, b'glb data')
+        self.client.force_authenticate(User.objects.create_user('other@example.com', 'password'))
+        self.assertEqual(self.client.post('/api/upload_url/', {
+            'target': 'post_model', 'id': self.posts[0].id, 'filename': 'dish.glb',
+        }).status_code, 403)
+        self.assertEqual(self.confirm(upload).status_code, 403)
+
+
+@override_settings(API_CACHE_ENABLED=False)
+class PostImportTests(TestCase):
+    def setUp(self):
+        self.user, self.restaurant, self.categories, self.posts = create_posts(2)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post_import(self, rows, query=''):
+        body = '\n'.join(row if isinstance(row, str) else json.dumps(row) for row in rows)
+        return self.client.generic('POST', '/api/post_import/' + query, body, content_type='application/x-ndjson')
+
+    def test_import_reports_row_errors(self):
+        response = self.post_import([
+            {'menu_item': 'tuna', 'restaurant': 'Sushi Dai', 'restaurant_location': 'Tokyo Tsukiji',
+             'category': ['category0', 'category1'], 'score': 5, 'price': 1000},
+            {'menu_item': 'eel', 'restaurant': 'Nope', 'restaurant_location': 'Tokyo', 'price': 1},
+            'garbage',
+            {'menu_item': 'salmon', 'restaurant': 'Sushi Dai', 'restaurant_location': 'Tokyo Tsukiji', 'price': 'abc'},
+            # 店舗名だけでは店舗を特定しない
+            {'menu_item': 'squid', 'restaurant': 'Sushi Dai', 'price': 500},
+            # 店舗名・場所は正規化して照合する。APIでは行のauthorは無視してリクエストしたユーザーの投稿にする
+            {'menu_item': 'salmon', 'restaurant': 'SUSHI  DAI', 'restaurant_location': 'tokyo tsukiji',
+             'category': 'category2|category0', 'price': 700, 'author': 'other@example.com'},
+        ])
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 4))
+        self.assertEqual([error['line'] for error in response.data['errors']], [2, 3, 4, 5])
+        self.assertIn('restaurant_location', response.data['errors'][3]['errors'])
+
+        tuna = Post.objects.get(menu_item='tuna')
+        salmon = Post.objects.get(menu_item='salmon')
+        self.assertEqual((tuna.author_id, salmon.author_id), (self.user.pk, self.user.pk))
+        self.assertEqual(salmon.restaurant_id, self.restaurant.pk)
+        self.assertEqual(sorted(salmon.category.values_list('name', flat=True)), ['category0', 'category2'])
+        # シグナルの代わりにバッチごとに集計・検索インデックスを更新する
+        self.assertEqual(RestaurantStats.objects.get(restaurant=self.restaurant).post_count, 4)
+        self.assertIn(tuna.id, search.search_post_ids('tuna', 10).ids)
+
+    def test_create_missing_resolves_through_dedup_key(self):
+        response = self.post_import([
+            {'menu_item': 'udon', 'restaurant': 'Menya', 'restaurant_location': 'Kyoto', 'category': ['noodles'], 'price': 800},
+            {'menu_item': 'soba', 'restaurant': 'menya', 'restaurant_location': 'KYOTO', 'category': ['noodles'], 'price': 900},
+        ], '?create_missing=true')
+        self.assertEqual(response.data['created'], 2, response.data)
+        restaurant = Restaurant.objects.get(name='Menya')
+        self.assertEqual(Restaurant.objects.filter(dedup_key=restaurant.dedup_key).count(), 1)
+        self.assertEqual(set(Post.objects.filter(menu_item__in=['udon', 'soba']).values_list('restaurant_id', flat=True)),
+                         {restaurant.pk})
+        self.assertEqual(Category.objects.filter(name='noodles').count(), 1)
+
+    def test_batches_do_not_query_per_row(self):
+        row = {'menu_item': 'tuna', 'restaurant': 'Sushi Dai', 'restaurant_location': 'Tokyo Tsukiji',
+               'category': ['category0'], 'price': 100}
+        query_counts = []
+        for count in (10, 50):
+            importer = bulk.PostImporter(author_id=self.user.pk, batch_size=50)
+            with CaptureQueriesContext(connection) as queries:
+                importer.run((line_no, dict(row), None) for line_no in range(1, count + 1))
+            self.assertEqual(importer.created, count)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_command_imports_exported_csv(self):
+        out = io.StringIO()
+        call_command('export_posts', '--format', 'csv', stdout=out)
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as export_file:
+            export_file.write(out.getvalue())
+        try:
+            call_command('import_posts', export_file.name, '--batch-size', '1', stdout=io.StringIO(), stderr=io.StringIO())
+        finally:
+            os.remove(export_file.name)
+        self.assertEqual(Post.objects.count(), 4)
+        self.assertEqual(
+            sorted(Post.objects.values_list('menu_item', 'restaurant_id', 'author_id')),
+            sorted(2 * [(post.menu_item, self.restaurant.pk, self.user.pk) for post in self.posts]),
+        )
+
+
+@override_settings(API_CACHE_ENABLED=False)
+class PostExportTests(TestCase):
+    def setUp(self):
+        self.user, self.restaurant, self.categories, self.posts = create_posts(5)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_export_streams_ndjson(self):
+        response = self.client.get('/api/post_export/?category={}'.format(self.categories[2].id))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['menu_item'] for row in rows], ['item2'])
+        self.assertEqual(rows[0]['category'], ['category0', 'category1', 'category2'])
+        self.assertEqual(rows[0]['restaurant_location'], 'Tokyo Tsukiji')
+        # APIでは投稿者のメールアドレスではなくIDを返す
+        self.assertEqual(rows[0]['author'], self.user.pk)
+
+    def test_export_csv(self):
+        response = self.client.get('/api/post_export/?data_format=csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], ','.join(bulk.EXPORT_FIELDS))
+        self.assertEqual(len(lines), 6)
+        self.assertNotIn('author@example.com', '\n'.join(lines))
+        self.assertEqual(self.client.get('/api/post_export/?data_format=xml').status_code, 400)
+
+    # カテゴリーはchunkごとに1回のクエリで取得する
+    def test_export_queries_per_chunk(self):
+        with self.assertNumQueries(1 + 1 + 3):
+            rows = list(bulk.iter_export_rows(chunk_size=2, author_emails=True))
+        self.assertEqual([row['id'] for row in rows], [post.id for post in self.posts])
+        self.assertEqual(rows[0]['author'], 'author@example.com')
+
+
+@override_settings(API_CACHE_ENABLED=False)
+class NearbyRestaurantTests(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        for name, latitude, longitude in (
+            ('Tokyo Station', 35.6812, 139.7671), ('Marunouchi', 35.6850, 139.7700),
+            ('Ginza', 35.6717, 139.7650), ('Osaka', 34.70, 135.49),
+        ):
+            Restaurant.objects.create(name=name, location='x', latitude=latitude, longitude=longitude)
+        Restaurant.objects.create(name='No location', location='x')
+
+    def nearby(self, query):
+        return self.client.get('/api/restaurant/nearby/?' + query)
+
+    def test_geohash_follows_coordinates(self):
+        self.assertEqual(geo.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        restaurant = Restaurant.objects.get(name='Ginza')
+        self.assertEqual(restaurant.geohash, geo.encode(35.6717, 139.7650))
+        restaurant.latitude = None
+        restaurant.save()
+        self.assertEqual(restaurant.geohash, '')
+
+    def test_nearby_is_ordered_by_distance(self):
+        response = self.nearby('lat=35.6812&lng=139.7671&radius=2')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertWithinQueryBudget(response)
+        self.assertEqual([row['name'] for row in response.data['results']], ['Tokyo Station', 'Marunouchi', 'Ginza'])
+        self.assertLess(response.data['results'][1]['distance'], 1)
+        self.assertNotIn('Osaka', [row['name'] for row in self.nearby('lat=35.6812&lng=139.7671&radius=20').data['results']])
+
+        response = self.nearby('lat=35.6812&lng=139.7671&radius=2&limit=1')
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIn('offset=1', response.data['next'])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.nearby('lat=95&lng=0').status_code, 400)
+        self.assertEqual(self.nearby('lat=35&lng=139&radius=500').status_code, 400)
+
+    # 範囲の絞り込みはgeohashのインデックスを使う
+    def test_nearby_uses_geohash_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            list(geo.nearby(Restaurant.objects.all(), 35.6812, 139.7671, 1))
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + queries.captured_queries[0]['sql'])
+            self.assertIn('geohash', str(cursor.fetchall()))
+
+    def test_nearby_across_date_line(self):
+        Restaurant.objects.create(name='Fiji', location='x', latitude=-17.0, longitude=179.999)
+        response = self.nearby('lat=-17.0&lng=-179.999&radius=5')
+        self.assertEqual([row['name'] for row in response.data['results']], ['Fiji'])
+
+
+@override_settings(API_CACHE_ENABLED=False)
+class RestaurantDedupTests(QueryBudgetTestMixin, TestCase):
+    def test_lookup_matches_normalized_name(self):
+        restaurant = Restaurant.objects.create(name='Sushi Dai', location='Tokyo Tsukiji')
+        client = APIClient()
+        response = client.post('/api/restaurant/', {'name': 'ＳＵＳＨＩ  dai', 'location': 'tokyo tsukiji'})
+        self.assertEqual(response.status_code, 400)
+        response = client.get('/api/restaurant/lookup/', {'name': 'sushi-dai', 'location': 'Tokyo Tsukiji'})
+        self.assertWithinQueryBudget(response)
+        self.assertEqual(response.data['id'], restaurant.id)
+        self.assertEqual(client.get('/api/restaurant/lookup/', {'name': 'x', 'location': 'y'}).status_code, 404)
+
+    # 重複の確認の後に同じ店舗が作成された場合も500にしない
+    def test_concurrent_duplicate_returns_400(self):
+        restaurant = Restaurant.objects.create(name='Sushi Dai', location='Tokyo Tsukiji')
+        with mock.patch('api.restaurants.find', side_effect=[None, restaurant]) as mocked_find:
+            response = APIClient().post('/api/restaurant/', {'name': 'sushi dai', 'location': 'Tokyo Tsukiji'})
+        self.assertEqual(mocked_find.call_count, 2)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(restaurant.id), response.data['non_field_errors'][0])
+        self.assertEqual(Restaurant.objects.count(), 1)
+
+    # 店舗名・場所を変えない更新では重複を確認しない(キーのない既存の重複の緯度・経度も変更できる)
+    def test_partial_update_without_name_skips_duplicate_check(self):
+        Restaurant.objects.create(name='Sushi Dai', location='Tokyo Tsukiji')
+        Restaurant.objects.bulk_create([Restaurant(name='sushi dai', location='tokyo tsukiji')])
+        legacy = Restaurant.objects.get(dedup_key=None)
+        client = APIClient()
+        response = client.patch('/api/restaurant/{}/'.format(legacy.id), {'latitude': 35.66, 'longitude': 139.77})
+        self.assertEqual(response.status_code, 200, response.data)
+        response = client.patch('/api/restaurant/{}/'.format(legacy.id), {'name': 'Sushi Dai'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_merge_moves_posts_and_stats(self):
+        user, restaurant, categories, posts = create_posts(6)
+        # 重複チェックの導入前に作られた、キーのない重複した店舗
+        Restaurant.objects.bulk_create([Restaurant(name='sushi dai', location='tokyo tsukiji') for _ in range(3)])
+        duplicates = list(Restaurant.objects.filter(dedup_key=None))
+        for post, duplicate in zip(posts, duplicates):
+            post.restaurant = duplicate
+            post.save()
+        other = Restaurant.objects.create(name='Other', location='Osaka')
+
+        call_command('merge_restaurants', dry_run=True, stdout=io.StringIO())
+        self.assertEqual(Restaurant.objects.count(), 5)
+        call_command('merge_restaurants', batch_size=2, stdout=io.StringIO())
+        self.assertEqual(set(Restaurant.objects.values_list('id', flat=True)), {restaurant.id, other.id})
+        self.assertEqual(Post.objects.filter(restaurant=restaurant).count(), 6)
+        self.assertEqual(RestaurantStats.objects.get(restaurant=restaurant).post_count, 6)
+
+
+@override_settings(API_CACHE_ENABLED=True)
+class AutocompleteTests(CacheClearMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        autocomplete.prefix_cache.clear()
+        self.user, self.restaurant, self.categories, self.posts = create_posts(6)
+        self.client = APIClient()
+
+    def complete(self, kind, q, **params):
+        response = self.client.get('/api/autocomplete/{}/'.format(kind), dict(params, q=q))
+        self.assertEqual(response.status_code, 200, response.data)
+        return response
+
+    def test_restaurants_use_stats_and_prefix_cache(self):
+        zanmai = Restaurant.objects.create(name='Sushi Zanmai', location='Ginza')
+        Post.objects.create(author=self.user, restaurant=zanmai, menu_item='tuna', score=3, price=1)
+        response = self.complete('restaurant', 'ＳＵ')
+        self.assertEqual([(row['name'], row['post_count']) for row in response.data['results']],
+                         [('Sushi Dai', 6), ('Sushi Zanmai', 1)])
+        self.assertEqual(response.metrics.queries, 1)
+        # 短い接頭辞の結果がlimit件未満なら、DBに問い合わせずにその中から絞り込む
+        response = self.complete('restaurant', 'sushi z')
+        self.assertEqual([row['name'] for row in response.data['results']], ['Sushi Zanmai'])
+        self.assertEqual(response.metrics.queries, 0)
+
+    def test_category_counts_come_from_category_stats(self):
+        response = self.complete('category', 'CATEGORY')
+        self.assertEqual([(row['name'], row['post_count']) for row in response.data['results']],
+                         [('category0', 6), ('category1', 4), ('category2', 2)])
+        self.assertEqual(response.metrics.queries, 1)
+        Category.objects.create(name='category9')
+        self.assertEqual(self.complete('category', 'category9').data['results'][0]['post_count'], 0)
+
+    def test_menu_items_are_grouped_by_normalized_name(self):
+        Post.objects.create(author=self.user, restaurant=self.restaurant, menu_item='ＩＴＥＭ1', score=3, price=1)
+        results = self.complete('menu_item', 'item', limit=3).data['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['post_count'], 2)
+        self.assertEqual(self.client.get('/api/autocomplete/unknown/', {'q': 'a'}).status_code, 404)
+        self.assertEqual(self.client.get('/api/autocomplete/menu_item/').status_code, 400)
+        self.assertEqual(self.complete('menu_item', '   ').data['results'], [])
+
+    # 投稿数を数えるのは名前順の候補だけ
+    @override_settings(AUTOCOMPLETE_CANDIDATES=2)
+    def test_counts_only_candidate_names(self):
+        for _ in range(3):
+            Post.objects.create(author=self.user, restaurant=self.restaurant, menu_item='item5', score=3, price=1)
+        results = self.complete('menu_item', 'item', limit=2).data['results']
+        self.assertEqual([row['menu_item'] for row in results], ['item0', 'item1'])
+        results = self.complete('menu_item', 'item5', limit=2).data['results']
+        self.assertEqual(results, [{'menu_item': 'item5', 'post_count': 4}])
+
+    def test_prefix_search_uses_index(self):
+        for kind in ('restaurant', 'category', 'menu_item'):
+            autocomplete.prefix_cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                self.complete(kind, 'su')
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + queries.captured_queries[-1]['sql'])
+                self.assertIn('normalized', str(cursor.fetchall()))
+
+
+@override_settings(API_CACHE_ENABLED=False)
+class PostExpandTests(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        self.user, self.restaurant, self.categories, self.posts = create_posts(12)
+        Profile.objects.create(nickName='nick', userProfile=self.user)
+        self.client = APIClient()
+
+    # 関連の展開は件数によらず固定のクエリ数で返す
+    def test_expand_in_fixed_queries(self):
+        response = self.client.get('/api/post_list/?expand=restaurant,category,author_profile')
+        self.assertWithinQueryBudget(response)
+        self.assertEqual(response.metrics.queries, 2)
+        row = response.json()['results'][0]
+        self.assertEqual(list(row)[:4], ['id', 'created_on', 'author', 'author_profile'])
+        self.assertEqual(row['restaurant']['name'], 'Sushi Dai')
+        self.assertEqual(row['restaurant']['stats']['post_count'], 12)
+        self.assertEqual(row['author_profile']['nickName'], 'nick')
+        self.assertIn('name', row['category'][0])
+
+        response = self.client.get('/api/post_detail/{}/?expand=restaurant,author_profile'.format(self.posts[0].id))
+        self.assertEqual(response.json()['restaurant']['id'], self.restaurant.id)
+        self.assertEqual(response.metrics.queries, 2)
+
+    def test_fields_and_expand_validation(self):
+        response = self.client.get('/api/post_list/?fields=id,menu_item&expand=restaurant')
+        self.assertEqual(set(response.json()['results'][0]), {'id', 'menu_item'})
+        response = self.client.get('/api/post/search/?q=item&expand=category&fields=id,category')
+        self.assertEqual(set(response.json()['results'][0]), {'id', 'category'})
+        self.assertEqual(self.client.get('/api/post_list/?fields=nope').status_code, 400)
+        self.assertEqual(self.client.get('/api/post_list/?expand=nope').status_code, 400)
+        self.assertEqual(self.client.get('/api/post_list/?fields=author_profile').status_code, 400)
+
+    # 書き込みのレスポンスは展開せずIDのまま返す
+    def test_write_returns_ids(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.post('/api/post/?expand=restaurant', {
+            'restaurant': self.restaurant.id, 'menu_item': 'new', 'score': 3, 'price': 1,
+            'category': [self.categories[0].id],
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.json()['restaurant'], self.restaurant.id)
+        response = self.client.get('/api/post/{}/?expand=author_profile'.format(self.posts[0].id))
+        self.assertEqual(response.json()['author_profile']['userProfile'], self.user.id)
+
+
+@override_settings(API_CACHE_ENABLED=False)
+class UserPostListTests(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        self.user, self.restaurant, self.categories, self.posts = create_posts(25)
+        self.other = User.objects.create_user('other@example.com', 'password')
+        Post.objects.create(author=self.other, restaurant=self.restaurant, menu_item='other', score=5, price=10)
+        self.client = APIClient()
+
+    def test_my_posts_with_summary(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get('/api/mypost/?summary=true&page_size=10')
+        self.assertEqual(response.status_code, 200)
+        self.assertWithinQueryBudget(response)
+        self.assertEqual(response.metrics.queries, 3)
+        self.assertEqual(response.data['summary'], {
+            'count': 25, 'avg_score': 3.0, 'total_spend': sum(100 * index for index in range(25)),
+        })
+        ids = []
+        while response is not None:
+            ids += [post['id'] for post in response.data['results']]
+            response = self.client.get(response.data['next']) if response.data['next'] else None
+        self.assertEqual(sorted(ids), sorted(post.id for post in self.posts))
+        self.assertEqual(APIClient().get('/api/mypost/').status_code, 401)
+
+    def test_user_posts(self):
+        response = self.client.get('/api/user/{}/posts/?expand=restaurant&fields=id,menu_item'.format(self.other.id))
+        self.assertEqual([post['menu_item'] for post in response.data['results']], ['other'])
+        self.assertNotIn('summary', response.data)
+        self.assertEqual(response.metrics.queries, 2)
+        response = self.client.get('/api/user/999/posts/?summary=1')
+        self.assertEqual(response.data['summary'], {'count': 0, 'avg_score': None, 'total_spend': 0})
+
+    # 投稿者・作成日時の複合インデックスで絞り込みと並べ替えを行う
+    def test_user_posts_use_author_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/user/{}/posts/'.format(self.user.id))
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + queries.captured_queries[0]['sql'])
+            self.assertIn('api_post_author_created_idx', str(cursor.fetchall()))
+
+
+@override_settings(API_CACHE_ENABLED=False)
+class PostCategoryTests(TestCase):
+    def setUp(self):
+        self.user, self.restaurant, self.categories, _ = create_posts(2, categories=6)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def category_ids(self, *indexes):
+        return [self.categories[index].id for index in indexes]
+
+    def test_category_diff_writes(self):
+        response = self.client.post('/api/post/', {
+            'restaurant': self.restaurant.id, 'menu_item': 'ramen', 'score': 4, 'price': 800,
+            'category': self.category_ids(0, 1, 1),
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(sorted(response.data['category']), self.category_ids(0, 1))
+        url = '/api/post/{}/'.format(response.data['id'])
+
+        response = self.client.patch(url, {'category': self.category_ids(1, 4, 5)}, format='json')
+        self.assertEqual(sorted(response.data['category']), self.category_ids(1, 4, 5))
+        response = self.client.patch(url, {'menu_item': 'tsukemen'}, format='json')
+        self.assertEqual(sorted(response.data['category']), self.category_ids(1, 4, 5))
+        incremental = stats_snapshot()
+        stats.rebuild_all()
+        self.assertEqual(stats_snapshot(), incremental)
+
+        # 変更するカテゴリーの数が増えてもクエリ数は変わらない(集計の行は作成済みの状態で比べる)
+        self.client.patch(url, {'category': self.category_ids(0, 1, 2, 3, 4, 5)}, format='json')
+        self.client.patch(url, {'category': self.category_ids(0)}, format='json')
+        with CaptureQueriesContext(connection) as small:
+            self.client.patch(url, {'category': self.category_ids(1)}, format='json')
+        with CaptureQueriesContext(connection) as large:
+            self.client.patch(url, {'category': self.category_ids(0, 2, 3, 4, 5)}, format='json')
+        self.assertEqual(len(large), len(small))
+
+    def test_invalid_category_leaves_post_unchanged(self):
+        response = self.client.post('/api/post/', {
+            'restaurant': self.restaurant.id, 'menu_item': 'ramen', 'score': 4, 'price': 800,
+            'category': self.category_ids(2),
+        }, format='json')
+        post_id = response.data['id']
+        response = self.client.patch('/api/post/{}/'.format(post_id), {'category': self.category_ids(0) + [9999]},
+                                     format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(Post.objects.get(pk=post_id).category.values_list('id', flat=True)),
+                         self.category_ids(2))
+
+
+# プールのテスト用のDB-APIの接続
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.status = 0
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = 0
+
+    def close(self):
+        self.closed = True
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, sql):
+        if self.connection.closed:
+            raise Exception('connection is closed')
+
+
+class ConnectionPoolTests(TestCase):
+    def setUp(self):
+        self.pool = connections.ConnectionPool('test', max_size=2, timeout=0.2, health_check_interval=0)
+
+    def test_checkout_waits_and_times_out(self):
+        first = self.pool.checkout(FakeConnection)
+        second = self.pool.checkout(FakeConnection)
+        self.assertEqual(self.pool.opened, 2)
+        with self.assertRaises(connections.PoolTimeout):
+            self.pool.checkout(FakeConnection)
+        self.assertEqual(self.pool.timeouts, 1)
+        # 返された接続を待っていたスレッドが受け取る
+        threading.Timer(0.05, self.pool.checkin, (second,)).start()
+        self.assertIs(self.pool.checkout(FakeConnection), second)
+        self.assertEqual(self.pool.waits, 1)
+        self.pool.checkin(first)
+        self.assertIs(self.pool.checkout(FakeConnection), first)
+
+    def test_checkin_resets_or_discards(self):
+        pooled = self.pool.checkout(FakeConnection)
+        # トランザクション中のまま返された接続はロールバックしてから使い回す
+        pooled.status = 2
+        self.pool.checkin(pooled)
+        self.assertEqual(pooled.rollbacks, 1)
+        self.assertIs(self.pool.checkout(FakeConnection), pooled)
+        self.pool.checkin(pooled, discard=True)
+        self.assertTrue(pooled.closed)
+        self.assertEqual(self.pool.closed, 1)
+
+    def test_broken_and_expired_connections_are_replaced(self):
+        broken = self.pool.checkout(FakeConnection)
+        self.pool.checkin(broken)
+        broken.closed = True
+        replacement = self.pool.checkout(FakeConnection)
+        self.assertIsNot(replacement, broken)
+        self.assertEqual(self.pool.opened, 2)
+        self.pool.max_lifetime = 0
+        self.pool.checkin(replacement)
+        self.assertTrue(replacement.closed)
+        self.assertEqual(self.pool.size, 0)
+
+
+class IdleConnectionCheckTests(TransactionTestCase):
+    # DB_HEALTH_CHECK_INTERVAL秒以上使っていない永続的な接続だけを確認する
+    def test_only_idle_connections_are_checked(self):
+        connection.ensure_connection()
+        before = connections.health_checks[('default', 'ok')]
+        with override_settings(DB_HEALTH_CHECK_INTERVAL=0):
+            connection._api_last_used = time.monotonic() - 1
+            connections.check_idle_connections()
+        self.assertEqual(connections.health_checks[('default', 'ok')], before + 1)
+        with override_settings(DB_HEALTH_CHECK_INTERVAL=60):
+            connections.mark_connections_used()
+            connections.check_idle_connections()
+        self.assertEqual(connections.health_checks[('default', 'ok')], before + 1)
+
+    def test_metrics_include_connection_counters(self):
+        with override_settings(METRICS_TOKEN='secret'):
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertIn(b'api_db_connects_total', response.content)
+
+
+# ランキングの全リストの内容
+def ranking_snapshot():
+    return sorted(
+        (entry.kind, entry.category_id or 0, entry.rank, entry.post_id or 0, entry.restaurant_id or 0, round(entry.score, 9))
+        for entry in RankingEntry.objects.all()
+    )
+
+
+@override_settings(API_CACHE_ENABLED=False, RANKING_SIZE=4, RANKING_OVERLAP_SECONDS=0)
+class RankingRefreshTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.restaurants = [Restaurant.objects.create(name='r{}'.format(index), location='x') for index in range(6)]
+        self.categories = [Category.objects.create(name='c{}'.format(index)) for index in range(3)]
+
+    def create_post(self, score, age_hours=0, restaurant=None, categories=()):
+        post = Post.objects.create(
+            author=self.user, restaurant=restaurant or self.restaurants[0], menu_item='item', score=score, price=100,
+        )
+        if age_hours:
+            Post.objects.filter(pk=post.pk).update(created_on=timezone.now() - timedelta(hours=age_hours))
+        post.category.set(categories)
+        return post
+
+    # 差分更新の結果は、同じ時点で全件から作り直した結果と一致する
+    def test_incremental_refresh_matches_full_rebuild(self):
+        rng = random.Random(6)
+        for _ in range(40):
+            self.create_post(rng.randint(1, 5), rng.randint(0, 400), rng.choice(self.restaurants),
+                             rng.sample(self.categories, rng.randint(1, 2)))
+        self.assertTrue(rankings.refresh().full)
+        for step in range(10):
+            for _ in range(rng.randint(1, 4)):
+                post = rng.choice(list(Post.objects.all()))
+                operation = rng.random()
+                if operation < 0.3:
+                    post.score = rng.randint(1, 5)
+                    post.save()
+                elif operation < 0.5:
+                    post.delete()
+                elif operation < 0.65:
+                    post.category.set(rng.sample(self.categories, rng.randint(1, 3)))
+                elif operation < 0.8:
+                    post.restaurant = rng.choice(self.restaurants)
+                    post.save()
+                elif operation < 0.9:
+                    rng.choice(self.categories).posts.add(post)
+                else:
+                    self.create_post(rng.randint(1, 5), 0, rng.choice(self.restaurants), rng.sample(self.categories, 1))
+            run = rankings.refresh()
+            self.assertFalse(run.full)
+            self.assertLess(run.changed_posts, 10)
+            incremental = ranking_snapshot()
+            rankings.refresh(full=True)
+            self.assertEqual(ranking_snapshot(), incremental, step)
+
+    def test_merge(self):
+        # 満杯でないリストには値を反映して並べ直すだけ
+        self.assertEqual(rankings._merge([(1, 5.0), (2, 3.0)], {2}, {2: 6.0, 3: 1.0}, 4), [(2, 6.0), (1, 5.0), (3, 1.0)])
+        # 満杯のリストで最下位以上の値は入れ替え、削除された項目(ID None)は外す
+        self.assertEqual(rankings._merge([(1, 5.0), (2, 3.0)], {3}, {3: 4.0}, 2), [(1, 5.0), (3, 4.0)])
+        # 最下位を下回ってcapacity件未満になると、繰り上がる項目が分からないので作り直す
+        self.assertIsNone(rankings._merge([(1, 5.0), (2, 3.0)], {1}, {1: 1.0}, 2))
+        self.assertIsNone(rankings._merge([(1, 5.0), (None, 3.0)], set(), {}, 2))
+
+    @override_settings(RANKING_SIZE=2)
+    def test_merge_falls_back_to_rebuild(self):
+        first, second, third = (self.create_post(score) for score in (5, 4, 3))
+        rankings.refresh()
+        first.score = 1
+        first.save()
+        with mock.patch('api.rankings._top', wraps=rankings._top) as top:
+            self.assertFalse(rankings.refresh().full)
+        self.assertTrue(top.called)
+        trending = RankingEntry.objects.filter(kind=RankingEntry.KIND_TRENDING, category=None).order_by('rank')
+        self.assertEqual(list(trending.values_list('post_id', flat=True)), [second.id, third.id])
+
+    def test_ranking_api(self):
+        old = self.create_post(5, age_hours=6 * 24, restaurant=self.restaurants[0])
+        new = self.create_post(4, restaurant=self.restaurants[1], categories=[self.categories[0]])
+        self.create_post(5, restaurant=self.restaurants[0])
+        client = APIClient()
+        response = client.get('/api/ranking/trending/')
+        self.assertEqual(response.data['results'], [])
+        self.assertIsNone(response.data['computed_on'])
+
+        rankings.refresh()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/ranking/trending/?expand=restaurant')
+        self.assertLessEqual(len(queries), 3)
+        results = response.data['results']
+        self.assertEqual([entry['post']['id'] for entry in results][1:], [new.id, old.id])
+        self.assertEqual(results[2]['post']['restaurant']['name'], 'r0')
+        response = client.get('/api/ranking/trending/?category={}'.format(self.categories[0].id))
+        self.assertEqual([entry['post']['id'] for entry in response.data['results']], [new.id])
+        response = client.get('/api/ranking/top_rated/')
+        self.assertEqual([entry['restaurant']['id'] for entry in response.data['results']],
+                         [self.restaurants[0].id, self.restaurants[1].id])
+        self.assertEqual(client.get('/api/ranking/nope/').status_code, 404)
+        self.assertEqual(client.get('/api/ranking/trending/?limit=500').status_code, 400)
+
+        # 削除された投稿は飛ばして順位を詰める
+        Post.objects.filter(pk=results[0]['post']['id']).delete()
+        response = client.get('/api/ranking/trending/')
+        self.assertEqual([(entry['rank'], entry['post']['id']) for entry in response.data['results']],
+                         [(1, new.id), (2, old.id)])
+
+
+class LazyCredentialsTests(SimpleTestCase):
+    def setUp(self):
+        storage.reset_credentials()
+        self.addCleanup(storage.reset_credentials)
+
+    # 設定の読み込み・WSGIアプリケーションの作成ではGCS・画像処理のライブラリを読み込まない
+    def test_settings_import_skips_heavy_modules(self):
+        script = (
+            'import sys, django; django.setup(); from api_gourmet.wsgi import application; '
+            'print(sorted(m for m in sys.modules if m.startswith(("google.oauth2", "google.auth", "google.cloud.storage", "PIL"))))'
+        )
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='api_gourmet.settings', STORAGE_BACKEND='gcs')
+        result = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True,
+                                cwd=settings.BASE_DIR)
+        self.assertEqual(result.stdout.strip(), '[]', result.stderr)
+
+    def test_credentials_load_once_on_first_client_use(self):
+        from .storage.gcs import GoogleCloudStorage
+
+        credentials = object()
+        with mock.patch('api.storage._load_credentials', return_value=credentials) as load, \
+                mock.patch('storages.backends.gcloud.Client') as client_class:
+            gcs = GoogleCloudStorage()
+            self.assertIsNone(gcs.credentials)
+            self.assertEqual(load.call_count, 0)
+            gcs.client
+            gcs.client
+            self.assertIs(storage.get_credentials(), credentials)
+            self.assertEqual(load.call_count, 1)
+            self.assertIs(client_class.call_args[1]['credentials'], credentials)
+            storage.reset_credentials()
+            storage.get_credentials()
+            self.assertEqual(load.call_count, 2)
+
+    def test_missing_key_file_uses_default_credentials(self):
+        with override_settings(GS_CREDENTIALS_JSON=None, GS_CREDENTIALS_FILE='/nonexistent'):
+            self.assertIsNone(storage.get_credentials())
+
+
+class MediaCleanupTests(TempMediaMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user, self.restaurant, self.categories, self.posts = create_posts(2)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload_photo(self, post, data, filename='photo.png'):
+        response = self.client.patch('/api/post/{}/'.format(post.id), {
+            'menu_item_photo': SimpleUploadedFile(filename, data, 'image/png'),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 200, response.data)
+        return Post.objects.get(pk=post.id)
+
+    def test_same_content_is_stored_once(self):
+        data = png()
+        first = self.upload_photo(self.posts[0], data, 'A.PNG')
+        second = self.upload_photo(self.posts[1], data)
+        self.assertEqual(first.menu_item_photo.name, second.menu_item_photo.name)
+        self.assertRegex(first.menu_item_photo.name, r'^posts/[0-9a-f]{64}\.png$')
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'posts')).count(
+            os.path.basename(first.menu_item_photo.name)), 1)
+        self.assertTrue(first.menu_item_photo_variants)
+
+    # 差し替えた画像は参照がなくなってもその場では消さず、gc_mediaがmin_ageより古いものを消す
+    def test_replaced_photo_is_collected_by_gc(self):
+        post = self.upload_photo(self.posts[0], png((255, 0, 0)))
+        old_names = [post.menu_item_photo.name] + media._names_in_variants(post.menu_item_photo_variants)
+        self.upload_photo(self.posts[0], png((0, 0, 255)))
+        self.assertTrue(all(default_storage.exists(name) for name in old_names))
+
+        media.collect_garbage(min_age=timedelta(hours=1))
+        self.assertTrue(all(default_storage.exists(name) for name in old_names))
+        call_command('gc_media', '--min-age', '0', stdout=io.StringIO())
+        self.assertFalse(any(default_storage.exists(name) for name in old_names))
+        current = Post.objects.get(pk=self.posts[0].pk).menu_item_photo.name
+        self.assertTrue(default_storage.exists(current))
+
+    # 同じ内容の再アップロードは保存済みのファイルの更新日時を新しくするので、gc_mediaに消されない
+    def test_reused_file_is_kept_by_gc(self):
+        name = default_storage.save('posts/{}.png'.format('a' * 64), ContentFile(b'x'))
+        old = (timezone.now() - timedelta(days=2)).timestamp()
+        os.utime(default_storage.path(name), (old, old))
+        self.assertEqual(default_storage.save(name, ContentFile(b'x')), name)
+        self.assertEqual(media.collect_garbage(min_age=timedelta(hours=1))['deleted'], 0)
+        self.assertTrue(default_storage.exists(name))
+
+    # ハッシュ導入前の名前のファイルは、参照がなくなればその場で消す
+    def test_legacy_file_is_deleted_on_replace(self):
+        legacy = default_storage.save('posts/1ramen.png', ContentFile(png()))
+        Post.objects.filter(pk=self.posts[0].pk).update(menu_item_photo=legacy)
+        self.upload_photo(self.posts[0], png((0, 255, 0)))
+        self.assertFalse(default_storage.exists(legacy))
+
+    def test_field_file_save_uses_content_hash(self):
+        post = Post.objects.get(pk=self.posts[0].pk)
+        for color in ((1, 2, 3), (4, 5, 6)):
+            data = png(color)
+            post.menu_item_photo.save('photo.png', ContentFile(data))
+            self.assertEqual(post.menu_item_photo.name, 'posts/{}.png'.format(hashlib.sha256(data).hexdigest()))
+
+
+class GarbageCollectionTests(TempMediaMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user, self.restaurant, self.categories, self.posts = create_posts(2)
+
+    def save(self, name, data=b'x'):
+        return default_storage.save(name, ContentFile(data))
+
+    def test_only_unreferenced_files_are_deleted(self):
+        photo = self.save('posts/{}.png'.format('a' * 64))
+        variant = self.save('posts/{}.w320.webp'.format('a' * 64))
+        Post.objects.filter(pk=self.posts[0].pk).update(menu_item_photo=photo)
+        legacy = self.save('posts/1ramen.png')
+        legacy_variant = self.save('posts/1ramen.w320.jpg')
+        Post.objects.filter(pk=self.posts[1].pk).update(
+            menu_item_photo=legacy, menu_item_photo_variants=json.dumps({'320': {'jpg': legacy_variant}}),
+        )
+        orphans = [self.save('models/{}.glb'.format(index), b'z' * 10) for index in range(25)]
+        orphans.append(self.save('avatars/{}.w640.jpg'.format('b' * 64), b'q'))
+        unmanaged = self.save('other/keep.txt')
+
+        # min_ageより新しいファイルは消さない
+        self.assertEqual(media.collect_garbage(min_age=timedelta(hours=1))['orphans'], 0)
+        out = io.StringIO()
+        call_command('gc_media', '--dry-run', '--min-age', '0', '-v', '2', stdout=out)
+        self.assertIn('26 orphans', out.getvalue())
+        self.assertIn('models/3.glb', out.getvalue())
+        self.assertTrue(all(default_storage.exists(name) for name in orphans))
+
+        result = media.collect_garbage(min_age=timedelta(0), page_size=7, batch_size=4, workers=3)
+        self.assertEqual((result['deleted'], result['orphan_bytes']), (26, 251))
+        self.assertFalse(any(default_storage.exists(name) for name in orphans))
+        for name in (photo, variant, legacy, legacy_variant, unmanaged):
+            self.assertTrue(default_storage.exists(name), name)
+
+    # 縮小版は元のファイルの拡張子を除いた名前(stem)で参照を確かめる
+    def test_still_referenced_matches_variant_stems(self):
+        stem = 'posts/{}'.format('c' * 64)
+        names = [stem + '.png', stem + '.w320.jpg', stem + '.w640.webp', 'posts/{}.w320.jpg'.format('d' * 64)]
+        self.assertEqual(media._still_referenced(names), set())
+        Post.objects.filter(pk=self.posts[0].pk).update(menu_item_photo=stem + '.png')
+        self.assertEqual(media._still_referenced(names), set(names[:3]))
+
+    # 一覧を読んだ後に再利用された(更新日時が新しくなった)ファイルは消さない
+    def test_delete_rechecks_modified_time(self):
+        stale = self.save('models/stale.glb')
+        fresh = self.save('models/fresh.glb')
+        old = (timezone.now() - timedelta(days=2)).timestamp()
+        os.utime(default_storage.path(stale), (old, old))
+        cutoff = timezone.now() - timedelta(hours=1)
+        self.assertEqual(media._delete(default_storage, [stale, fresh, 'models/missing.glb'], cutoff), 1)
+        self.assertFalse(default_storage.exists(stale))
+        self.assertTrue(default_storage.exists(fresh))
+
+    def test_memory_storage(self):
+        from .storage.memory import InMemoryStorage
+
+        memory = InMemoryStorage()
+        for index in range(5):
+            memory.save('posts/{}.png'.format(index), ContentFile(b'1'))
+        self.assertEqual(media.collect_garbage(storage=memory, min_age=timedelta(0), batch_size=2)['deleted'], 5)
+        self.assertEqual(memory.listdir('posts'), ([], []))
+
+
+class GoogleCloudListingTests(SimpleTestCase):
+    # バケットの一覧はpage_size件ずつのページで読む(list_blobsのmax_resultsは全体の件数なので使わない)
+    def test_list_pages_uses_page_size(self):
+        from google.cloud.storage import Bucket
+        from .storage.gcs import GoogleCloudStorage
+
+        requests = []
+
+        def api_request(**kwargs):
+            params = kwargs['query_params']
+            requests.append(params)
+            start = int(params.get('pageToken', 0))
+            items = [{'name': 'posts/{}.png'.format(index), 'size': '1', 'updated': '2020-01-01T00:00:00.000Z'}
+                     for index in range(start, min(start + params['maxResults'], 7))]
+            response = {'items': items}
+            if start + len(items) < 7:
+                response['nextPageToken'] = str(start + len(items))
+            return response
+
+        client = mock.Mock()
+        client._connection.api_request.side_effect = api_request
+        gcs = GoogleCloudStorage(bucket_name='bucket')
+        gcs._bucket = Bucket(client, name='bucket')
+        pages = list(gcs.list_pages('posts/', page_size=3))
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(requests[0]['maxResults'], 3)
+        self.assertEqual(pages[0][0][0], 'posts/0.png')
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .models import ChunkedUpload
+
+# 3Dモデルの分割アップロード(ChunkedUpload)の処理
+# 受け取ったチャンクはメモリに溜めず、一時ディレクトリのファイル(<CHUNKED_UPLOAD_DIR>/<アップロードID>.part)に
+# ブロック単位で追記する。完了時にファイルを読みながらSHA-256を計算して確認し、ストレージへ保存する
+
+BLOCK_SIZE = 64 * 1024
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+# 受け付ける3Dモデルのファイル形式
+MODEL_EXTENSIONS = ('.glb', '.gltf', '.usdz')
+
+
+class OffsetMismatch(Exception):
+    # チャンクの開始位置が受け取り済みのバイト数と一致しない(クライアントは現在のoffsetから再送する)
+    def __init__(self, offset):
+        super().__init__(offset)
+        self.offset = offset
+
+
+def staging_dir():
+    return getattr(settings, 'CHUNKED_UPLOAD_DIR', os.path.join(settings.MEDIA_ROOT, 'chunked_uploads'))
+
+
+def staging_path(upload):
+    return os.path.join(staging_dir(), '{}.part'.format(upload.id))
+
+
+def parse_content_range(header):
+    # Content-Range: bytes <開始>-<終了>/<全体のサイズ>
+    match = CONTENT_RANGE.match(header or '')
+    if not match:
+        raise ValidationError({'Content-Range': ['Expected "bytes <start>-<end>/<size>".']})
+    start, end, size = (int(value) for value in match.groups())
+    if end < start:
+        raise ValidationError({'Content-Range': ['Invalid byte range.']})
+    return start, end, size
+
+
+# チャンクを一時ファイルに追記し、新しいoffsetを返す
+# streamはリクエストボディ(read(n)できるもの)。lengthバイトをBLOCK_SIZEずつ読んで書き込む
+# ボディの受信はクライアントの回線次第で時間がかかるので、まずロックせずにチャンク用の一時ファイル(<アップロードID>.<ランダム>.chunk)へ書き出し、
+# 行ロックを取るのはoffsetを確認して.partファイルに追記・offsetを進める間だけにする
+def append_chunk(upload_id, stream, start, length):
+    max_chunk = getattr(settings, 'CHUNKED_UPLOAD_MAX_CHUNK_SIZE', 8 * 1024 * 1024)
+    if length > max_chunk:
+        raise ValidationError({'Content-Range': ['Chunk is larger than {} bytes.'.format(max_chunk)]})
+
+    # ボディを受け取る前に、明らかに受け付けられないチャンクを断る(ロック中にもう一度確認する)
+    upload = ChunkedUpload.objects.get(pk=upload_id)
+    _check_chunk(upload, start, length)
+
+    os.makedirs(staging_dir(), exist_ok=True)
+    chunk_path = os.path.join(staging_dir(), '{}.{}.chunk'.format(upload_id, uuid.uuid4().hex))
+    try:
+        written = 0
+        with open(chunk_path, 'wb') as chunk:
+            while written < length:
+                block = stream.read(min(BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                chunk.write(block)
+                written += len(block)
+        if written != length:
+            raise ValidationError({'Content-Range': ['Request body is shorter than the declared range.']})
+
+        with transaction.atomic():
+            # 同じアップロードへの並行したチャンクの追記を防ぐ
+            upload = ChunkedUpload.objects.select_for_update().get(pk=upload_id)
+            _check_chunk(upload, start, length)
+            with open(staging_path(upload), 'ab') as staged, open(chunk_path, 'rb') as chunk:
+                # 前回のチャンクが途中で失敗していた場合は、確定済みのoffsetまで切り詰めてから追記する
+                staged.truncate(upload.offset)
+                staged.seek(upload.offset)
+                shutil.copyfileobj(chunk, staged, BLOCK_SIZE)
+            upload.offset += length
+            upload.save(update_fields=['offset'])
+    finally:
+        try:
+            os.remove(chunk_path)
+        except FileNotFoundError:
+            pass
+    return upload.offset
+
+
+def _check_chunk(upload, start, length):
+    if upload.status != ChunkedUpload.STATUS_UPLOADING:
+        raise ValidationError({'status': ['Upload is already complete.']})
+    if start != upload.offset:
+        raise OffsetMismatch(upload.offset)
+    if start + length > upload.size:
+        raise ValidationError({'Content-Range': ['Chunk exceeds the declared upload size.']})
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as staged:
+        for block in iter(lambda: staged.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# 全てのチャンクを受け取ったアップロードを確認して、投稿のmenu_item_modelとして保存する
+def finalize(upload_id, sha256):
+    with transaction.atomic():
+        # 同じアップロードの並行した完了の処理(ファイルの保存・投稿の更新が2回行われる)を防ぐ
+        upload = ChunkedUpload.objects.select_for_update().get(pk=upload_id)
+        if upload.status != ChunkedUpload.STATUS_UPLOADING:
+            raise ValidationError({'status': ['Upload is already complete.']})
+        if upload.offset != upload.size:
+            raise ValidationError(
+                {'offset': ['Upload is incomplete ({} of {} bytes).'.format(upload.offset, upload.size)]}
+            )
+
+        path = staging_path(upload)
+        if file_sha256(path) != (sha256 or '').lower():
+            raise ValidationError({'sha256': ['Checksum does not match the uploaded data.']})
+
+        post = upload.post
+        with open(path, 'rb') as staged:
+            # ストレージへの保存もファイルから順に読み出して行う
+            # ファイル名(upload_model_path)には確認済みのSHA-256を使う(もう一度ファイル全体を読まない)
+            model_file = File(staged, name=upload.filename)
+            model_file.sha256 = sha256.lower()
+            post.menu_item_model = model_file
+            post.save()
+
+        upload.status = ChunkedUpload.STATUS_COMPLETE
+        upload.save(update_fields=['status'])
+    discard_staging(upload)
+    return post
+
+
+def discard_staging(upload):
+    try:
+        os.remove(staging_path(upload))
+    except FileNotFoundError:
+        pass
+
+
+# 期限切れ(途中で放棄された)アップロードと一時ファイルを削除する
+def clear_expired(hours=None):
+    hours = hours if hours is not None else getattr(settings, 'CHUNKED_UPLOAD_EXPIRE_HOURS', 24)
+    expired = ChunkedUpload.objects.filter(created_on__lt=timezone.now() - timedelta(hours=hours))
+    count = 0
+    for upload in expired.iterator():
+        discard_staging(upload)
+        count += 1
+    expired.delete()
+    return count
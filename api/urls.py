@@ -11,6 +11,8 @@ router.register('profile', views.ProfileViewSet)
 router.register('post', views.PostViewSet)
 router.register('restaurant', views.RestaurantViewSet)
 router.register('category', views.CategoryViewSet)
+# 3Dモデルの分割アップロード
+router.register('model_upload', views.ChunkedUploadViewSet)
 
 # DjangoのURLパターンを定義するurlpatternsリスト
 # generics(汎用ビュー)で作ったViewのurlを設定する
@@ -21,8 +23,24 @@ urlpatterns = [
     path('myprofile/', views.MyProfileListView.as_view(), name='myprofile'),
     # 投稿一覧
     path('post_list/', views.PostListView.as_view(), name='postlist'),
+    # 自分の投稿一覧・ユーザーごとの投稿一覧
+    path('mypost/', views.MyPostListView.as_view(), name='mypost'),
+    path('user/<int:pk>/posts/', views.UserPostListView.as_view(), name='userposts'),
     # 投稿詳細
     path('post_detail/<str:pk>/', views.PostDetailView.as_view(), name="postdetail"),
+    # 投稿の全文検索(ルーターの'post/<pk>/'より先にマッチさせる)
+    path('post/search/', views.PostSearchView.as_view(), name='postsearch'),
+    # 店舗名・カテゴリー名・メニュー名の入力補完
+    path('autocomplete/<str:kind>/', views.AutocompleteView.as_view(), name='autocomplete'),
+    # 注目の投稿・評価の高い店舗・人気の店舗のランキング
+    path('ranking/<str:kind>/', views.RankingView.as_view(), name='ranking'),
+    # 投稿の一括インポート・エクスポート
+    path('post_import/', views.PostImportView.as_view(), name='postimport'),
+    path('post_export/', views.PostExportView.as_view(), name='postexport'),
+    # 署名付きURLによるストレージへの直接アップロード(発行・確認・ローカル用のPUT先)
+    path('upload_url/', views.UploadUrlView.as_view(), name='uploadurl'),
+    path('upload_confirm/', views.UploadConfirmView.as_view(), name='uploadconfirm'),
+    path('upload_local/<str:token>/', views.LocalUploadView.as_view(), name='uploadlocal'),
     # ルーターに登録されたすべてのパスをルートURL（''）に含める、これにより上記で登録したパス（'profile', 'post', 'comment'）がURLとして使えるようになる
     path('',include(router.urls)),
 ]
\ No newline at end of file
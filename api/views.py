@@ -1,8 +1,22 @@
+from django.db.models import Avg, Count, Prefetch, Sum
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 from rest_framework import generics
+from rest_framework import mixins
+from rest_framework import status
 from rest_framework import viewsets
-from rest_framework.permissions import AllowAny
-from . import serializers
-from .models import Profile, Post, Restaurant, Category
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.filters import OrderingFilter
+from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from . import autocomplete, bulk, geo, rankings, restaurants, search, serializers, signed_uploads, uploads
+from .cache import CachedResponseMixin
+from .metrics import MetricsMixin
+from .filters import PostFilter
+from .pagination import NearbyPagination, PostCursorPagination, SearchPagination
+from .models import Profile, Post, Restaurant, Category, RestaurantCategoryStats, ChunkedUpload
 # Create your views here.
 
 # CreateUserView:新規ユーザーを作成するためのAPIエンドポイント
@@ -14,53 +28,428 @@ class CreateUserView(generics.CreateAPIView):
     permission_classes = (AllowAny,)
 
 # ProfileViewSet；プロフィールデータに対するCRUD（Create, Read, Update, Delete）操作を提供するAPIエンドポイント
-class ProfileViewSet(viewsets.ModelViewSet):
+class ProfileViewSet(MetricsMixin, viewsets.ModelViewSet):
     # このビューセットが扱うデータのクエリセットを指定(Profileモデルのすべてのインスタンスを取得)
     queryset = Profile.objects.all()
 
     # ProfileSerializerを使用してプロフィールデータをシリアライズ
     serializer_class = serializers.ProfileSerializer
+    # 1リクエストあたりのクエリ数の上限(api.metrics)
+    query_budget = {'list': 1, 'retrieve': 1}
 
     # perform_createは新規オブジェクトを作成するときにオーバーライドすることができるメソッド
     # 新規プロフィールのuserProfileフィールドを現在認証されているユーザーに設定
     def perform_create(self, serializer):
-        serializer.save(userProfile=self.request.user)
+        # request.userはトークンから作ったユーザーなので、DBのユーザーを取得せずIDで紐付ける
+        serializer.save(userProfile_id=self.request.user.pk)
 
 # MyProfileListView：プロフィールの一覧を取得するためのエンドポイント
-class MyProfileListView(generics.ListAPIView):
+class MyProfileListView(MetricsMixin, generics.ListAPIView):
     queryset = Profile.objects.all()
     serializer_class = serializers.ProfileSerializer
+    # プロフィール + JWT認証のユーザーの状態(api.authenticationのキャッシュにない場合)
+    query_budget = 2
     def get_queryset(self):
-        return self.queryset.filter(userProfile=self.request.user)
+        return self.queryset.filter(userProfile_id=self.request.user.pk)
 
 # RestaurantViewSet：店舗情報に対するCRUD（Create, Read, Update, Delete）操作を提供するAPIエンドポイント
-class RestaurantViewSet(viewsets.ModelViewSet):
-    queryset = Restaurant.objects.all()
+# 集計値(stats)はJOINで取得するため、一覧のクエリ数は集計値なしの場合と変わらない
+class RestaurantViewSet(MetricsMixin, CachedResponseMixin, viewsets.ModelViewSet):
+    queryset = Restaurant.objects.select_related('stats')
     serializer_class = serializers.RestaurantSerializer
     permission_classes = (AllowAny,)
+    # 集計値は投稿から作られるため、投稿の変更でもキャッシュを無効にする
+    cache_namespaces = ('restaurant', 'post')
+    query_budget = {'list': 1, 'retrieve': 2, 'nearby': 1, 'lookup': 1}
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'retrieve':
+            # 詳細ではカテゴリーごとの集計値(投稿のあるもの)もまとめて取得する
+            queryset = queryset.prefetch_related(Prefetch(
+                'category_stats', queryset=RestaurantCategoryStats.objects.filter(post_count__gt=0).order_by('-post_count')
+            ))
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action == 'retrieve':
+            return serializers.RestaurantDetailSerializer
+        if self.action == 'nearby':
+            return serializers.RestaurantNearbySerializer
+        return super().get_serializer_class()
+
+    # 近くの店舗(距離順): /api/restaurant/nearby/?lat=35.68&lng=139.76&radius=1 (radiusはkm)
+    # geohashのインデックスで候補を絞ってから距離を計算するため、テーブル全体は走査しない
+    @action(detail=False, pagination_class=NearbyPagination)
+    def nearby(self, request, *args, **kwargs):
+        params = serializers.NearbyQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        queryset = geo.nearby(self.get_queryset(), params.validated_data['lat'], params.validated_data['lng'],
+                              params.validated_data['radius'])
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+    # 店舗名・場所が同じ(正規化して一致する)店舗: /api/restaurant/lookup/?name=&location= (なければ404)
+    # ユニークインデックスの1件の検索なので、入力中に呼んでも負荷は小さい(レスポンスもキャッシュされる)
+    @action(detail=False)
+    def lookup(self, request, *args, **kwargs):
+        params = serializers.RestaurantKeySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        restaurant = restaurants.find(params.validated_data['name'], params.validated_data['location'], self.get_queryset())
+        if restaurant is None:
+            raise NotFound()
+        return Response(self.get_serializer(restaurant).data)
+
+    # POST /api/restaurant/lookup/ {"name": ..., "location": ...}: 同じ店舗を返し、なければ作成する(作成した場合は201)
+    @lookup.mapping.post
+    def resolve(self, request, *args, **kwargs):
+        params = serializers.RestaurantKeySerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        restaurant, created = restaurants.get_or_create(params.validated_data['name'], params.validated_data['location'])
+        return Response(
+            self.get_serializer(restaurant).data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        )
+
+    def _is_cacheable_request(self, request):
+        # 位置ごとに異なるレスポンスになる近くの店舗はキャッシュしない(キャッシュがすぐに溢れるため)
+        return super()._is_cacheable_request(request) and self.action_map.get(request.method.lower()) != 'nearby'
 
 # CategoryViewSet：カテゴリーに対するCRUD（Create, Read, Update, Delete）操作を提供するAPIエンドポイント
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(MetricsMixin, CachedResponseMixin, viewsets.ModelViewSet):
     queryset = Category.objects.all()
     serializer_class = serializers.CategorySerializer
     permission_classes = (AllowAny,)
+    cache_namespaces = ('category',)
+    query_budget = {'list': 1, 'retrieve': 1}
+
+# 投稿の読み取り(一覧・詳細・検索)を高速なシリアライザー(PostReadSerializer)で返すMixin
+# ?expand=restaurant,category,author_profile  店舗・カテゴリーをIDの代わりに中身で返し、投稿者のプロフィールを追加する
+#                                            (select_related/prefetch_relatedで取得するため、展開してもクエリ数は増えない)
+# ?fields=id,menu_item,restaurant            返すフィールドを絞る
+class PostReadMixin:
+    read_actions = ('list', 'retrieve', None)
+
+    def is_read_request(self):
+        return self.request.method in ('GET', 'HEAD') and getattr(self, 'action', None) in self.read_actions
+
+    def get_cache_namespaces(self, request):
+        return _expanded_namespaces(self.cache_namespaces, request)
+
+    def get_expand(self):
+        if not hasattr(self, '_expand'):
+            self._expand = _name_list(self.request.query_params, 'expand', serializers.PostReadSerializer.expandable)
+        return self._expand
+
+    def get_fields(self):
+        if not hasattr(self, '_fields'):
+            allowed = serializers.PostReadSerializer.field_names(self.get_expand())
+            self._fields = _name_list(self.request.query_params, 'fields', allowed) or None
+        return self._fields
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if not self.is_read_request():
+            return queryset
+        expand = self.get_expand()
+        if 'restaurant' in expand:
+            queryset = queryset.select_related('restaurant__stats')
+        if 'author_profile' in expand:
+            queryset = queryset.select_related('author__profile')
+        return queryset
+
+    def get_serializer_class(self):
+        if self.is_read_request():
+            return serializers.PostReadSerializer
+        return super().get_serializer_class()
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.is_read_request():
+            context['expand'] = self.get_expand()
+            context['fields'] = self.get_fields()
+        return context
+
+# カンマ区切りの名前の一覧(allowed以外の名前はエラー)
+# ?expand=で埋め込む関連と、その内容が依存するデータ(api.cacheのnamespace)
+EXPAND_NAMESPACES = {
+    'restaurant': ('restaurant',),
+    'category': ('category',),
+    'author_profile': ('profile',),
+}
+
+
+# 依存するデータに?expand=で埋め込む関連のnamespaceを加える(キャッシュの確認はビューの処理前なので、requestはDjangoのもの)
+def _expanded_namespaces(namespaces, request):
+    expanded = [value.strip() for value in request.GET.get('expand', '').split(',')]
+    extra = [namespace for value in expanded for namespace in EXPAND_NAMESPACES.get(value, ())]
+    return tuple(dict.fromkeys(tuple(namespaces) + tuple(extra)))
+
+
+def _name_list(params, name, allowed):
+    values = [value.strip() for value in params.get(name, '').split(',') if value.strip()]
+    unknown = [value for value in values if value not in allowed]
+    if unknown:
+        raise ValidationError({name: ['Unknown value(s): {}. Choose from: {}.'.format(', '.join(unknown), ', '.join(allowed))]})
+    return tuple(dict.fromkeys(values))
 
 # PostViewSet：投稿に対するCRUD（Create, Read, Update, Delete）操作を提供するAPIエンドポイント
-class PostViewSet(viewsets.ModelViewSet):
-    queryset = Post.objects.all()
+class PostViewSet(MetricsMixin, PostReadMixin, viewsets.ModelViewSet):
+    queryset = Post.objects.prefetch_related('category')
     serializer_class = serializers.PostSerializer
+    # カテゴリー・店舗・投稿者・スコア・値段で絞り込み、?ordering=で並び替え
+    filter_backends = (PostFilter, OrderingFilter)
+    ordering_fields = ('created_on', 'score', 'price')
+    ordering = ('-created_on', '-id')
+    # カテゴリーはprefetch_relatedで1クエリにまとめる(投稿ごとにクエリを発行しない)
+    query_budget = {'list': 2, 'retrieve': 2}
 
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        serializer.save(author_id=self.request.user.pk)
 
 # 投稿一覧取得(誰でもアクセス可能)
-class PostListView(generics.ListAPIView):
-    queryset = Post.objects.all()
+# カーソルでページ分割し、店舗・投稿者はJOIN、カテゴリーは1クエリでまとめて取得する
+# (ページサイズに関わらず1ページあたりのクエリ数は一定)
+class PostListView(MetricsMixin, PostReadMixin, CachedResponseMixin, generics.ListAPIView):
+    queryset = Post.objects.select_related('restaurant', 'author').prefetch_related('category')
     serializer_class = serializers.PostSerializer
     permission_classes = (AllowAny,)
+    cache_namespaces = ('post',)
+    pagination_class = PostCursorPagination
+    filter_backends = (PostFilter, OrderingFilter)
+    ordering_fields = ('created_on', 'score', 'price')
+    ordering = ('-created_on',)
+    query_budget = 2
 
-class PostDetailView(generics.RetrieveAPIView):
-    queryset = Post.objects.all()
+class PostDetailView(MetricsMixin, PostReadMixin, CachedResponseMixin, generics.RetrieveAPIView):
+    queryset = Post.objects.prefetch_related('category')
+    serializer_class = serializers.PostSerializer
+    permission_classes = (AllowAny,)
+    cache_namespaces = ('post',)
+    query_budget = 2
+
+# ユーザーごとの投稿一覧(新しい投稿順)
+# /api/mypost/ は自分の投稿、/api/user/<id>/posts/ は指定したユーザーの投稿(誰でもアクセス可能)
+# (author, created_on, id)のインデックスでそのユーザーの投稿だけを読み、keysetでページ分割する
+# ?summary=true で投稿数・平均スコア・合計金額(summary)を1回の集計クエリで追加する
+class UserPostListView(MetricsMixin, PostReadMixin, CachedResponseMixin, generics.ListAPIView):
+    queryset = Post.objects.prefetch_related('category')
+    permission_classes = (AllowAny,)
+    cache_namespaces = ('post',)
+    pagination_class = PostCursorPagination
+    # 投稿・カテゴリー(summary付きは集計の1クエリが増える)
+    query_budget = 2
+
+    def get_author_id(self):
+        return self.kwargs['pk']
+
+    def get_queryset(self):
+        return super().get_queryset().filter(author_id=self.get_author_id())
+
+    def get_query_budget(self):
+        return self.query_budget + 1 if self.wants_summary() else self.query_budget
+
+    def wants_summary(self):
+        return self.request.query_params.get('summary', '').lower() in ('1', 'true')
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        if self.wants_summary():
+            response.data['summary'] = self.get_summary()
+        return response
+
+    def get_summary(self):
+        summary = Post.objects.filter(author_id=self.get_author_id()).aggregate(
+            count=Count('id'), avg_score=Avg('score'), total_spend=Sum('price'),
+        )
+        return {
+            'count': summary['count'],
+            'avg_score': round(summary['avg_score'], 2) if summary['avg_score'] is not None else None,
+            'total_spend': summary['total_spend'] or 0,
+        }
+
+class MyPostListView(UserPostListView):
+    permission_classes = (IsAuthenticated,)
+
+    def get_author_id(self):
+        return self.request.user.pk
+
+    # ユーザーごとにレスポンスが異なるのでキャッシュしない
+    def _is_cacheable_request(self, request):
+        return False
+
+# 投稿の全文検索(誰でもアクセス可能)
+# ?q=検索語(空白区切りでAND検索)、メニュー名・レビュー・店舗名・店舗の場所が対象
+# 結果は関連度順で、?limit=&offset=でページ分割する
+class PostSearchView(MetricsMixin, PostReadMixin, CachedResponseMixin, generics.GenericAPIView):
+    queryset = Post.objects.select_related('restaurant', 'author').prefetch_related('category')
     serializer_class = serializers.PostSerializer
     permission_classes = (AllowAny,)
+    cache_namespaces = ('post', 'restaurant')
+    pagination_class = SearchPagination
+    # 検索・投稿の取得・カテゴリー
+    query_budget = 3
+
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': ['This field is required.']})
+
+        ids = self.paginator.paginate_search(
+            lambda limit, offset: search.search_post_ids(query, limit, offset), request
+        )
+        posts = self.get_queryset().in_bulk(ids)
+        serializer = self.get_serializer([posts[pk] for pk in ids if pk in posts], many=True)
+        return self.paginator.get_paginated_response(serializer.data)
+
+# AutocompleteView：店舗名・カテゴリー名・メニュー名の前方一致の入力補完(投稿数の多い順)
+# /api/autocomplete/restaurant/?q=らー  /api/autocomplete/category/?q=ラ  /api/autocomplete/menu_item/?q=醤油
+class AutocompleteView(MetricsMixin, APIView):
+    permission_classes = (AllowAny,)
+    # プロセス内のキャッシュにある接頭辞はクエリなし
+    query_budget = 1
+
+    def get(self, request, kind):
+        if kind not in autocomplete.SOURCES:
+            raise NotFound()
+        params = serializers.AutocompleteQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        return Response({'results': autocomplete.complete(kind, params.validated_data['q'], params.validated_data['limit'])})
+
+# RankingView：ランキング(api.rankings、manage.py refresh_rankingsが定期的に作成したもの)
+# /api/ranking/trending/?category=<id>&limit=20  注目の投稿(新しく評価の高い投稿、?expand=は投稿一覧と同じ)
+# /api/ranking/top_rated/?category=<id>          評価の高い店舗(投稿数で補正した平均スコア順)
+# /api/ranking/top_restaurants/?category=<id>    人気の店舗(投稿数・新しさ・スコア)
+# 保存済みの上位の行をインデックスで読むだけなので、投稿数によらずクエリ数・時間は一定
+class RankingView(MetricsMixin, CachedResponseMixin, APIView):
+    permission_classes = (AllowAny,)
+    # 投稿・店舗の内容の変更もすぐに反映する
+    cache_namespaces = ('ranking', 'post', 'restaurant')
+    # ランキングの行(投稿・店舗をJOIN)・投稿のカテゴリー・最後の更新
+    query_budget = 3
+
+    def get_cache_namespaces(self, request):
+        return _expanded_namespaces(self.cache_namespaces, request)
+
+    def get(self, request, kind):
+        if kind not in rankings.KINDS:
+            raise NotFound()
+        params = serializers.RankingQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        expand = _name_list(request.query_params, 'expand', serializers.PostReadSerializer.expandable)
+        category_id = params.validated_data.get('category')
+        entries = rankings.top(kind, category_id, params.validated_data['limit'], expand)
+        context = {'request': request, 'expand': expand, 'now': timezone.now()}
+        run = rankings.last_run()
+        return Response({
+            'kind': kind,
+            'category': category_id,
+            'computed_on': run.finished_on if run is not None else None,
+            'results': serializers.RankingEntrySerializer(entries, many=True, context=context).data,
+        })
+
+# PostImportView：投稿の一括インポート(api.bulk)
+# POST /api/post_import/ にNDJSON(Content-Type: application/x-ndjson)かCSV(Content-Type: text/csv)のボディを送る
+# ボディは1行ずつ読みながらバッチごとに保存し、作成件数と行ごとのエラーを返す。投稿者はリクエストしたユーザー
+# ?create_missing=true で存在しない店舗・カテゴリーを作成する
+class PostImportView(MetricsMixin, APIView):
+    def post(self, request, *args, **kwargs):
+        data_format = bulk.FORMAT_CSV if request.content_type.split(';')[0].strip().lower() == 'text/csv' else bulk.FORMAT_NDJSON
+        importer = bulk.PostImporter(
+            author_id=request.user.pk,
+            create_missing=request.query_params.get('create_missing', '').lower() in ('1', 'true'),
+        )
+        result = importer.run(bulk.iter_rows(request.stream, data_format))
+        return Response(result)
+
+# PostExportView：投稿のエクスポート(api.bulk、インポートと同じ形式)
+# GET /api/post_export/?data_format=ndjson|csv (投稿一覧と同じ絞り込みのパラメーターが使える)
+# 投稿は.iterator()でchunkごとに読み、書き出した行から順に送信するので、件数によらずメモリの使用量は一定で
+# 最初のバイトが届くまでの時間も短い
+class PostExportView(MetricsMixin, generics.GenericAPIView):
+    queryset = Post.objects.all()
+    filter_backends = (PostFilter,)
+
+    def get(self, request, *args, **kwargs):
+        # formatはDRFがレンダラーの選択に使うため、data_formatで指定する
+        data_format = request.query_params.get('data_format', bulk.FORMAT_NDJSON)
+        if data_format not in bulk.FORMATS:
+            raise ValidationError({'data_format': ['Must be one of: {}.'.format(', '.join(bulk.FORMATS))]})
+        rows = bulk.iter_export_rows(self.filter_queryset(self.get_queryset()))
+        response = StreamingHttpResponse(
+            bulk.buffered(bulk.render_rows(rows, data_format)), content_type=bulk.CONTENT_TYPES[data_format]
+        )
+        response['Content-Disposition'] = 'attachment; filename="posts.{}"'.format(data_format)
+        return response
+
+# ChunkedUploadViewSet：3Dモデル(menu_item_model)の分割・再開可能なアップロード
+# POST /api/model_upload/                {post, filename, size}でアップロードを開始
+# GET  /api/model_upload/<id>/           受け取り済みのバイト数(offset)を確認(中断からの再開時)
+# PUT  /api/model_upload/<id>/           Content-Range: bytes <start>-<end>/<size> ヘッダーとチャンクのバイト列を送信
+# POST /api/model_upload/<id>/finalize/  {sha256}でチェックサムを確認し、投稿のmenu_item_modelとして保存
+class ChunkedUploadViewSet(MetricsMixin, mixins.CreateModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    queryset = ChunkedUpload.objects.all()
+    serializer_class = serializers.ChunkedUploadSerializer
+
+    def get_queryset(self):
+        return self.queryset.filter(user_id=self.request.user.pk)
+
+    def perform_create(self, serializer):
+        serializer.save(user_id=self.request.user.pk)
+
+    def update(self, request, *args, **kwargs):
+        upload = self.get_object()
+        start, end, size = uploads.parse_content_range(request.META.get('HTTP_CONTENT_RANGE'))
+        if size != upload.size:
+            raise ValidationError({'Content-Range': ['Size does not match the upload size.']})
+        # request.dataは使わず(パーサーでボディ全体を読み込まないように)、ストリームから直接読む
+        stream = request.stream
+        if stream is None:
+            raise ValidationError({'Content-Range': ['Request body is empty.']})
+        try:
+            offset = uploads.append_chunk(upload.pk, stream, start, end - start + 1)
+        except uploads.OffsetMismatch as exc:
+            # 開始位置がずれている場合は、受け取り済みのoffsetを返してそこから送り直してもらう
+            return Response({'id': upload.pk, 'offset': exc.offset, 'size': upload.size}, status=status.HTTP_409_CONFLICT)
+        return Response({'id': upload.pk, 'offset': offset, 'size': upload.size})
+
+    @action(detail=True, methods=['post'])
+    def finalize(self, request, pk=None):
+        post = uploads.finalize(self.get_object().pk, request.data.get('sha256'))
+        return Response(serializers.PostSerializer(post, context=self.get_serializer_context()).data)
+
+# 署名付きURLによるストレージへの直接アップロード(api.signed_uploads)
+# UploadUrlView：アップロード先(署名付きのPUT先URLとファイル名)を発行する
+class UploadUrlView(MetricsMixin, generics.GenericAPIView):
+    serializer_class = serializers.UploadUrlSerializer
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        upload = signed_uploads.issue(
+            data['target'], data['id'], data['filename'], data['content_type'], request.user.pk, request
+        )
+        return Response(upload, status=status.HTTP_201_CREATED)
+
+# UploadConfirmView：アップロードしたファイルを投稿・プロフィールに紐付ける
+class UploadConfirmView(MetricsMixin, APIView):
+    def post(self, request, *args, **kwargs):
+        instance = signed_uploads.confirm(request.data.get('token', ''), request.user.pk)
+        serializer_class = serializers.PostSerializer if isinstance(instance, Post) else serializers.ProfileSerializer
+        return Response(serializer_class(instance, context={'request': request}).data)
+
+# LocalUploadView：ローカル環境でストレージの代わりにPUTを受け付ける(DIRECT_UPLOAD_BACKENDがLocalUploadBackendの時のみ)
+# URLのトークンが署名されているため、認証ヘッダーは不要
+class LocalUploadView(APIView):
+    permission_classes = (AllowAny,)
+    authentication_classes = ()
 
+    def put(self, request, token, *args, **kwargs):
+        backend = signed_uploads.get_backend()
+        if not isinstance(backend, signed_uploads.LocalUploadBackend):
+            raise NotFound()
+        backend.store(
+            token, request.stream, int(request.META.get('CONTENT_LENGTH') or 0),
+            request.META.get('CONTENT_TYPE', '').split(';')[0].strip(),
+        )
+        return Response(status=status.HTTP_204_NO_CONTENT)
@@ -8,9 +8,68 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 """
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 
+from asgiref.sync import async_to_sync, sync_to_async
 from django.core.asgi import get_asgi_application
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections
+
+from api.connections import check_idle_connections, mark_connections_used
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api_gourmet.settings')
 
-application = get_asgi_application()
+
+# ビュー(同期)をスレッドプールで並行に処理するASGIハンドラー
+# Django 3.0のASGIHandlerはsync_to_async(get_response)を既定の引数で呼ぶが、
+# asgiref 3.3以降は既定がthread_sensitive=Trueのため、1プロセスの全リクエストが1つのスレッドで順番に処理されてしまう。
+# ここではthread_sensitive=Falseでスレッドプール(ASGI_THREADS)に渡し、
+# DB接続の後始末(通常はrequest_started/request_finishedで行う)も処理したスレッドで行う
+class ConcurrentASGIHandler(ASGIHandler):
+    def __init__(self):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('ASGI_THREADS', 8)),
+            thread_name_prefix='asgi-view',
+        )
+
+    async def get_response(self, request):
+        return await sync_to_async(self._get_response_in_thread, thread_sensitive=False, executor=self.executor)(request)
+
+    def _get_response_in_thread(self, request):
+        close_old_connections()
+        check_idle_connections()
+        try:
+            return super().get_response(request)
+        finally:
+            close_old_connections()
+            mark_connections_used()
+
+    # ストリーミングのレスポンス(投稿のエクスポートなど)はイテレーターがDBを読むため、
+    # イベントループではなくスレッドプールの1つのスレッドで最後まで読み出して送信する
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        await sync_to_async(self._send_streaming_in_thread, thread_sensitive=False, executor=self.executor)(response, send)
+
+    def _send_streaming_in_thread(self, response, send):
+        send = async_to_sync(send)
+        headers = [
+            (header.encode('ascii'), value.encode('latin1')) for header, value in response.items()
+        ] + [
+            (b'Set-Cookie', cookie.output(header='').encode('ascii').strip()) for cookie in response.cookies.values()
+        ]
+        send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        try:
+            for part in response:
+                for chunk, _ in self.chunk_bytes(part):
+                    send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            send({'type': 'http.response.body'})
+        finally:
+            response.close()
+            close_old_connections()
+            mark_connections_used()
+
+
+get_asgi_application()  # django.setup()
+application = ConcurrentASGIHandler()
@@ -14,7 +14,7 @@ from pathlib import Path
 from datetime import timedelta
 import dj_database_url
 import os
-from google.oauth2 import service_account
+from django.core.exceptions import ImproperlyConfigured
 
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -51,6 +51,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # リクエストごとのクエリ数・時間の計測(Server-Timingヘッダーと/metrics)
+    'api.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -98,8 +100,9 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     # 認証方法を指定する
+    # JWTの検証後、ユーザーをDBから取得せずトークンから組み立てる(api.authentication)
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication'
+        'api.authentication.CachedJWTAuthentication'
     ]
 }
 
@@ -108,18 +111,136 @@ SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
 }
 
+# JWT認証でキャッシュするユーザーの状態(is_active等)の有効期間(秒)
+# ユーザーの更新はシグナルでキャッシュから消すが、別プロセスのローカルメモリキャッシュにはこの時間だけ残る
+JWT_USER_STATE_TIMEOUT = int(os.environ.get('JWT_USER_STATE_TIMEOUT', 60))
+
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 if DEBUG:
     DATABASES = {
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
-            'NAME': BASE_DIR / 'db.sqlite3',
+            'NAME': str(BASE_DIR / 'db.sqlite3'),
         }
     }
 else:
     DATABASES = {"default": dj_database_url.config()}
 
+# データベースへの接続の持ち方(api.connections)
+#   off        : リクエストごとに接続・切断する
+#   persistent : DB_CONN_MAX_AGE秒の間、接続を使い回す(DB_HEALTH_CHECK_INTERVAL秒以上使っていない接続は使う前に確認する)
+#   pool       : プロセス内の接続プール(api.pool_backend、Postgresのみ)。リクエストの終わりに接続をプールへ返す
+# DBへの同時接続数は WEB_CONCURRENCY(ワーカー数) × 1ワーカーの接続数(DB_POOL_MAX) になるので、DBの上限を超えないようにする
+DB_CONN_MODE = os.environ.get('DB_CONN_MODE', 'persistent')
+DB_HEALTH_CHECK_INTERVAL = float(os.environ.get('DB_HEALTH_CHECK_INTERVAL', 30))
+# 1ワーカーで同時に処理するリクエスト数(ASGIはビューのスレッド数、WSGIの同期ワーカーは1)
+WORKER_THREADS = int(os.environ.get('ASGI_THREADS', 8)) if os.environ.get('SERVER_MODE') == 'asgi' else 1
+if DB_CONN_MODE == 'persistent':
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('DB_CONN_MAX_AGE', 600))
+elif DB_CONN_MODE == 'pool' and DATABASES['default'].get('ENGINE') in (
+    'django.db.backends.postgresql', 'django.db.backends.postgresql_psycopg2'
+):
+    DATABASES['default']['ENGINE'] = 'api.pool_backend'
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['POOL'] = {
+        'MAX_SIZE': int(os.environ.get('DB_POOL_MAX', WORKER_THREADS)),
+        'TIMEOUT': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'MAX_LIFETIME': float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800)),
+    }
+else:
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+
+
+# キャッシュ
+# デフォルトはプロセスごとのローカルメモリ(LRU)。REDIS_URLを設定した場合はRedisを使う(django-redis)
+# キャッシュを無効にするバージョン(api.cache)は全ワーカーで共有する必要があるため、
+# 複数のワーカー(WEB_CONCURRENCY > 1)で動かす場合、Redisがなければレスポンスキャッシュ・入力補完のキャッシュは使わない
+# (ローカルメモリでは書き込みを処理したワーカーのバージョンしか上がらず、他のワーカーが古いレスポンスを返すため)
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'api_gourmet',
+            'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('API_CACHE_MAX_ENTRIES', 1000))},
+        }
+    }
+SHARED_CACHE = bool(os.environ.get('REDIS_URL')) or WEB_CONCURRENCY <= 1
+
+# 誰でもアクセスできる読み取りAPIのレスポンスキャッシュ(api.cache)
+API_CACHE_ENABLED = os.environ.get('API_CACHE_ENABLED', '1' if SHARED_CACHE else '0') == '1'
+if API_CACHE_ENABLED and not SHARED_CACHE:
+    raise ImproperlyConfigured('API_CACHE_ENABLED with WEB_CONCURRENCY > 1 requires REDIS_URL (shared cache versions).')
+API_CACHE_ALIAS = 'default'
+API_CACHE_TIMEOUT = int(os.environ.get('API_CACHE_TIMEOUT', 300))
+
+# 画像の縮小版の作成(api.images)
+# 縮小版を作る幅(px)、バックグラウンドで処理するスレッド数、画質
+IMAGE_VARIANT_WIDTHS = (320, 640, 1280)
+IMAGE_PIPELINE_WORKERS = int(os.environ.get('IMAGE_PIPELINE_WORKERS', 2))
+IMAGE_VARIANT_QUALITY = 80
+# Trueの場合はバックグラウンドではなく保存したリクエストの中で作成する(テスト用)
+IMAGE_PIPELINE_SYNC = os.environ.get('IMAGE_PIPELINE_SYNC') == '1'
+
+# 3Dモデルの分割アップロード(api.uploads)
+# チャンクを溜める一時ディレクトリ、ファイル全体・1チャンクの最大サイズ(バイト)、放棄されたアップロードの保持時間
+CHUNKED_UPLOAD_DIR = os.environ.get('CHUNKED_UPLOAD_DIR', os.path.join(BASE_DIR, 'tmp', 'chunked_uploads'))
+CHUNKED_UPLOAD_MAX_SIZE = 200 * 1024 * 1024
+CHUNKED_UPLOAD_MAX_CHUNK_SIZE = 8 * 1024 * 1024
+CHUNKED_UPLOAD_EXPIRE_HOURS = 24
+
+# 署名付きURLによるストレージへの直接アップロード(api.signed_uploads)
+# GCSの署名付きURL(GoogleCloudUploadBackend)か、ローカル用のPUT先(LocalUploadBackend)
+# 未指定の場合はSTORAGE_BACKENDに合わせる(gcsならGoogleCloudUploadBackend、それ以外はLocalUploadBackend)
+DIRECT_UPLOAD_BACKEND = os.environ.get('DIRECT_UPLOAD_BACKEND')
+DIRECT_UPLOAD_EXPIRES = 15 * 60
+DIRECT_UPLOAD_MAX_SIZE = 200 * 1024 * 1024
+# 画像(投稿のメニュー画像・プロフィール画像)の上限
+DIRECT_UPLOAD_MAX_IMAGE_SIZE = 20 * 1024 * 1024
+
+# 投稿の一括インポート・エクスポート(api.bulk)
+# 1回のbulk_createで保存する行数、レスポンスに含める行ごとのエラーの最大件数、エクスポートで1回に読み込む投稿数
+BULK_IMPORT_BATCH_SIZE = int(os.environ.get('BULK_IMPORT_BATCH_SIZE', 500))
+BULK_IMPORT_MAX_ERRORS = 100
+BULK_EXPORT_CHUNK_SIZE = 1000
+
+# /metrics(api.metrics)の認証用トークン(Authorization: Bearer <METRICS_TOKEN>。未設定の場合はスタッフのログインが必要)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# 入力補完(api.autocomplete)の件数とプロセス内にキャッシュする接頭辞の数
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 20
+AUTOCOMPLETE_CACHE_SIZE = int(os.environ.get('AUTOCOMPLETE_CACHE_SIZE', 2000))
+# 投稿数を数える候補(カテゴリー・メニュー名)の最大数。前方一致する名前を名前順にこの件数まで取ってから数える
+AUTOCOMPLETE_CANDIDATES = 200
+
+# 近くの店舗の検索(api.geo)の半径の上限(km)と、緯度・経度の補完(manage.py backfill_restaurant_locations)に使うジオコーダー
+NEARBY_MAX_RADIUS_KM = 20
+GEOCODER_URL = os.environ.get('GEOCODER_URL', 'https://nominatim.openstreetmap.org/search')
+GEOCODER_USER_AGENT = 'api_gourmet'
+GEOCODER_INTERVAL = 1.0
+
+# ランキング(api.rankings、manage.py refresh_rankings)
+# 保存する件数(APIで返せる最大件数)とAPIのデフォルトの件数、投稿のスコアが半分に減衰するまでの日数、
+# 評価の補正(RANKING_PRIOR_SCOREの投稿RANKING_PRIOR_COUNT件分を加えて平均する)、差分更新で前回の開始時刻から遡る秒数
+RANKING_SIZE = 100
+RANKING_PAGE_SIZE = 20
+RANKING_HALF_LIFE_DAYS = float(os.environ.get('RANKING_HALF_LIFE_DAYS', 3))
+RANKING_PRIOR_SCORE = 3.0
+RANKING_PRIOR_COUNT = 5
+RANKING_OVERLAP_SECONDS = 300
+
+# 全文検索(api.search)のクエリ実行時間の上限(ミリ秒)
+SEARCH_TIMEOUT_MS = int(os.environ.get('SEARCH_TIMEOUT_MS', 300))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -156,14 +277,27 @@ USE_TZ = True
 # djangoのデフォルトのユーザモデルをemail仕様にoverrideしたため、その設定
 AUTH_USER_MODEL = 'api.User'
 
-# GoogleCloudStorage settings
-GS_CREDENTIALS = service_account.Credentials.from_service_account_file(
-    os.path.join(BASE_DIR, 'GOOGLE_CREDENTIALS_JSON')
-)
+# メディアファイルのストレージ(api.storage)
+# gcs(GoogleCloudStorage) / local(MEDIA_ROOTに保存) / memory(プロセスのメモリに保存、テスト用)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'gcs')
+STORAGE_BACKENDS = {
+    'gcs': 'api.storage.gcs.GoogleCloudStorage',
+    'local': 'api.storage.local.FileSystemStorage',
+    'memory': 'api.storage.memory.InMemoryStorage',
+}
+DEFAULT_FILE_STORAGE = STORAGE_BACKENDS[STORAGE_BACKEND]
 
-DEFAULT_FILE_STORAGE = 'storages.backends.gcloud.GoogleCloudStorage'
+# GoogleCloudStorage settings
+# 認証情報は最初にGCSを使う時に読み込む(api.storage.get_credentials)
+# GS_CREDENTIALS_JSON(鍵のJSONそのもの)、GS_CREDENTIALS_FILE(鍵ファイル)の順に使い、どちらもなければADCを使う
+GS_CREDENTIALS_FILE = os.environ.get('GS_CREDENTIALS_FILE', os.path.join(BASE_DIR, 'GOOGLE_CREDENTIALS_JSON'))
+GS_CREDENTIALS_JSON = os.environ.get('GS_CREDENTIALS_JSON')
 GS_BUCKET_NAME = 'ar-gourmet-app'
 GS_PROJECT_ID = 'gourmet-review'
+# ファイル名は内容のハッシュ(api.models.upload_post_path等)で、同じ名前のファイルの内容は変わらないため長期間キャッシュさせる
+GS_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Trueの場合はファイルのURLを署名付きURLにする(非公開のバケット用)。Falseの場合はMEDIA_URL + ファイル名
+GS_QUERYSTRING_AUTH = os.environ.get('GS_QUERYSTRING_AUTH') == '1'
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
@@ -172,5 +306,9 @@ STATIC_URL = '/static/'
 STATIC_ROOT = str(BASE_DIR / 'staticfiles')
 # 画像の格納先を指定
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
-MEDIA_URL = 'https://storage.googleapis.com/{}/'.format(GS_BUCKET_NAME)
+# MEDIA_CDN_URLを指定した場合はバケットの代わりにCDN(バケットをオリジンにしたもの)のURLにする
+if STORAGE_BACKEND == 'gcs':
+    MEDIA_URL = os.environ.get('MEDIA_CDN_URL') or 'https://storage.googleapis.com/{}/'.format(GS_BUCKET_NAME)
+else:
+    MEDIA_URL = '/media/'
 
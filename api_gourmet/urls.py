@@ -2,11 +2,14 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from api.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
     path('authen/', include('djoser.urls.jwt')),
+    # リクエストの計測値(Prometheusのテキスト形式)
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 # 静的メディアファイルを扱うためのURLパターンを追加
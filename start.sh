@@ -0,0 +1,11 @@
+#!/usr/bin/env bash
+# exit on error
+set -o errexit
+
+# SERVER_MODE=asgi の場合はuvicornのワーカー(ASGI)で起動する。それ以外は従来通りWSGIで起動する
+# ワーカー数はgunicornがWEB_CONCURRENCYから読み込む
+if [ "$SERVER_MODE" = "asgi" ]; then
+    exec gunicorn api_gourmet.asgi:application -k uvicorn.workers.UvicornWorker
+else
+    exec gunicorn api_gourmet.wsgi:application
+fi